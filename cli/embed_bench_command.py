@@ -0,0 +1,117 @@
+import click
+from pathlib import Path
+from typing import Dict, List
+from rich.table import Table
+
+from frag.utils import console
+from frag.settings import Settings
+
+
+def bench_embeddings(
+    model: str | None,
+    texts_path: str | None,
+    count: int,
+    batch_size: int,
+    threads: int | None,
+    rounds: int,
+    workers: int = 0,
+) -> None:
+    """
+    Compare the PyTorch and ONNX backends of a HuggingFace embedding model.
+
+    Args:
+        model (str, optional): The model; defaults to the one in the settings.
+        texts_path (str, optional): A file whose lines are embedded; sample sentences otherwise.
+        count (int): Number of texts embedded per round.
+        batch_size (int): Texts per inference batch.
+        threads (int, optional): ONNX Runtime threads.
+        rounds (int): Rounds per backend; the best one counts.
+        workers (int): Also run each backend in a pool of this many worker processes.
+    """
+    from frag.embeddings.hf_embed_api import HFEmbedAPI, benchmark, parity
+
+    settings: Settings = Settings.from_path()
+    name: str = model or settings.embeds.api_model
+    if texts_path is not None:
+        lines: List[str] = [
+            line.strip()
+            for line in Path(texts_path).read_text(encoding="utf-8").splitlines()
+            if line.strip()
+        ]
+    else:
+        lines = [
+            f"Sample sentence number {i}, about topic {i % 17} and its details."
+            for i in range(count)
+        ]
+    texts: List[str] = (lines * (count // max(len(lines), 1) + 1))[:count]
+
+    options: Dict[str, object] = {
+        "name": name,
+        "embed_batch_size": batch_size,
+        "threads": threads,
+        "cache_dir": str(settings.embeds.path),
+    }
+    models: Dict[str, HFEmbedAPI] = {
+        "torch": HFEmbedAPI(**options),
+        "onnx": HFEmbedAPI(backend="onnx", **options),
+        "onnx-int8": HFEmbedAPI(backend="onnx", quantize=True, **options),
+    }
+    if workers:
+        models.update(
+            {
+                f"{label} x{workers}": HFEmbedAPI(
+                    **{**options, "embed_batch_size": batch_size * workers},
+                    backend=model_api.backend,
+                    quantize=model_api.quantize,
+                    workers=workers,
+                )
+                for label, model_api in list(models.items())
+            }
+        )
+    try:
+        throughput: Dict[str, float] = benchmark(models, texts, rounds=rounds)
+
+        table = Table(title=f"{name}: {count} texts, batches of {batch_size}")
+        table.add_column("backend")
+        table.add_column("texts/s", justify="right")
+        table.add_column("speed-up", justify="right")
+        table.add_column("min cosine vs torch", justify="right")
+        for label, model_api in models.items():
+            table.add_row(
+                label,
+                f"{throughput[label]:.1f}",
+                f"{throughput[label] / throughput['torch']:.2f}x",
+                "-" if label == "torch" else f"{parity(model_api, texts[:64]):.4f}",
+            )
+        console.print(table)
+    finally:
+        for model_api in models.values():
+            model_api.close()
+
+
+@click.command("embed:bench")
+@click.option("--model", "-m", default=None, type=str, help="HuggingFace model name")
+@click.option("--texts", "texts_path", default=None, type=str, help="File of texts, one per line")
+@click.option("--count", "-n", default=512, type=int)
+@click.option("--batch-size", "-b", default=32, type=int)
+@click.option("--threads", "-t", default=None, type=int)
+@click.option("--rounds", "-r", default=3, type=int)
+@click.option("--workers", "-w", default=0, type=int, help="Also bench worker pools")
+def main(
+    model: str | None,
+    texts_path: str | None,
+    count: int,
+    batch_size: int,
+    threads: int | None,
+    rounds: int,
+    workers: int,
+) -> None:
+    bench_embeddings(
+        model=model,
+        texts_path=texts_path,
+        count=count,
+        batch_size=batch_size,
+        threads=threads,
+        rounds=rounds,
+        workers=workers,
+    )
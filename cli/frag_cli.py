@@ -9,6 +9,13 @@ from click.core import Group
 from .init_command import main as init
 from .test_settings_command import main as test_settings
 from .store_init_command import main as store_init
+from .store_reembed_command import main as store_reembed
+from .store_compact_command import main as store_compact
+from .store_gc_command import main as store_gc
+from .store_export_command import main as store_export
+from .store_import_command import main as store_import
+from .store_publish_command import main as store_publish
+from .embed_bench_command import main as embed_bench
 
 
 @click.group()
@@ -21,6 +28,13 @@ def frag() -> None:
 frag.add_command(init)
 frag.add_command(test_settings)
 frag.add_command(store_init)
+frag.add_command(store_reembed)
+frag.add_command(store_compact)
+frag.add_command(store_gc)
+frag.add_command(store_export)
+frag.add_command(store_import)
+frag.add_command(store_publish)
+frag.add_command(embed_bench)
 
 
 main: Group = frag
@@ -0,0 +1,65 @@
+import click
+from rich.table import Table
+
+from frag.utils import console
+from frag.settings import Settings
+from frag.embeddings.store import EmbeddingStore
+
+
+def _megabytes(size: int) -> str:
+    return f"{size / 2**20:.1f} MB"
+
+
+def compact_store(
+    collection: str | None, batch_size: int, samples: int, drop_old: bool
+) -> None:
+    """
+    Rebuild a collection and vacuum the store's databases, reporting the gains.
+
+    Args:
+        collection (str, optional): The collection to compact; defaults to the default one.
+        batch_size (int): Records copied at a time.
+        samples (int): Queries timed before and after.
+        drop_old (bool): Delete the old collection right away, rather than on the next
+            compaction or garbage collection.
+    """
+    from frag.embeddings.compact import CompactJob, CompactionReport
+
+    settings: Settings = Settings.from_path()
+    store: EmbeddingStore = EmbeddingStore.instance or EmbeddingStore.create(
+        settings.embeds
+    )
+    report: CompactionReport = CompactJob(
+        store,
+        collection_name=collection,
+        batch_size=batch_size,
+        samples=samples,
+        drop_old=drop_old,
+    ).run()
+
+    table = Table(title=f"{report.collection}: {report.records} records")
+    table.add_column("")
+    table.add_column("before", justify="right")
+    table.add_column("after", justify="right")
+    table.add_row(
+        "store size", _megabytes(report.size_before), _megabytes(report.size_after)
+    )
+    table.add_row("query p50", f"{report.p50_before:.2f} ms", f"{report.p50_after:.2f} ms")
+    table.add_row("query p95", f"{report.p95_before:.2f} ms", f"{report.p95_after:.2f} ms")
+    console.print(table)
+    if report.retired:
+        console.print(
+            f"{report.retired} is kept for readers still using it: the next store:compact or "
+            "store:gc deletes it, or pass --drop-old"
+        )
+
+
+@click.command("store:compact")
+@click.option("--collection", "-c", default=None, type=str)
+@click.option("--batch-size", "-b", default=1000, type=int)
+@click.option("--samples", "-s", default=50, type=int, help="Queries timed before and after")
+@click.option("--drop-old", is_flag=True, default=False)
+def main(collection: str | None, batch_size: int, samples: int, drop_old: bool) -> None:
+    compact_store(
+        collection=collection, batch_size=batch_size, samples=samples, drop_old=drop_old
+    )
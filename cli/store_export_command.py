@@ -0,0 +1,46 @@
+import click
+from pathlib import Path
+from typing import Dict
+
+from frag.utils import console
+from frag.settings import Settings
+from frag.embeddings.store import EmbeddingStore
+
+
+def export_store(path: str, collection: str | None, base: str | None) -> None:
+    """
+    Export a collection to a snapshot directory.
+
+    Args:
+        path (str): The snapshot directory, replaced if it exists.
+        collection (str, optional): The collection to export; defaults to the default one.
+        base (str, optional): A previous snapshot of the collection: its segment count is
+            kept, so that unchanged segments keep their checksums.
+    """
+    from frag.embeddings.snapshot import Manifest, export_snapshot, read_manifest
+
+    settings: Settings = Settings.from_path()
+    store: EmbeddingStore = EmbeddingStore.instance or EmbeddingStore.create(
+        settings.embeds
+    )
+    # read first: the base may be the snapshot being replaced
+    previous: Dict[str, str] = (
+        {s.name: s.checksum for s in read_manifest(Path(base)).segments} if base else {}
+    )
+    manifest: Manifest = export_snapshot(
+        store,
+        Path(path),
+        collection_name=collection,
+        base=Path(base) if base else None,
+    )
+    if base:
+        changed: int = sum(previous.get(s.name) != s.checksum for s in manifest.segments)
+        console.log(f"{changed}/{len(manifest.segments)} segments changed since {base}")
+
+
+@click.command("store:export")
+@click.argument("path", type=str)
+@click.option("--collection", "-c", default=None, type=str)
+@click.option("--base", default=None, type=str, help="Previous snapshot, for incremental updates")
+def main(path: str, collection: str | None, base: str | None) -> None:
+    export_store(path=path, collection=collection, base=base)
@@ -0,0 +1,72 @@
+import click
+from rich.table import Table
+
+from frag.utils import console
+from frag.settings import Settings
+from frag.embeddings.store import EmbeddingStore
+
+
+def _megabytes(size: int) -> str:
+    return f"{size / 2**20:.1f} MB"
+
+
+def gc_store(collection: str | None, compact: bool, grace_minutes: float) -> None:
+    """
+    Delete the expired nodes of a collection, the orphaned entries of its indexes and the
+    records missing from them, reporting the space reclaimed.
+
+    Args:
+        collection (str, optional): The collection to collect; defaults to the default one.
+        compact (bool): Rebuild the collection afterwards, to reclaim the space its vector
+            index still holds.
+        grace_minutes (float): How long records must have been missing from the indexes, as
+            found by earlier collections, to be deleted; 0 deletes them right away.
+    """
+    from frag.embeddings.compact import CompactJob, CompactionReport
+    from frag.embeddings.lifecycle import GCReport, collect_garbage
+
+    settings: Settings = Settings.from_path()
+    store: EmbeddingStore = EmbeddingStore.instance or EmbeddingStore.create(
+        settings.embeds
+    )
+    report: GCReport = collect_garbage(
+        store, collection_name=collection, grace=grace_minutes * 60
+    )
+    size_after: int = report.size_after
+    deleted: int = report.expired + report.unindexed
+    if compact and (deleted or report.orphaned):
+        compaction: CompactionReport = CompactJob(
+            store, collection_name=report.collection
+        ).run()
+        size_after = compaction.size_after
+
+    table = Table(title=f"{report.collection}: {report.records} records left")
+    table.add_column("")
+    table.add_column("", justify="right")
+    table.add_row("expired nodes deleted", str(report.expired))
+    table.add_row("orphaned index entries dropped", str(report.orphaned))
+    table.add_row("unindexed records deleted", str(report.unindexed))
+    table.add_row("unindexed records kept until the grace period ends", str(report.pending))
+    table.add_row("store size before", _megabytes(report.size_before))
+    table.add_row("store size after", _megabytes(size_after))
+    table.add_row("reclaimed", _megabytes(max(0, report.size_before - size_after)))
+    console.print(table)
+    if deleted and not compact:
+        console.log(
+            "The vector index keeps deleted vectors: run `frag store:compact` to reclaim them"
+        )
+
+
+@click.command("store:gc")
+@click.option("--collection", "-c", default=None, type=str)
+@click.option(
+    "--compact", is_flag=True, default=False, help="Rebuild the collection afterwards"
+)
+@click.option(
+    "--grace-minutes",
+    default=60.0,
+    type=float,
+    help="Delete records missing from the indexes only once missing for this long",
+)
+def main(collection: str | None, compact: bool, grace_minutes: float) -> None:
+    gc_store(collection=collection, compact=compact, grace_minutes=grace_minutes)
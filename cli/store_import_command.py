@@ -0,0 +1,33 @@
+import click
+from pathlib import Path
+
+from frag.utils import console
+from frag.settings import Settings
+from frag.embeddings.store import EmbeddingStore
+
+
+def import_store(path: str, collection: str | None, force: bool) -> None:
+    """
+    Load a snapshot into a collection, skipping the segments already loaded.
+
+    Args:
+        path (str): The snapshot directory.
+        collection (str, optional): The collection to load into; defaults to the snapshot's.
+        force (bool): Import even if the snapshot was made with other embedding settings.
+    """
+    from frag.embeddings.snapshot import import_snapshot
+
+    settings: Settings = Settings.from_path()
+    store: EmbeddingStore = EmbeddingStore.instance or EmbeddingStore.create(
+        settings.embeds
+    )
+    written: int = import_snapshot(store, Path(path), collection_name=collection, force=force)
+    console.log(f"Imported {written} records into {store.collection_name}")
+
+
+@click.command("store:import")
+@click.argument("path", type=str)
+@click.option("--collection", "-c", default=None, type=str)
+@click.option("--force", is_flag=True, default=False, help="Ignore the settings fingerprint")
+def main(path: str, collection: str | None, force: bool) -> None:
+    import_store(path=path, collection=collection, force=force)
@@ -6,7 +6,7 @@ from frag.settings import Settings
 from frag.embeddings.store import EmbeddingStore
 
 
-def init_store(items: Tuple[str]) -> None:
+def init_store(items: Tuple[str], workers: int = 1, job: str | None = None) -> None:
     # Load settings
     settings: Settings = Settings.from_path()
     console.log(f"Settings: {settings.model_dump()}")
@@ -31,16 +31,32 @@ def init_store(items: Tuple[str]) -> None:
     console.log(f"Paths: {paths}")
     console.log(f"Embedding store: {store}")
 
+    if workers > 1:
+        from frag.embeddings.ingest.sharded import ShardedIngestor
+
+        ShardedIngestor(store=store, workers=workers, job=job).ingest([*urls, *paths])
+        return
+
     if len(urls) > 0:
         from frag.embeddings.ingest.ingest_url import URLIngestor
 
         ingestor = URLIngestor(store=store)
         ingestor.ingest(urls)
 
+    from frag.embeddings.ingest.streaming import StreamIngestor, is_streamable
+
+    streamable: List[str] = [path for path in paths if is_streamable(path)]
+    if len(streamable) > 0:
+        StreamIngestor(store=store).ingest(streamable)
+
     # Further processing can be added here to handle URLs and paths with the store
 
 
 @click.command("init:store")
 @click.argument("items", nargs=-1, type=str)
-def main(items: Tuple[str]) -> None:
-    init_store(items=items)
+@click.option(
+    "--workers", "-w", default=1, type=int, help="Ingest across this many processes"
+)
+@click.option("--job", "-j", default=None, type=str, help="Name of a resumable job")
+def main(items: Tuple[str], workers: int, job: str | None) -> None:
+    init_store(items=items, workers=workers, job=job)
@@ -0,0 +1,56 @@
+import click
+import shutil
+from pathlib import Path
+
+from frag.settings import Settings
+from frag.embeddings.store import EmbeddingStore
+
+
+def publish_store(collection: str | None, snapshot: str | None, keep: int) -> None:
+    """
+    Publish a snapshot of a collection to the read-only stores.
+
+    Args:
+        collection (str, optional): The collection; defaults to the default one.
+        snapshot (str, optional): A snapshot made with `frag store:export`; by default, the
+            collection is exported from this store.
+        keep (int): Snapshots kept in the serving directory, the published one included.
+    """
+    from frag.embeddings.serving import publish, serving_dir
+    from frag.embeddings.snapshot import export_snapshot
+
+    settings: Settings = Settings.from_path()
+    name: str = collection or settings.embeds.default_collection
+    if snapshot is not None:
+        publish(settings.embeds.path, name, Path(snapshot), keep=keep)
+        return
+    if settings.embeds.read_only:
+        raise click.UsageError("A read-only store cannot export: pass a snapshot to publish")
+
+    store: EmbeddingStore = EmbeddingStore.instance or EmbeddingStore.create(
+        settings.embeds
+    )
+    directory: Path = serving_dir(settings.embeds.path, name)
+    current: Path = directory / "CURRENT"
+    export: Path = directory / "export"
+    export_snapshot(
+        store,
+        export,
+        collection_name=name,
+        # keep the segment count of the published snapshot
+        base=directory / current.read_text(encoding="utf-8").strip()
+        if current.exists()
+        else None,
+    )
+    try:
+        publish(settings.embeds.path, name, export, keep=keep)
+    finally:
+        shutil.rmtree(export, ignore_errors=True)
+
+
+@click.command("store:publish")
+@click.option("--collection", "-c", default=None, type=str)
+@click.option("--snapshot", "-s", default=None, type=str, help="Snapshot to publish")
+@click.option("--keep", "-k", default=2, type=int, help="Snapshots kept")
+def main(collection: str | None, snapshot: str | None, keep: int) -> None:
+    publish_store(collection=collection, snapshot=snapshot, keep=keep)
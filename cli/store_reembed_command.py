@@ -0,0 +1,36 @@
+import click
+from frag.utils import console
+from frag.settings import Settings
+from frag.embeddings.store import EmbeddingStore
+
+
+def reembed_store(collection: str | None, batch_size: int, drop_old: bool) -> None:
+    """
+    Re-embed a collection with the embedding model in the settings.
+
+    Args:
+        collection (str, optional): The collection to migrate; defaults to the default one.
+        batch_size (int): Records embedded and checkpointed at a time.
+        drop_old (bool): Delete the old collection once reads are switched over.
+    """
+    from frag.embeddings.reembed import ReembedJob
+
+    settings: Settings = Settings.from_path()
+    store: EmbeddingStore = EmbeddingStore.instance or EmbeddingStore.create(
+        settings.embeds
+    )
+    console.log(
+        f"Re-embedding {collection or store.collection_name} "
+        f"with {settings.embeds.api_model}"
+    )
+    ReembedJob(
+        store, collection_name=collection, batch_size=batch_size, drop_old=drop_old
+    ).run()
+
+
+@click.command("store:reembed")
+@click.option("--collection", "-c", default=None, type=str)
+@click.option("--batch-size", "-b", default=256, type=int)
+@click.option("--drop-old", is_flag=True, default=False)
+def main(collection: str | None, batch_size: int, drop_old: bool) -> None:
+    reembed_store(collection=collection, batch_size=batch_size, drop_old=drop_old)
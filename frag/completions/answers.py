@@ -0,0 +1,40 @@
+"""
+Cache of whole answers to stateless questions.
+
+A turn made of a single user message, with no history, depends only on the question, the
+collection and the bots. `AnswerCache` keeps the answers to such turns, with the notes they
+were written from, and serves them to questions whose embedding is close enough, skipping both
+the archivists and the interface bot.
+
+Entries are scoped by the bots' fingerprints (templates, models and settings) and by the
+collection, and stamped with the collection's version: ingesting into it invalidates them.
+"""
+
+from typing import List
+
+from pydantic import BaseModel, Field
+
+from frag.embeddings.retrieval_cache import SemanticCache
+from frag.typedefs import Note
+
+
+class CachedAnswer(BaseModel):
+    """
+    An answer, and the notes it was written from.
+    """
+
+    answer: str
+    notes: List[Note] = Field(default_factory=list)
+
+
+class AnswerCache(SemanticCache[CachedAnswer]):
+    """
+    A thread-safe, size-bounded LRU cache of answers, looked up by question similarity.
+
+    :param max_size: Maximum number of cached answers.
+    :param threshold: Minimum cosine similarity between two questions' embeddings for one to
+        reuse the other's answer; higher than for retrieval, since the answer is reused whole.
+    """
+
+    def __init__(self, max_size: int = 256, threshold: float = 0.97) -> None:
+        super().__init__(max_size=max_size, threshold=threshold)
@@ -1,16 +1,38 @@
 """
 Base API client, from which both the prompter and the summariser inherit.
+
+Prompts are laid out according to the `prompt_layout` bot setting:
+- `inline`: every template is rendered with every variable of the turn;
+- `stable`: the prompt starts with a prefix that stays byte-identical from one call to the
+  next, so that the provider's prompt cache serves it, and ends with what changes; see
+  `_prefix`.
 """
 
+import hashlib
 import os
-from typing import List, Dict, Any, Literal
+from typing import Callable, Iterator, List, Dict, Any, Literal
 
 import jinja2
-from litellm.main import ModelResponse, completion
+from litellm import token_counter
+from litellm.main import ModelResponse
 
 from frag.typedefs import MessageParam, Role, SystemMessage, UserMessage
 from frag.settings import BotModelSettings
-from frag.utils.console import error_console
+from frag.utils.console import console, error_console
+from .hedging import Hedger
+from .prompt_cache import PromptCacheReport, SegmentCache, cached_tokens, mark_breakpoint
+from .scheduler import LLMScheduler
+from .transport import get_transport
+
+
+def _close_stream(response: Any) -> None:
+    """
+    Cancels a streamed completion: litellm wraps the provider stream, and closing it drops
+    the connection.
+    """
+    stream = getattr(response, "completion_stream", None)
+    if stream is not None and hasattr(stream, "close"):
+        stream.close()
 
 
 class BaseBot:
@@ -22,8 +44,10 @@ class BaseBot:
     client_type: Literal["interface", "summarizer"] | None = None
     system_template: jinja2.Template
     user_template: jinja2.Template
+    context_template: jinja2.Template | None = None
     messages: List[MessageParam]
     responder: str
+    priority: int = 1  # for the LLM scheduler, lower goes first
 
     def __init__(self, settings: BotModelSettings, template_dir: str) -> None:
         """
@@ -37,6 +61,14 @@ class BaseBot:
         if self.client_type is None:
             raise ValueError("client_type must be provided")
         self.settings: BotModelSettings = settings
+        self.scheduler: LLMScheduler = LLMScheduler.shared()
+        self.scheduler.configure(settings.api, rpm=settings.rpm, tpm=settings.tpm)
+        self.hedger: Hedger | None = None
+        if settings.hedge_percentile is not None:
+            self.hedger = Hedger(settings.hedge_percentile, settings.hedge_budget)
+            if settings.hedge_model:
+                self.scheduler.configure(settings.hedge_model, rpm=settings.rpm, tpm=settings.tpm)
+        self.prompt_cache: PromptCacheReport = PromptCacheReport()
         self.load_templates(template_dir)
 
     def run(
@@ -52,17 +84,140 @@ class BaseBot:
                 msg for msg in self._render(messages, **kwargs)
             ]
 
-            return ModelResponse(
-                completion(
-                    model=self.settings.api,
-                    messages=rendered_messages,
-                    **self.settings.completion_kwargs,
-                )
-            )
+            return self._complete(rendered_messages)
         except Exception as e:
             error_console.log(f"Error during completion: {e}")
             raise
 
+    def _complete(
+        self, rendered_messages: List[MessageParam], **kwargs: Any
+    ) -> ModelResponse:
+        """
+        Sends already rendered messages to the LLM model. All the bots' calls go through here.
+
+        :param rendered_messages: The messages to send.
+        :param kwargs: Extra completion parameters, overriding the bot settings.
+        """
+        return self._hedged(
+            lambda model: self._call(model, rendered_messages, **kwargs),
+            valid=lambda response: bool(response.choices),
+        )
+
+    def _call(
+        self,
+        model: str,
+        rendered_messages: List[MessageParam],
+        estimate: int | None = None,
+        **kwargs: Any,
+    ) -> Any:
+        """
+        Runs a single completion through the scheduler and the current transport.
+
+        :param estimate: The tokens the call is expected to use, see `_estimate_tokens`;
+            streams settle it once their last chunk reports the actual usage.
+        """
+        if estimate is None:
+            estimate = self._estimate_tokens(rendered_messages)
+        if kwargs.get("stream"):
+            # OpenAI only reports the usage of a stream, with its last chunk, on request
+            kwargs = {"stream_options": {"include_usage": True}, **kwargs}
+        response = self.scheduler.call(
+            model,
+            lambda: get_transport().complete(
+                model=model,
+                messages=rendered_messages,
+                **{**self.settings.completion_kwargs, **kwargs},
+            ),
+            priority=self.priority,
+            tokens=estimate,
+            retries=self.settings.retries,
+        )
+        if not kwargs.get("stream") and (usage := getattr(response, "usage", None)):
+            self.scheduler.settle(model, estimate, usage.total_tokens)
+            self._report_usage(model, usage)
+        return response
+
+    def _report_usage(self, model: str, usage: Any) -> None:
+        """
+        Accounts for the prompt tokens of a call served from the provider's cache.
+        """
+        prompt_tokens: int = int(getattr(usage, "prompt_tokens", 0) or 0)
+        cached: int = cached_tokens(usage)
+        self.prompt_cache.add(prompt_tokens, cached)
+        console.log(
+            f"{self.client_type} bot, {model}: {prompt_tokens} prompt tokens, "
+            f"{cached / prompt_tokens if prompt_tokens else 0:.0%} cached"
+        )
+
+    def _hedged(
+        self,
+        call: Callable[[str], Any],
+        valid: Callable[[Any], bool] = lambda _: True,
+        discard: Callable[[Any], None] = lambda _: None,
+    ) -> Any:
+        """
+        Runs a call on the bot's model, hedging it on the hedge model if it is slow.
+
+        :param call: Takes the model name and performs the call.
+        """
+        if self.hedger is None:
+            return call(self.settings.api)
+        hedge_model: str = self.settings.hedge_model or self.settings.api
+        return self.hedger.run(
+            lambda: call(self.settings.api),
+            lambda: call(hedge_model),
+            valid=valid,
+            discard=discard,
+        )
+
+    def _estimate_tokens(self, rendered_messages: List[MessageParam]) -> int:
+        """
+        Estimates the tokens a call will use, for the tokens per minute limit.
+        """
+        if self.settings.tpm is None:
+            return 0
+        return token_counter(
+            model=self.settings.api, messages=rendered_messages
+        ) + int(self.settings.completion_kwargs.get("max_tokens", 0))
+
+    def _stream(
+        self, rendered_messages: List[MessageParam], **kwargs: Any
+    ) -> Iterator[str]:
+        """
+        Streams the completion of already rendered messages, yielding the text deltas.
+
+        Closing the generator (or leaving a loop over it early) cancels the request, so that
+        no more output tokens are generated.
+
+        :param rendered_messages: The messages to send.
+        :param kwargs: Extra completion parameters, overriding the bot settings.
+        """
+        estimate: int = self._estimate_tokens(rendered_messages)
+        # with the model of each call, to report the usage of whichever served it
+        model, response = self._hedged(
+            lambda model: (
+                model,
+                self._call(model, rendered_messages, estimate, **{**kwargs, "stream": True}),
+            ),
+            discard=lambda served: _close_stream(served[1]),
+        )
+        usage: Any = None
+        try:
+            for chunk in response:
+                # sent with the last chunk, by the providers which report it when streaming
+                usage = getattr(chunk, "usage", None) or usage
+                delta: str | None = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    yield delta
+        finally:
+            _close_stream(response)
+            if usage is not None:
+                self.scheduler.settle(model, estimate, usage.total_tokens)
+                self._report_usage(model, usage)
+            else:
+                # closed before the last chunk
+                self.prompt_cache.unreported += 1
+
     def _render(
         self, messages: List[MessageParam], **kwargs: Dict[str, Any]
     ) -> List[MessageParam]:
@@ -92,13 +247,24 @@ class BaseBot:
                 "r",
                 encoding="utf-8",
             ) as file:
-                self.system_template = jinja2.Template(file.read())
+                system_source: str = file.read()
+                self.system_template = jinja2.Template(system_source)
             with open(
                 os.path.join(template_dir, f"{self.client_type}.user.html"),
                 "r",
                 encoding="utf-8",
             ) as file:
-                self.user_template = jinja2.Template(file.read())
+                user_source: str = file.read()
+                self.user_template = jinja2.Template(user_source)
+            self.template_sources: List[str] = [system_source, user_source]
+            context_path: str = os.path.join(template_dir, f"{self.client_type}.context.html")
+            self.context_template = None
+            if os.path.exists(context_path):
+                with open(context_path, "r", encoding="utf-8") as file:
+                    context_source: str = file.read()
+                    self.context_template = jinja2.Template(context_source)
+                self.template_sources.append(context_source)
+            self.segments: SegmentCache = SegmentCache()
         except FileNotFoundError as e:
             error_console.log("Template file not found: %s", e)
             raise e
@@ -106,6 +272,17 @@ class BaseBot:
             error_console.log("Error loading templates: %s", e)
             raise e
 
+    @property
+    def fingerprint(self) -> str:
+        """
+        Identifies what the bot's answers depend on besides its input: its templates, model
+        and completion settings.
+        """
+        digest = hashlib.sha256(self.settings.model_dump_json().encode("utf-8"))
+        for source in self.template_sources:
+            digest.update(source.encode("utf-8"))
+        return digest.hexdigest()
+
     def _render_message(
         self, latest_messages: List[MessageParam], role: Role, **kwargs: Dict[str, Any]
     ) -> MessageParam:
@@ -116,19 +293,65 @@ class BaseBot:
         :param role: Role of the message to be rendered (SYSTEM or USER).
         :return: Rendered ChatCompletionMessage object.
         """
-        if role == SystemMessage:
+        layout: str = self.settings.prompt_layout
+        if role == "system":
             return SystemMessage(
                 content=self.system_template.render(
-                    latest_messages=latest_messages, **kwargs
+                    latest_messages=latest_messages, layout=layout, **kwargs
                 ),
                 role="system",
             )
-        elif role == UserMessage:
+        elif role == "user":
             return UserMessage(
                 content=self.user_template.render(
-                    latest_messages=latest_messages, **kwargs
+                    latest_messages=latest_messages, layout=layout, **kwargs
                 ),
                 role="user",
             )
         else:
             raise ValueError("MessageType must be SystemMessage or UserMessage")
+
+    def _segment(self, name: str, template: jinja2.Template, **variables: Any) -> str:
+        """
+        Renders a template, memoised by a hash of its variables.
+        """
+        key: str = SegmentCache.key(name, variables)
+        segment: str | None = self.segments.get(key)
+        if segment is None:
+            segment = template.render(layout=self.settings.prompt_layout, **variables)
+            self.segments.put(key, segment)
+        return segment
+
+    def _prefix(
+        self,
+        latest_messages: List[MessageParam],
+        history: List[MessageParam] | None = None,
+    ) -> List[MessageParam]:
+        """
+        The stable prefix of a prompt, in the `stable` layout: the system message, rendered
+        without any per-turn variable; then, if the bot has a `<client_type>.context.html`
+        template, the conversation as it renders it; then the history messages, as they are.
+        The rest of the prompt follows it.
+
+        With the `prompt_cache_marker` setting, its last message is marked as a cache
+        breakpoint, for the providers which only cache on request.
+
+        :param latest_messages: The conversation so far, for the context template.
+        :param history: Messages sent as they are.
+        """
+        prefix: List[MessageParam] = [
+            SystemMessage(content=self._segment("system", self.system_template), role="system")
+        ]
+        if self.context_template is not None and latest_messages:
+            prefix.append(
+                UserMessage(
+                    content=self._segment(
+                        "context", self.context_template, latest_messages=latest_messages
+                    ),
+                    role="user",
+                )
+            )
+        prefix.extend(history or [])
+        if self.settings.prompt_cache_marker:
+            prefix[-1] = mark_breakpoint(prefix[-1])
+        return prefix
@@ -0,0 +1,137 @@
+"""
+Hedged LLM calls.
+
+When a call takes longer than a given percentile of the recent latencies for its bot, a
+duplicate is sent (to the same model, or to a fallback one), and whichever valid answer comes
+first is used; the loser is discarded. Hedges are capped to a share of all calls, so that they
+stay cheap.
+
+Configured per bot, with `hedge_percentile`, `hedge_model` and `hedge_budget` in the bot
+settings.
+"""
+
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from threading import Lock
+from typing import Callable, Deque, Generic, List, Set, TypeVar
+
+from frag.utils.console import console
+
+T = TypeVar("T")
+
+_executor: ThreadPoolExecutor = ThreadPoolExecutor(
+    max_workers=64, thread_name_prefix="hedge"
+)
+
+
+class LatencyTracker:
+    """
+    Keeps the latencies of the most recent calls.
+    """
+
+    def __init__(self, size: int = 500) -> None:
+        self._latencies: Deque[float] = deque(maxlen=size)
+        self._lock: Lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._latencies)
+
+    def add(self, latency: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, p: float) -> float:
+        """
+        Returns the p-th percentile (0 < p < 1) of the recorded latencies.
+        """
+        with self._lock:
+            latencies: List[float] = sorted(self._latencies)
+        if not latencies:
+            return float("inf")
+        return latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+
+
+class Hedger(Generic[T]):
+    """
+    Runs calls, hedging the slow ones.
+
+    :param percentile: Latency percentile after which a call is hedged.
+    :param budget: Maximum share of calls that can be hedged.
+    :param min_samples: Latencies to record before hedging starts.
+    """
+
+    def __init__(self, percentile: float, budget: float, min_samples: int = 20) -> None:
+        self.percentile: float = percentile
+        self.budget: float = budget
+        self.min_samples: int = min_samples
+        self.latencies: LatencyTracker = LatencyTracker()
+        self.calls: int = 0
+        self.hedges: int = 0
+        self.hedge_wins: int = 0
+        self._lock: Lock = Lock()
+
+    def _may_hedge(self) -> bool:
+        with self._lock:
+            if self.hedges + 1 > self.budget * self.calls:
+                return False
+            self.hedges += 1
+            return True
+
+    def run(
+        self,
+        primary: Callable[[], T],
+        hedge: Callable[[], T],
+        valid: Callable[[T], bool] = lambda _: True,
+        discard: Callable[[T], None] = lambda _: None,
+    ) -> T:
+        """
+        Runs `primary`, and `hedge` too if `primary` is slow.
+
+        :param primary: The call.
+        :param hedge: The duplicate call.
+        :param valid: Whether a result is usable; an invalid result waits for the other call.
+        :param discard: Disposes of the loser's result, e.g. closes a stream.
+        :return: The first valid result.
+        """
+        with self._lock:
+            self.calls += 1
+        started: Future[T] = _executor.submit(self._timed, primary)
+
+        threshold: float | None = None
+        if len(self.latencies) >= self.min_samples:
+            threshold = self.latencies.percentile(self.percentile)
+        done, _ = wait([started], timeout=threshold)
+        if done or not self._may_hedge():
+            return started.result()
+
+        console.log(f"Hedging a call slower than {threshold:.2f}s")
+        hedged: Future[T] = _executor.submit(hedge)
+        pending: Set[Future[T]] = {started, hedged}
+        errors: List[BaseException] = []
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if (error := future.exception()) is not None:
+                    errors.append(error)
+                    continue
+                result: T = future.result()
+                if not valid(result):
+                    discard(result)
+                    continue
+                if future is hedged:
+                    with self._lock:
+                        self.hedge_wins += 1
+                for loser in (pending | done) - {future}:
+                    if not loser.cancel():
+                        loser.add_done_callback(
+                            lambda f: discard(f.result()) if not f.exception() else None
+                        )
+                return result
+        raise errors[0] if errors else ValueError("No valid answer from hedged calls")
+
+    def _timed(self, fn: Callable[[], T]) -> T:
+        started: float = time.monotonic()
+        result: T = fn()
+        self.latencies.add(time.monotonic() - started)
+        return result
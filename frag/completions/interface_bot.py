@@ -9,7 +9,7 @@ To personalise the template, extract (`frag template extract`) and modify them f
 from typing import List
 
 import jinja2
-from litellm import completion, ModelResponse
+from litellm import ModelResponse
 
 from frag.typedefs import MessageParam, Note
 from frag.settings import BotModelSettings
@@ -26,6 +26,7 @@ class InterfaceBot(BaseBot):
     """
 
     client_type = "interface"
+    priority = 0  # the user is waiting on it: goes before the archivists
     settings: BotModelSettings
     system_template: jinja2.Template
     user_template: jinja2.Template
@@ -37,15 +38,7 @@ class InterfaceBot(BaseBot):
         try:
             rendered_messages: List[MessageParam] = self._render(messages, notes=notes)
 
-            result = ModelResponse(
-                completion(
-                    messages=rendered_messages,
-                    model=self.settings.api,
-                    stream=False,
-                    **self.settings.model_dump(exclude=set(["llm"])),
-                )
-            )
-            return result
+            return self._complete(rendered_messages, stream=False)
         except jinja2.TemplateError as te:
             error_console.log("Template rendering error: %s", te)
             raise
@@ -58,11 +51,25 @@ class InterfaceBot(BaseBot):
     ) -> List[MessageParam]:
         try:
             last_message = messages[-1]
+            if self.settings.prompt_layout == "stable":
+                # the notes and the question come last, after the unchanged history
+                return [
+                    *self._prefix([], history=messages[:-1]),
+                    self._render_message(
+                        messages[:-1],
+                        role="user",
+                        content=last_message.get("content"),
+                        **kwargs,
+                    ),
+                ]
             return [
-                self._render_message(messages=messages[:-1], role="system", **kwargs),
+                self._render_message(messages[:-1], role="system", **kwargs),
                 *messages[:-1],
                 self._render_message(
-                    messages=last_message.get("content"), role="user", **kwargs
+                    messages[:-1],
+                    role="user",
+                    content=last_message.get("content"),
+                    **kwargs,
                 ),
             ]
         except IndexError as ie:
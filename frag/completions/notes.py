@@ -0,0 +1,154 @@
+"""
+Parsing of the summarizer's XML verdicts into `Note`s.
+
+A verdict looks like:
+
+```xml
+<relevant>true</relevant>
+<complete>false</complete>
+<summary>The summary of the relevant parts</summary>
+```
+
+In batched mode, each verdict is wrapped in `<verdict id="...">...</verdict>`, where the id is
+the position of the document in the prompt.
+
+`VerdictStreamParser` reads a single verdict while it is being streamed, so that the stream can
+be cancelled as soon as the document is judged irrelevant.
+"""
+
+import re
+from typing import Dict, List, Sequence
+
+from llama_index.core.schema import Document
+
+from frag.typedefs import Note
+
+_VERDICT_RE: re.Pattern[str] = re.compile(
+    r"<verdict\s+id=[\"']?([^\"'>\s]+)[\"']?\s*>(.*?)</verdict>", re.DOTALL
+)
+_RELEVANT_RE: re.Pattern[str] = re.compile(r"<relevant>\s*([A-Za-z])")
+_SUMMARY_RE: re.Pattern[str] = re.compile(r"<summary>(.*?)(</summary>|$)", re.DOTALL)
+
+
+def tag(text: str, name: str) -> str | None:
+    """
+    Returns the content of the first `<name>` element in the text, if any.
+    """
+    match: re.Match[str] | None = re.search(
+        rf"<{name}>(.*?)</{name}>", text, re.DOTALL
+    )
+    return match.group(1).strip() if match else None
+
+
+def is_true(value: str | None) -> bool:
+    """
+    Whether a tag's content reads as true.
+    """
+    return value is not None and value.strip().lower() == "true"
+
+
+def make_note(document: Document, summary: str, complete: bool) -> Note:
+    """
+    Builds a note pointing to the given document.
+    """
+    return Note(
+        id=document.doc_id,
+        source=str(document.metadata.get("url") or ""),
+        title=str(document.metadata.get("title") or ""),
+        summary=summary,
+        complete=complete,
+    )
+
+
+def parse_verdict(text: str, document: Document) -> Note | None:
+    """
+    Parses a single verdict.
+
+    Returns:
+        Note | None: The note, or None if the document was judged irrelevant.
+    """
+    if not is_true(tag(text, "relevant")):
+        return None
+    summary: str | None = tag(text, "summary")
+    if not summary:
+        return None
+    return make_note(document, summary, is_true(tag(text, "complete")))
+
+
+def parse_batch(text: str, documents: Sequence[Document]) -> List[Note]:
+    """
+    Parses a batched summarizer answer, one verdict per document.
+
+    Args:
+        text (str): The summarizer output.
+        documents (Sequence[Document]): The documents, in the order they were given in the
+            prompt; verdict ids are their 1-based positions.
+
+    Returns:
+        List[Note]: The notes for the relevant documents. Documents without a verdict are
+            treated as irrelevant.
+    """
+    by_id: Dict[str, Document] = {str(i + 1): doc for i, doc in enumerate(documents)}
+    notes: List[Note] = []
+    for verdict_id, body in _VERDICT_RE.findall(text):
+        document: Document | None = by_id.pop(verdict_id, None)
+        if document is None:
+            continue
+        if (note := parse_verdict(body, document)) is not None:
+            notes.append(note)
+    return notes
+
+
+class VerdictStreamParser:
+    """
+    Incremental parser for a single streamed verdict.
+
+    Feed it the stream's text deltas; `feed` returns False once the verdict is known to be
+    irrelevant, at which point the stream can be cancelled.
+    """
+
+    def __init__(self, document: Document) -> None:
+        self.document: Document = document
+        self.buffer: str = ""
+        self.relevant: bool | None = None
+
+    def feed(self, delta: str) -> bool:
+        """
+        Adds a chunk of streamed text.
+
+        Returns:
+            bool: Whether the rest of the stream is still needed.
+        """
+        self.buffer += delta
+        if self.relevant is None:
+            # the first letter of the verdict is enough to tell true from false
+            match: re.Match[str] | None = _RELEVANT_RE.search(self.buffer)
+            if match is not None:
+                self.relevant = match.group(1).lower() == "t"
+        return self.relevant is not False
+
+    @property
+    def summary(self) -> str | None:
+        """
+        The summary streamed so far, if it has started.
+        """
+        match: re.Match[str] | None = _SUMMARY_RE.search(self.buffer)
+        return match.group(1) if match else None
+
+    @property
+    def done(self) -> bool:
+        """
+        Whether the verdict is final: irrelevant, or relevant with a closed summary.
+        """
+        return self.relevant is False or "</summary>" in self.buffer
+
+    @property
+    def note(self) -> Note | None:
+        """
+        The note built so far; while the summary is streaming, it holds the partial text.
+        """
+        if not self.relevant or not (summary := self.summary):
+            return None
+        return make_note(
+            self.document, summary.strip(), is_true(tag(self.buffer, "complete"))
+        )
@@ -0,0 +1,125 @@
+"""
+Support for the providers' prompt caches.
+
+Providers cache the longest prefix a prompt shares with recent ones, and bill its tokens at a
+discount. Only a byte-identical prefix hits: in the `stable` prompt layout (the `prompt_layout`
+bot setting), the bots keep what does not change from one call to the next (the system prompt,
+then the conversation so far) at the start of the prompt, and what does (notes, documents, the
+latest question) at the end. See `BaseBot._prefix`.
+
+- `SegmentCache` memoises the rendered prefix segments, by a hash of their inputs;
+- `mark_breakpoint` marks the end of the prefix, for providers which only cache on request
+  (Anthropic);
+- `PromptCacheReport` accounts for the share of prompt tokens the provider served from its
+  cache, as reported in the responses' usage.
+"""
+
+import hashlib
+import json
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, List
+
+from pydantic import BaseModel
+
+from frag.typedefs import MessageParam
+
+
+class SegmentCache:
+    """
+    A thread-safe, size-bounded LRU cache of rendered template segments.
+
+    :param max_size: Segments kept.
+    """
+
+    def __init__(self, max_size: int = 256) -> None:
+        self.max_size: int = max_size
+        self.hits: int = 0
+        self.misses: int = 0
+        self._segments: OrderedDict[str, str] = OrderedDict()
+        self._lock: Lock = Lock()
+
+    @staticmethod
+    def key(name: str, variables: Dict[str, Any]) -> str:
+        return hashlib.sha256(
+            json.dumps([name, variables], sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            segment: str | None = self._segments.get(key)
+            if segment is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._segments.move_to_end(key)
+            return segment
+
+    def put(self, key: str, segment: str) -> None:
+        with self._lock:
+            self._segments[key] = segment
+            self._segments.move_to_end(key)
+            while len(self._segments) > self.max_size:
+                self._segments.popitem(last=False)
+
+
+def mark_breakpoint(message: MessageParam) -> MessageParam:
+    """
+    Returns a copy of a message marked as the end of a prefix to cache, as litellm passes it
+    to the providers which need it.
+    """
+    content: Any = message.get("content")
+    blocks: List[Dict[str, Any]] = (
+        [dict(block) for block in content]
+        if isinstance(content, list)
+        else [{"type": "text", "text": str(content or "")}]
+    )
+    if blocks:
+        blocks[-1]["cache_control"] = {"type": "ephemeral"}
+    return {**message, "content": blocks}  # type: ignore[return-value]
+
+
+def _field(value: Any, name: str) -> Any:
+    if value is None:
+        return None
+    if isinstance(value, dict):
+        return value.get(name)
+    return getattr(value, name, None)
+
+
+def cached_tokens(usage: Any) -> int:
+    """
+    The prompt tokens of a response's usage served from the provider's cache: OpenAI reports
+    them in `prompt_tokens_details`, Anthropic as `cache_read_input_tokens`.
+    """
+    cached: Any = _field(_field(usage, "prompt_tokens_details"), "cached_tokens")
+    if cached is None:
+        cached = _field(usage, "cache_read_input_tokens")
+    return int(cached or 0)
+
+
+class PromptCacheReport(BaseModel):
+    """
+    Prompt tokens sent, and served from the provider's cache, over a bot's calls; streamed
+    calls closed before their usage came are only counted as unreported.
+    """
+
+    calls: int = 0
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    unreported: int = 0
+
+    @property
+    def share(self) -> float:
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+    def add(self, prompt_tokens: int, cached_tokens: int) -> None:
+        self.calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.cached_tokens += cached_tokens
+
+    def __str__(self) -> str:
+        return (
+            f"{self.calls} calls, {self.prompt_tokens} prompt tokens, "
+            f"{self.share:.0%} cached, {self.unreported} calls without usage"
+        )
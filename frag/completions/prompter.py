@@ -1,43 +1,323 @@
-from typing import List, Any
+"""
+The prompter runs a conversation turn: it retrieves fragments for the latest question, has the
+archivists (summarizer bots) turn them into notes, and passes the notes to the interface bot.
+
+Archivists run in parallel, launched in order of retrieval score. If a turn has a deadline,
+the interface bot is called with whichever notes are ready when it expires; the archivists still
+running are either cancelled, or left to finish. Their verdicts are stored in the verdict cache,
+for the same question, and in the conversation's working set, for follow-up questions that
+reuse it. The archivist pool is larger than a turn needs, so that stragglers do not hold up the
+next turn's archivists.
+
+With an answer cache, stateless turns (a single user message) similar enough to an earlier one
+get its answer back, without archivists nor interface call. With incremental retrieval, each
+conversation keeps a working set of documents, and follow-up questions close to the last one
+reuse it (see `working_set.py`). Conversations are identified by the caller, with an id from
+`Prompter.new_conversation`: working sets hold the documents retrieved for one user, and are
+never shared between conversations.
+"""
+
+import json
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from threading import Event
+from typing import Dict, List, Any, Literal, Tuple
+
 from litellm import Choices, ModelResponse
+from llama_index.core.schema import Document
+
+from frag.embeddings.store import EmbeddingStore
 from frag.settings import BotsSettings
-from frag.typedefs import MessageParam
+from frag.typedefs import MessageParam, Note
+from .answers import AnswerCache, CachedAnswer
 from .summarizer_bot import SummarizerBot
 from .interface_bot import InterfaceBot
-from frag.utils.console import error_console
+from .verdicts import VerdictCache, normalise_question
+from .working_set import WorkingSet, WorkingSets
+from frag.utils.console import console, error_console
+
+StragglerPolicy = Literal["cancel", "cache"]
 
 
 class Prompter:
     """
     Main handler of prompts and responses.
 
+    :param settings: The bots settings.
+    :param summarizer: The archivist bot.
+    :param interface: The interface bot.
+    :param store: The embedding store to retrieve fragments from; without it, the interface
+        bot answers without notes.
+    :param deadline: Default latency budget, in seconds, for retrieval and archivists.
+    :param stragglers: What to do with archivists still running at the deadline.
+    :param top_k: Number of fragments to retrieve per turn.
+    :param neighbours: Number of neighbouring chunks to add around each fragment.
+    :param answer_cache: Cache of answers to stateless turns; none by default.
+    :param incremental: Keep a working set of documents per conversation, and reuse it for
+        follow-up questions; only for turns given a conversation id.
+    :param novelty: Cosine distance from the question that last queried the store above which
+        a follow-up question queries it again.
+    :param workers: Archivist threads; twice `top_k` by default, leaving room for stragglers.
     """
 
     def __init__(
-        self, settings: BotsSettings, summarizer: SummarizerBot, interface: InterfaceBot
+        self,
+        settings: BotsSettings,
+        summarizer: SummarizerBot,
+        interface: InterfaceBot,
+        store: EmbeddingStore | None = None,
+        deadline: float | None = None,
+        stragglers: StragglerPolicy = "cache",
+        top_k: int = 5,
+        neighbours: int = 0,
+        answer_cache: AnswerCache | None = None,
+        incremental: bool = False,
+        novelty: float = 0.15,
+        workers: int | None = None,
     ) -> None:
         self.settings: BotsSettings = settings
         self.summarizer: SummarizerBot = summarizer
         self.interface: InterfaceBot = interface
+        self.store: EmbeddingStore | None = store
+        self.deadline: float | None = deadline
+        self.stragglers: StragglerPolicy = stragglers
+        self.top_k: int = top_k
+        self.neighbours: int = neighbours
+        self.verdicts: VerdictCache = VerdictCache()
+        self.answers: AnswerCache | None = answer_cache
+        self.working_sets: WorkingSets | None = (
+            WorkingSets(max_documents=top_k * 10) if incremental else None
+        )
+        self.novelty: float = novelty
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=workers or max(top_k, 1) * 2, thread_name_prefix="archivist"
+        )
 
-    def respond(self, messages: List[MessageParam], **kwargs: Any) -> str:
+    def respond(
+        self,
+        messages: List[MessageParam],
+        deadline: float | None = None,
+        conversation_id: str | None = None,
+        **kwargs: Any,
+    ) -> str:
         """
         Respond to a message history.
+
+        :param messages: The conversation, ending with the user's question.
+        :param deadline: Latency budget, in seconds, for retrieval and archivists; defaults to
+            the prompter's.
+        :param conversation_id: Identifies the conversation for incremental retrieval, see
+            `new_conversation`; without it, the turn retrieves afresh.
         """
         try:
+            cacheable: bool = (
+                self.answers is not None and self.store is not None and len(messages) == 1
+            )
+            embedding: List[float] | None = None
+            if cacheable:
+                raw: str = str(messages[-1].get("content") or "")
+                question: str = normalise_question(raw)
+                # the answer cache is keyed by the normalised question; retrieval by the raw one
+                key: List[float] = self.store.embed_model.get_query_embedding(question)
+                embedding = key if question == raw else None
+                scope: Tuple[str, ...] = self._answer_scope(**kwargs)
+                version: Any = self.store.version
+                cached: CachedAnswer | None = self.answers.get_exact(
+                    scope, version, question
+                ) or self.answers.get(scope, version, key)
+                if cached is not None:
+                    console.log("Answered from the answer cache")
+                    return cached.answer
+
+            notes, complete = self._gather(
+                messages,
+                deadline=deadline if deadline is not None else self.deadline,
+                embedding=embedding,
+                conversation_id=conversation_id,
+            )
             responses: List[Choices] = [
-                Choices(c) for c in self.interface.run(messages, **kwargs).choices
+                Choices(c)
+                for c in self.interface.run(messages, notes=notes, **kwargs).choices
             ]
+            answer: str = ""
             if responses and responses[0]:
-                return str(responses[0].get("content", ""))
-            return ""
+                answer = str(responses[0].get("content", ""))
+            # an answer written without every note is not worth keeping
+            if cacheable and complete and answer:
+                self.answers.put(
+                    scope, version, question, key, CachedAnswer(answer=answer, notes=notes)
+                )
+            return answer
         except Exception as e:
             error_console.log("Error in responding: %s", e)
             raise
 
+    @staticmethod
+    def new_conversation() -> str:
+        """
+        Returns a new conversation id, to pass to every turn of the conversation.
+        """
+        return uuid.uuid4().hex
+
     def summarise(self, messages: List[MessageParam], **kwargs: Any) -> ModelResponse:
         try:
             return self.summarizer.run(messages, **kwargs)
         except Exception as e:
             error_console.log("Error in summarising: %s", e)
             raise
+
+    def _answer_scope(self, **kwargs: Any) -> Tuple[str, ...]:
+        assert self.store is not None
+        return (
+            self.store.collection_name,
+            self.interface.fingerprint,
+            self.summarizer.fingerprint,
+            f"{self.top_k}:{self.neighbours}",
+            json.dumps(kwargs, sort_keys=True, default=str),
+        )
+
+    def gather_notes(
+        self, messages: List[MessageParam], deadline: float | None = None
+    ) -> List[Note]:
+        """
+        Retrieves fragments for the latest question and runs the archivists on them.
+
+        :param messages: The conversation, ending with the user's question.
+        :param deadline: Latency budget in seconds; None waits for every archivist.
+        :return: The notes ready by the deadline, in order of retrieval score.
+        """
+        return self._gather(messages, deadline=deadline)[0]
+
+    def _retrieve(
+        self,
+        question: str,
+        embedding: List[float] | None,
+        conversation_id: str | None,
+    ) -> Tuple[List[Document], WorkingSet | None, bool]:
+        """
+        Retrieves the documents for a question, from the conversation's working set if the
+        question is not novel enough to query the store.
+
+        :return: The documents, the working set, and whether it was reused.
+        """
+        assert self.store is not None
+        if self.working_sets is None or conversation_id is None:
+            documents: List[Document] = self.store.retrieve_documents(
+                question, top_k=self.top_k, neighbours=self.neighbours, embedding=embedding
+            )
+            return documents, None, False
+
+        working_set: WorkingSet = self.working_sets.get(conversation_id)
+        embedding = embedding or self.store.embed_model.get_query_embedding(question)
+        if (novelty := working_set.novelty(embedding)) < self.novelty:
+            console.log(f"Reusing the working set (novelty {novelty:.2f})")
+            return working_set.rank(embedding, self.top_k), working_set, True
+
+        documents = self.store.retrieve_documents(
+            question, top_k=self.top_k, neighbours=self.neighbours, embedding=embedding
+        )
+        node_ids: List[str] = [
+            node_id
+            for document in documents
+            if document.doc_id not in working_set.documents
+            for node_id in document.metadata.get("node_ids") or [document.doc_id]
+        ]
+        working_set.add(embedding, documents, self.store.get_embeddings(node_ids))
+        return documents, working_set, False
+
+    def _gather(
+        self,
+        messages: List[MessageParam],
+        deadline: float | None = None,
+        embedding: List[float] | None = None,
+        conversation_id: str | None = None,
+    ) -> Tuple[List[Note], bool]:
+        # also returns whether every archivist finished
+        if self.store is None or not messages:
+            return [], True
+        started: float = time.monotonic()
+        question: str = str(messages[-1].get("content") or "")
+        documents, working_set, reused = self._retrieve(
+            question, embedding, conversation_id
+        )
+
+        ready: Dict[str, Note | None] = {}
+        pending: List[Document] = []
+        for document in documents:
+            if self.verdicts.has(question, document.doc_id):
+                ready[document.doc_id] = self.verdicts.get(question, document.doc_id)
+            elif reused and document.doc_id in working_set.verdicts:
+                # judged on an earlier turn, for a close enough question
+                ready[document.doc_id] = working_set.verdicts[document.doc_id]
+            else:
+                pending.append(document)
+
+        cancel = Event()
+        futures: List[Future[Dict[str, Note | None]]] = [
+            self.executor.submit(self._judge, messages, question, task, cancel, working_set)
+            for task in self._tasks(pending)
+        ]
+        timeout: float | None = (
+            None if deadline is None else max(deadline - (time.monotonic() - started), 0)
+        )
+        done, not_done = wait(futures, timeout=timeout)
+
+        complete: bool = not not_done
+        for future in done:
+            try:
+                ready.update(future.result())
+            except Exception as e:
+                complete = False
+                error_console.log(f"Archivist failed: {e}")
+        if not_done:
+            console.log(
+                f"{len(not_done)} archivist(s) missed the deadline, "
+                f"{'cancelling' if self.stragglers == 'cancel' else 'caching'} them"
+            )
+            if self.stragglers == "cancel":
+                cancel.set()
+                for future in not_done:
+                    future.cancel()
+
+        if working_set is not None:
+            working_set.verdicts.update(ready)
+        notes: List[Note] = [
+            note
+            for document in documents
+            if (note := ready.get(document.doc_id)) is not None
+        ]
+        return notes, complete
+
+    def _tasks(self, documents: List[Document]) -> List[List[Document]]:
+        if self.summarizer.settings.batch_tokens:
+            return self.summarizer.pack(documents, self.summarizer.settings.batch_tokens)
+        return [[document] for document in documents]
+
+    def _judge(
+        self,
+        messages: List[MessageParam],
+        question: str,
+        documents: List[Document],
+        cancel: Event,
+        working_set: WorkingSet | None = None,
+    ) -> Dict[str, Note | None]:
+        if len(documents) == 1 and not self.summarizer.settings.batch_tokens:
+            note: Note | None = self.summarizer.summarize(
+                messages, documents[0], cancel=cancel
+            )
+            verdicts: Dict[str, Note | None] = {documents[0].doc_id: note}
+        else:
+            notes: List[Note] = self.summarizer.run_batch(messages, documents)
+            by_id: Dict[str, Note] = {note.id: note for note in notes}
+            verdicts = {doc.doc_id: by_id.get(doc.doc_id) for doc in documents}
+
+        if cancel.is_set():
+            # a cancelled stream may hold a partial summary: don't keep it
+            return {}
+        for doc_id, verdict in verdicts.items():
+            self.verdicts.put(question, doc_id, verdict)
+            # a straggler's verdict serves the follow-up questions that reuse the working set
+            if working_set is not None and doc_id in working_set.documents:
+                working_set.verdicts[doc_id] = verdict
+        return verdicts
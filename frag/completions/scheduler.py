@@ -0,0 +1,239 @@
+"""
+Shared scheduler for LLM calls.
+
+Every bot call goes through `LLMScheduler.call`, which:
+
+- holds per-model token buckets for requests and tokens per minute (`rpm`/`tpm` in the bot
+  settings);
+- hands capacity out by priority, so that interface calls go before archivist calls queued on
+  the same model;
+- retries rate-limited and transient provider errors with jittered exponential backoff;
+- keeps queue depth and wait time metrics per model.
+"""
+
+import heapq
+import itertools
+import random
+import time
+from collections import deque
+from threading import Condition
+from typing import Any, Callable, Deque, Dict, List, Self, Tuple, TypeVar
+
+from litellm.exceptions import (
+    APIConnectionError,
+    InternalServerError,
+    RateLimitError,
+    ServiceUnavailableError,
+    Timeout,
+)
+from pydantic import BaseModel
+
+from frag.utils import SingletonMixin
+from frag.utils.console import error_console
+
+T = TypeVar("T")
+
+RETRYABLE: Tuple[type[Exception], ...] = (
+    RateLimitError,
+    APIConnectionError,
+    InternalServerError,
+    ServiceUnavailableError,
+    Timeout,
+)
+
+Ticket = Tuple[int, int]
+
+
+class TokenBucket:
+    """
+    A token bucket refilling at a per-minute rate, with a minute's worth of capacity.
+    """
+
+    def __init__(self, per_minute: int) -> None:
+        self.capacity: float = float(per_minute)
+        self.rate: float = per_minute / 60.0
+        self.tokens: float = self.capacity
+        self.updated: float = time.monotonic()
+
+    def _refill(self) -> None:
+        now: float = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """
+        Seconds to wait before `amount` is available (0 if it is available now).
+        """
+        self._refill()
+        # a request larger than the bucket can only ever wait for a full bucket
+        amount = min(amount, self.capacity)
+        return max(amount - self.tokens, 0) / self.rate
+
+    def take(self, amount: float) -> None:
+        """
+        Removes `amount` from the bucket; a negative amount gives tokens back.
+        """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class ModelMetrics(BaseModel):
+    """
+    Call metrics for a model.
+    """
+
+    queue_depth: int = 0
+    calls: int = 0
+    retries: int = 0
+    rate_limited: int = 0
+    failures: int = 0
+    wait_total: float = 0.0
+    wait_max: float = 0.0
+    wait_p95: float = 0.0
+
+
+class _ModelState:
+    def __init__(self) -> None:
+        self.requests: TokenBucket | None = None
+        self.tokens: TokenBucket | None = None
+        self.queue: List[Ticket] = []
+        self.metrics: ModelMetrics = ModelMetrics()
+        self.waits: Deque[float] = deque(maxlen=1000)
+
+    def delay(self, tokens: int) -> float:
+        return max(
+            self.requests.delay(1) if self.requests else 0.0,
+            self.tokens.delay(tokens) if self.tokens else 0.0,
+        )
+
+    def take(self, tokens: int) -> None:
+        if self.requests:
+            self.requests.take(1)
+        if self.tokens:
+            self.tokens.take(tokens)
+
+
+class LLMScheduler(SingletonMixin[type(Dict[str, Any])]):
+    """
+    Rate limits, prioritises and retries LLM calls. Shared by all the bots: get it with
+    `LLMScheduler.shared()`.
+    """
+
+    max_backoff: float = 30.0
+    base_backoff: float = 0.5
+
+    def __init__(self) -> None:
+        self._condition: Condition = Condition()
+        self._models: Dict[str, _ModelState] = {}
+        self._counter: itertools.count[int] = itertools.count()
+
+    @classmethod
+    def shared(cls) -> Self:
+        """
+        Returns the shared scheduler, creating it if needed.
+        """
+        return cls.instance or cls.__new__(cls)
+
+    def _state(self, model: str) -> _ModelState:
+        if model not in self._models:
+            self._models[model] = _ModelState()
+        return self._models[model]
+
+    def configure(self, model: str, rpm: int | None = None, tpm: int | None = None) -> None:
+        """
+        Sets the requests and tokens per minute limits for a model. Limits only ever get
+        stricter: bots sharing a model can't loosen each other's limits.
+        """
+        with self._condition:
+            state: _ModelState = self._state(model)
+            if rpm and (state.requests is None or rpm < state.requests.capacity):
+                state.requests = TokenBucket(rpm)
+            if tpm and (state.tokens is None or tpm < state.tokens.capacity):
+                state.tokens = TokenBucket(tpm)
+
+    def metrics(self) -> Dict[str, ModelMetrics]:
+        """
+        Returns a snapshot of the metrics, per model.
+        """
+        with self._condition:
+            snapshot: Dict[str, ModelMetrics] = {}
+            for model, state in self._models.items():
+                waits: List[float] = sorted(state.waits)
+                snapshot[model] = state.metrics.model_copy(
+                    update={
+                        "queue_depth": len(state.queue),
+                        "wait_p95": waits[int(len(waits) * 0.95)] if waits else 0.0,
+                    }
+                )
+            return snapshot
+
+    def _acquire(self, model: str, priority: int, tokens: int) -> None:
+        ticket: Ticket = (priority, next(self._counter))
+        queued: float = time.monotonic()
+        with self._condition:
+            state: _ModelState = self._state(model)
+            heapq.heappush(state.queue, ticket)
+            while True:
+                if state.queue[0] == ticket:
+                    delay: float = state.delay(tokens)
+                    if delay <= 0:
+                        break
+                    self._condition.wait(timeout=delay)
+                else:
+                    self._condition.wait()
+            heapq.heappop(state.queue)
+            state.take(tokens)
+            waited: float = time.monotonic() - queued
+            state.waits.append(waited)
+            state.metrics.calls += 1
+            state.metrics.wait_total += waited
+            state.metrics.wait_max = max(state.metrics.wait_max, waited)
+            self._condition.notify_all()
+
+    def settle(self, model: str, estimated: int, actual: int) -> None:
+        """
+        Corrects the tokens bucket once a call's actual usage is known.
+        """
+        with self._condition:
+            state: _ModelState = self._state(model)
+            if state.tokens:
+                state.tokens.take(actual - estimated)
+            self._condition.notify_all()
+
+    def call(
+        self,
+        model: str,
+        fn: Callable[[], T],
+        priority: int = 1,
+        tokens: int = 0,
+        retries: int = 3,
+    ) -> T:
+        """
+        Runs an LLM call once the model's limits allow it, retrying on transient errors.
+
+        :param model: The model the call is for; limits and metrics are per model.
+        :param fn: The call.
+        :param priority: Lower goes first.
+        :param tokens: Estimated tokens used by the call, for the tokens per minute limit.
+        :param retries: How many times to retry after a transient error.
+        """
+        for attempt in itertools.count():
+            self._acquire(model, priority, tokens)
+            try:
+                return fn()
+            except RETRYABLE as e:
+                with self._condition:
+                    metrics: ModelMetrics = self._state(model).metrics
+                    metrics.rate_limited += isinstance(e, RateLimitError)
+                    if attempt >= retries:
+                        metrics.failures += 1
+                        raise
+                    metrics.retries += 1
+                backoff: float = random.uniform(
+                    0, min(self.max_backoff, self.base_backoff * 2**attempt)
+                )
+                error_console.log(
+                    f"{model}: {type(e).__name__}, retrying in {backoff:.1f}s"
+                )
+                time.sleep(backoff)
+        raise AssertionError("unreachable")
@@ -2,13 +2,27 @@
 The SummarizerBot class is responsible for summarizing chat messages.
 It uses internal methods to render system and user messages based on
 the latest messages.
+
+In batched mode (`batch_tokens` set in the summarizer settings), several documents are judged
+in a single call, using the `summarizer.batch.html` template.
+
+In the `stable` prompt layout, the conversation is rendered apart, by the
+`summarizer.context.html` template, right after the system prompt: every document judged for a
+question then shares that prefix, and the provider's prompt cache serves it.
 """
 
+import os
+from threading import Event
 from typing import List, Dict, Any
-from llama_index.core.schema import Document
+
+import jinja2
+from llama_index.core.schema import Document, MetadataMode
+from frag.embeddings.tokenizer import get_llm_tokenizer
 from frag.settings.bot_model_settings import BotModelSettings
-from frag.typedefs import MessageParam, DocMeta
+from frag.typedefs import MessageParam, Note, UserMessage
+from frag.utils.console import error_console
 from .base_bot import BaseBot
+from .notes import VerdictStreamParser, parse_batch
 
 
 class SummarizerBot(BaseBot):
@@ -19,19 +33,150 @@ class SummarizerBot(BaseBot):
     """
 
     client_type = "summarizer"
+    batch_template: jinja2.Template | None = None
 
     def __init__(self, settings: BotModelSettings, template_dir: str) -> None:
         super().__init__(settings, template_dir=template_dir)
 
+    def load_templates(self, template_dir: str) -> None:
+        """
+        Loads the message templates, plus the optional batch template.
+        """
+        super().load_templates(template_dir)
+        batch_path: str = os.path.join(
+            template_dir or "templates", f"{self.client_type}.batch.html"
+        )
+        if os.path.exists(batch_path):
+            with open(batch_path, "r", encoding="utf-8") as file:
+                batch_source: str = file.read()
+                self.batch_template = jinja2.Template(batch_source)
+            self.template_sources.append(batch_source)
+
     def _render(
         self,
-        *_,
         messages: List[MessageParam],
         document: Document,
-        doc_meta: DocMeta,
         **kwargs: Dict[str, Any]
     ) -> List[MessageParam]:
+        """
+        Renders the system and user messages for a document.
+
+        :param messages: The conversation so far.
+        :param document: The document to judge; adjacent chunks are merged into a single
+            document by `EmbeddingStore.retrieve_documents`.
+        """
+        if self.settings.prompt_layout == "stable":
+            # the documents judged for a question share the system prompt and conversation
+            return [
+                *self._prefix(messages),
+                self._render_message(messages, role="user", document=document, **kwargs),
+            ]
         return [
             self._render_message(messages, role="system", **kwargs),
-            self._render_message(messages, role="user", **kwargs),
+            self._render_message(messages, role="user", document=document, **kwargs),
         ]
+
+    def summarize(
+        self,
+        messages: List[MessageParam],
+        document: Document,
+        cancel: Event | None = None,
+    ) -> Note | None:
+        """
+        Judges a single document, streaming the verdict and cancelling the stream as soon as
+        the document is found irrelevant.
+
+        :param messages: The conversation so far.
+        :param document: The document to judge.
+        :param cancel: If set while streaming, the stream is cancelled.
+        :return: The note, or None if the document is not relevant.
+        """
+        parser = VerdictStreamParser(document)
+        try:
+            stream = self._stream(self._render(messages, document=document))
+            try:
+                for delta in stream:
+                    if not parser.feed(delta) or parser.done:
+                        break
+                    if cancel is not None and cancel.is_set():
+                        break
+            finally:
+                stream.close()
+        except Exception as e:
+            error_console.log(f"Error during summarization: {e}")
+            raise
+        return parser.note
+
+    def _render_batch(
+        self, messages: List[MessageParam], documents: List[Document]
+    ) -> List[MessageParam]:
+        if self.batch_template is None:
+            raise ValueError(
+                f"Batched mode requires a {self.client_type}.batch.html template"
+            )
+        batch: MessageParam = UserMessage(
+            content=self.batch_template.render(
+                latest_messages=messages,
+                documents=documents,
+                layout=self.settings.prompt_layout,
+            ),
+            role="user",
+        )
+        if self.settings.prompt_layout == "stable":
+            return [*self._prefix(messages), batch]
+        return [self._render_message(messages, role="system"), batch]
+
+    def count_tokens(self, documents: List[Document]) -> List[int]:
+        """
+        Counts the tokens of documents' texts for the summarizer model; the counts are cached,
+        as the same documents are packed again for later questions.
+        """
+        return get_llm_tokenizer(self.settings.api).count_batch(
+            [document.get_content(metadata_mode=MetadataMode.NONE) for document in documents]
+        )
+
+    def pack(self, documents: List[Document], budget: int) -> List[List[Document]]:
+        """
+        Groups documents into batches whose text fits in the token budget, keeping their
+        order. A document larger than the budget gets a batch of its own.
+
+        :param documents: The documents, best first.
+        :param budget: The maximum number of document tokens per batch.
+        """
+        batches: List[List[Document]] = []
+        batch: List[Document] = []
+        used: int = 0
+        for document, tokens in zip(documents, self.count_tokens(documents)):
+            if batch and used + tokens > budget:
+                batches.append(batch)
+                batch, used = [], 0
+            batch.append(document)
+            used += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def run_batch(
+        self, messages: List[MessageParam], documents: List[Document]
+    ) -> List[Note]:
+        """
+        Judges several documents per call and returns the notes for the relevant ones.
+
+        :param messages: The conversation so far.
+        :param documents: The retrieved documents, best first.
+        """
+        budget: int | None = self.settings.batch_tokens
+        if not budget:
+            raise ValueError("Batched mode requires batch_tokens in the summarizer settings")
+
+        notes: List[Note] = []
+        for batch in self.pack(documents, budget):
+            try:
+                response = self._complete(self._render_batch(messages, batch))
+                notes.extend(
+                    parse_batch(str(response.choices[0].message.content or ""), batch)
+                )
+            except Exception as e:
+                error_console.log(f"Error during batched summarization: {e}")
+                raise
+        return notes
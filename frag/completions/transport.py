@@ -0,0 +1,315 @@
+"""
+Completion transports: how bots reach the LLM providers.
+
+- `LiveTransport` calls litellm (the default);
+- `RecordTransport` calls litellm and appends every request and response to a cassette file;
+- `ReplayTransport` answers from a cassette, deterministically, without network access;
+- `SimulatedTransport` answers from a cassette too, but with latencies drawn from a provider-like
+  distribution (time to first token, then token throughput), for offline performance tests.
+
+The transport is process-wide: set it with `set_transport`, or with the `FRAG_TRANSPORT`
+environment variable, e.g. `FRAG_TRANSPORT=replay:tests/cassettes/turn.jsonl`
+(`live`, `record:<path>`, `replay:<path>` or `simulate:<path>`).
+
+Cassettes are JSONL files, one call per line.
+"""
+
+import hashlib
+import json
+import math
+import os
+import random
+import time
+from pathlib import Path
+from threading import Lock
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List
+
+from litellm import ModelResponse, completion
+
+
+def _key(model: str, messages: List[Any], **kwargs: Any) -> str:
+    request: Dict[str, Any] = {"model": model, "messages": messages, **kwargs}
+    request.pop("stream", None)
+    request.pop("stream_options", None)
+    return hashlib.sha256(
+        json.dumps(request, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def _chunk(text: str) -> SimpleNamespace:
+    # the shape BaseBot._stream reads from litellm's stream chunks
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+
+class CompletionTransport:
+    """
+    Base transport: performs a completion, with litellm's `completion` arguments.
+    """
+
+    def complete(self, model: str, messages: List[Any], **kwargs: Any) -> Any:
+        raise NotImplementedError
+
+
+class LiveTransport(CompletionTransport):
+    """
+    Calls the providers through litellm.
+    """
+
+    def complete(self, model: str, messages: List[Any], **kwargs: Any) -> Any:
+        return completion(model=model, messages=messages, **kwargs)
+
+
+class _RecordingStream:
+    """
+    Wraps a litellm stream, recording the deltas; the entry is written once the stream ends or
+    is closed.
+    """
+
+    def __init__(
+        self, response: Any, entry: Dict[str, Any], transport: "RecordTransport"
+    ) -> None:
+        self.response: Any = response
+        self.completion_stream: Any = getattr(response, "completion_stream", None)
+        self.entry: Dict[str, Any] = entry
+        self.transport: RecordTransport = transport
+
+    def __iter__(self) -> Iterator[Any]:
+        started: float = time.monotonic()
+        chunks: List[str] = []
+        try:
+            for chunk in self.response:
+                # the usage comes in a last chunk, without choices
+                if chunk.choices:
+                    if not chunks:
+                        self.entry["ttft"] = self.entry["latency"] + time.monotonic() - started
+                    chunks.append(chunk.choices[0].delta.content or "")
+                yield chunk
+        finally:
+            self.entry["chunks"] = chunks
+            self.entry["latency"] += time.monotonic() - started
+            self.transport.write(self.entry)
+
+
+class RecordTransport(CompletionTransport):
+    """
+    Calls the providers and records every call to a cassette.
+
+    :param path: The cassette; entries are appended to it.
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        self.path: Path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock: Lock = Lock()
+
+    def write(self, entry: Dict[str, Any]) -> None:
+        """
+        Appends an entry to the cassette.
+        """
+        with self._lock, self.path.open("a", encoding="utf-8") as file:
+            file.write(json.dumps(entry, default=str) + "\n")
+
+    def complete(self, model: str, messages: List[Any], **kwargs: Any) -> Any:
+        started: float = time.monotonic()
+        response: Any = completion(model=model, messages=messages, **kwargs)
+        entry: Dict[str, Any] = {
+            "key": _key(model, messages, **kwargs),
+            "model": model,
+            "messages": messages,
+            "latency": time.monotonic() - started,
+        }
+        if kwargs.get("stream"):
+            return _RecordingStream(response, entry, self)
+        entry["ttft"] = entry["latency"]
+        entry["response"] = response.model_dump()
+        self.write(entry)
+        return response
+
+
+class ReplayTransport(CompletionTransport):
+    """
+    Answers from a cassette, without network access.
+
+    Identical requests recorded several times are replayed in order, the last one repeating.
+    A streamed call can be replayed from a non-streamed recording and vice versa.
+
+    :param path: The cassette.
+    :param strict: Raise on requests missing from the cassette; otherwise, answer with an empty
+        completion.
+    """
+
+    def __init__(self, path: str | Path, strict: bool = True) -> None:
+        self.path: Path = Path(path)
+        self.strict: bool = strict
+        self._entries: Dict[str, List[Dict[str, Any]]] = {}
+        self._served: Dict[str, int] = {}
+        self._lock: Lock = Lock()
+        with self.path.open("r", encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    entry: Dict[str, Any] = json.loads(line)
+                    self._entries.setdefault(entry["key"], []).append(entry)
+
+    def entry(self, model: str, messages: List[Any], **kwargs: Any) -> Dict[str, Any]:
+        """
+        Finds the recorded entry for a request.
+        """
+        key: str = _key(model, messages, **kwargs)
+        with self._lock:
+            entries: List[Dict[str, Any]] | None = self._entries.get(key)
+            if not entries:
+                if self.strict:
+                    raise KeyError(f"No recorded completion for this {model} request")
+                return {"model": model, "chunks": [], "latency": 0.0, "ttft": 0.0}
+            served: int = self._served.get(key, 0)
+            self._served[key] = served + 1
+            return entries[min(served, len(entries) - 1)]
+
+    @staticmethod
+    def text(entry: Dict[str, Any]) -> str:
+        """
+        Returns the text of a recorded completion.
+        """
+        if entry.get("chunks") is not None:
+            return "".join(entry["chunks"])
+        return str(entry["response"]["choices"][0]["message"]["content"] or "")
+
+    @staticmethod
+    def chunks(entry: Dict[str, Any]) -> List[str]:
+        """
+        Returns the recorded stream deltas, splitting a non-streamed answer into words.
+        """
+        if entry.get("chunks") is not None:
+            return list(entry["chunks"])
+        words: List[str] = ReplayTransport.text(entry).split(" ")
+        return [f"{word} " for word in words[:-1]] + [words[-1]]
+
+    def respond(self, entry: Dict[str, Any], stream: bool) -> Any:
+        """
+        Builds a response (or a stream of chunks) from a recorded entry.
+        """
+        if stream:
+            return iter([_chunk(text) for text in self.chunks(entry)])
+        if entry.get("response") is not None:
+            return ModelResponse(**entry["response"])
+        return ModelResponse(
+            model=entry["model"],
+            choices=[
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": self.text(entry)},
+                }
+            ],
+        )
+
+    def complete(self, model: str, messages: List[Any], **kwargs: Any) -> Any:
+        return self.respond(
+            self.entry(model, messages, **kwargs), bool(kwargs.get("stream"))
+        )
+
+
+class SimulatedTransport(ReplayTransport):
+    """
+    Answers from a cassette, with provider-like timings: the time to first token is drawn from
+    a log-normal distribution fitted to the given median and 99th percentile, then tokens
+    (approximated as words) arrive at a throughput drawn per call from a normal distribution
+    around `tokens_per_second`.
+
+    :param path: The cassette.
+    :param ttft_p50: Median time to first token, in seconds.
+    :param ttft_p99: 99th percentile of the time to first token, in seconds.
+    :param tokens_per_second: Mean output throughput.
+    :param throughput_cv: Standard deviation of the throughput, relative to its mean.
+    :param seed: Seed for the latency and throughput draws, for reproducible runs.
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        ttft_p50: float = 0.5,
+        ttft_p99: float = 5.0,
+        tokens_per_second: float = 50.0,
+        throughput_cv: float = 0.3,
+        seed: int = 0,
+        strict: bool = True,
+    ) -> None:
+        super().__init__(path, strict=strict)
+        self.mu: float = math.log(ttft_p50)
+        # 2.326 is the 99th percentile of the standard normal distribution
+        self.sigma: float = max(math.log(ttft_p99) - math.log(ttft_p50), 0.0) / 2.326
+        self.tokens_per_second: float = tokens_per_second
+        self.throughput_cv: float = throughput_cv
+        self._random: random.Random = random.Random(seed)
+
+    def ttft(self) -> float:
+        """
+        Draws a time to first token.
+        """
+        with self._lock:
+            return self._random.lognormvariate(self.mu, self.sigma)
+
+    def throughput(self) -> float:
+        """
+        Draws the output throughput of a call, in tokens per second.
+        """
+        with self._lock:
+            drawn: float = self._random.gauss(
+                self.tokens_per_second, self.tokens_per_second * self.throughput_cv
+            )
+        # a slow call, never a stalled or negative one
+        return max(drawn, self.tokens_per_second * 0.1)
+
+    def _stream(self, chunks: List[str], throughput: float) -> Iterator[SimpleNamespace]:
+        for text in chunks:
+            time.sleep(1.0 / throughput)
+            yield _chunk(text)
+
+    def complete(self, model: str, messages: List[Any], **kwargs: Any) -> Any:
+        entry: Dict[str, Any] = self.entry(model, messages, **kwargs)
+        chunks: List[str] = self.chunks(entry)
+        if kwargs.get("stream"):
+            # waited for before the stream is returned, as hedging and the scheduler time it
+            time.sleep(self.ttft())
+            return self._stream(chunks, self.throughput())
+        time.sleep(self.ttft() + len(chunks) / self.throughput())
+        return self.respond(entry, stream=False)
+
+
+_transport: CompletionTransport | None = None
+
+
+def transport_from_spec(spec: str) -> CompletionTransport:
+    """
+    Builds a transport from a `mode[:path]` string, as in `FRAG_TRANSPORT`.
+    """
+    mode, _, path = spec.partition(":")
+    if mode == "live":
+        return LiveTransport()
+    if not path:
+        raise ValueError(f"Transport {mode} requires a cassette path, e.g. {mode}:calls.jsonl")
+    if mode == "record":
+        return RecordTransport(path)
+    if mode == "replay":
+        return ReplayTransport(path)
+    if mode == "simulate":
+        return SimulatedTransport(path)
+    raise ValueError(f"Unknown transport: {mode}")
+
+
+def get_transport() -> CompletionTransport:
+    """
+    Returns the current transport, built from `FRAG_TRANSPORT` on first use.
+    """
+    global _transport
+    if _transport is None:
+        _transport = transport_from_spec(os.environ.get("FRAG_TRANSPORT", "live"))
+    return _transport
+
+
+def set_transport(transport: CompletionTransport | None) -> None:
+    """
+    Sets the transport used by all bots; None goes back to `FRAG_TRANSPORT`.
+    """
+    global _transport
+    _transport = transport
@@ -0,0 +1,74 @@
+"""
+Cache of archivist verdicts, keyed by question and document.
+
+Irrelevant verdicts are cached too (as None), so that a document already judged useless for a
+question is not sent to an archivist again. Verdicts from archivists that missed a turn's
+deadline land here, and are picked up by a later turn asking the same question; follow-up
+questions find them in the conversation's working set instead (see `working_set.py`).
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from typing import Tuple
+
+from frag.typedefs import Note
+
+Key = Tuple[str, str]
+
+
+def normalise_question(question: str) -> str:
+    """
+    Normalises a question for use as a cache key.
+    """
+    return " ".join(question.lower().split())
+
+
+class VerdictCache:
+    """
+    A thread-safe, size-bounded LRU cache of verdicts.
+    """
+
+    def __init__(self, max_size: int = 1024) -> None:
+        self.max_size: int = max_size
+        self._entries: OrderedDict[Key, Note | None] = OrderedDict()
+        self._lock: Lock = Lock()
+
+    def __contains__(self, key: Key) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def get(self, question: str, doc_id: str) -> Note | None:
+        """
+        Returns the cached verdict: a note, or None if the document was judged irrelevant
+        (or never judged; check with `in` first).
+        """
+        key: Key = (normalise_question(question), doc_id)
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def has(self, question: str, doc_id: str) -> bool:
+        """
+        Whether a verdict is cached for the question and document.
+        """
+        return (normalise_question(question), doc_id) in self
+
+    def put(self, question: str, doc_id: str, note: Note | None) -> None:
+        """
+        Stores a verdict, evicting the least recently used ones above `max_size`.
+        """
+        key: Key = (normalise_question(question), doc_id)
+        with self._lock:
+            self._entries[key] = note
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """
+        Drops every cached verdict.
+        """
+        with self._lock:
+            self._entries.clear()
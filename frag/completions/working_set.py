@@ -0,0 +1,120 @@
+"""
+Per-conversation working sets, for incremental retrieval across turns.
+
+Follow-up questions usually land on the chunks the previous turns retrieved. A `WorkingSet`
+keeps a conversation's retrieved documents, with their chunks' embeddings and the archivists'
+verdicts on them. A question close enough to the one that last queried the store (its novelty,
+one minus their cosine similarity, is under the threshold) is answered from the working set,
+re-ranked against the new question, without a vector query; only documents not yet judged are
+sent to the archivists. A novel question queries the store again, and its hits join the set.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, List, Sequence
+
+import numpy as np
+from llama_index.core.schema import Document
+
+from frag.typedefs import Note
+
+
+def _normalise(vectors: Sequence[Sequence[float]]) -> np.ndarray:
+    matrix: np.ndarray = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms: np.ndarray = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+class WorkingSet:
+    """
+    The documents retrieved during a conversation.
+
+    :param max_documents: Documents kept; the ones least similar to the latest question are
+        dropped first.
+    """
+
+    def __init__(self, max_documents: int = 50) -> None:
+        self.max_documents: int = max_documents
+        self.anchor: np.ndarray | None = None
+        self.documents: Dict[str, Document] = {}
+        self.vectors: Dict[str, np.ndarray] = {}
+        self.verdicts: Dict[str, Note | None] = {}
+
+    def novelty(self, embedding: Sequence[float]) -> float:
+        """
+        One minus the cosine similarity between a question and the last one queried; 1 if
+        nothing was queried yet.
+        """
+        if self.anchor is None:
+            return 1.0
+        return 1.0 - float(_normalise([embedding])[0] @ self.anchor)
+
+    def add(
+        self,
+        embedding: Sequence[float],
+        documents: Sequence[Document],
+        vectors: Dict[str, List[float]],
+    ) -> None:
+        """
+        Records a query and its documents.
+
+        :param embedding: The question's embedding, the new anchor.
+        :param documents: The retrieved documents.
+        :param vectors: Embeddings of the documents' chunks, by node id.
+        """
+        self.anchor = _normalise([embedding])[0]
+        for document in documents:
+            node_ids: List[str] = list(document.metadata.get("node_ids") or [document.doc_id])
+            chunks: List[List[float]] = [vectors[i] for i in node_ids if i in vectors]
+            if not chunks:
+                continue
+            self.documents[document.doc_id] = document
+            self.vectors[document.doc_id] = _normalise(chunks)
+        self._trim(embedding)
+
+    def rank(self, embedding: Sequence[float], top_k: int) -> List[Document]:
+        """
+        Returns the documents best matching a question, by their best chunk.
+        """
+        query: np.ndarray = _normalise([embedding])[0]
+        scores: Dict[str, float] = {
+            doc_id: float(np.max(vectors @ query)) for doc_id, vectors in self.vectors.items()
+        }
+        ranked: List[str] = sorted(scores, key=lambda d: scores[d], reverse=True)[:top_k]
+        return [self.documents[doc_id] for doc_id in ranked]
+
+    def _trim(self, embedding: Sequence[float]) -> None:
+        if len(self.documents) <= self.max_documents:
+            return
+        kept = {d.doc_id for d in self.rank(embedding, self.max_documents)}
+        for doc_id in [d for d in self.documents if d not in kept]:
+            self.documents.pop(doc_id)
+            self.vectors.pop(doc_id)
+            self.verdicts.pop(doc_id, None)
+
+
+class WorkingSets:
+    """
+    The working sets of the most recent conversations, in a thread-safe LRU.
+
+    :param max_conversations: Conversations kept.
+    :param max_documents: Documents kept per conversation.
+    """
+
+    def __init__(self, max_conversations: int = 256, max_documents: int = 50) -> None:
+        self.max_conversations: int = max_conversations
+        self.max_documents: int = max_documents
+        self._sets: OrderedDict[str, WorkingSet] = OrderedDict()
+        self._lock: Lock = Lock()
+
+    def get(self, conversation_id: str) -> WorkingSet:
+        """
+        Returns a conversation's working set, creating it if needed.
+        """
+        with self._lock:
+            if conversation_id not in self._sets:
+                self._sets[conversation_id] = WorkingSet(self.max_documents)
+            self._sets.move_to_end(conversation_id)
+            while len(self._sets) > self.max_conversations:
+                self._sets.popitem(last=False)
+            return self._sets[conversation_id]
@@ -0,0 +1,244 @@
+"""
+Sparse BM25 index, kept alongside each collection, for hybrid retrieval.
+
+Dense retrieval misses exact identifiers, such as API names and error codes, which a keyword
+index ranks highly. `BM25Index` is an inverted index in SQLite, under `.frag/bm25/`, updated
+whenever the store writes nodes; `reciprocal_rank_fusion` merges its results with the vector
+search results, by rank, so that the scores of the two need not be comparable.
+
+Searches are scored in SQLite, only returning the best nodes. Terms found in most nodes (above
+`max_df`, e.g. stopwords) barely change the ranking but have the longest posting lists: they
+are left out of the query, unless every query term is that common.
+"""
+
+import math
+import re
+import sqlite3
+from collections import Counter
+from pathlib import Path
+from threading import Lock
+from typing import AbstractSet, Any, Dict, Iterable, List, Sequence, Set, Tuple
+
+from llama_index.core.schema import BaseNode, MetadataMode, NodeWithScore
+
+_TOKEN = re.compile(r"\w+(?:[.:/\-]\w+)*")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Splits text into lowercase terms. Compound identifiers (`os.path`, `ERR-42`) are kept
+    whole, along with their parts.
+    """
+    terms: List[str] = []
+    for token in _TOKEN.findall(text.lower()):
+        terms.append(token)
+        if not token.isalnum():
+            terms.extend(part for part in re.split(r"[^\w]+|_", token) if part)
+    return terms
+
+
+def reciprocal_rank_fusion(
+    *rankings: Sequence[NodeWithScore], k: int = 60
+) -> List[NodeWithScore]:
+    """
+    Fuses rankings of nodes: each node scores the sum of 1 / (k + rank) over the rankings it
+    appears in.
+    """
+    scores: Dict[str, float] = {}
+    nodes: Dict[str, NodeWithScore] = {}
+    for ranking in rankings:
+        for rank, hit in enumerate(ranking, start=1):
+            node_id: str = hit.node.node_id
+            scores[node_id] = scores.get(node_id, 0.0) + 1.0 / (k + rank)
+            nodes.setdefault(node_id, hit)
+    return [
+        NodeWithScore(node=nodes[node_id].node, score=score)
+        for node_id, score in sorted(scores.items(), key=lambda s: s[1], reverse=True)
+    ]
+
+
+class BM25Index:
+    """
+    A BM25 inverted index of a collection's nodes.
+
+    :param path: The SQLite database file.
+    :param k1: Term frequency saturation.
+    :param b: Document length normalisation.
+    :param read_only: Open an existing index that never changes, e.g. a published snapshot's,
+        for searching only, without taking any locks.
+    :param max_df: Share of the nodes above which a term is too common to search for.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        k1: float = 1.2,
+        b: float = 0.75,
+        read_only: bool = False,
+        max_df: float = 0.5,
+    ) -> None:
+        self.path: Path = path
+        self.k1: float = k1
+        self.b: float = b
+        self.max_df: float = max_df
+        self._lock: Lock = Lock()
+        if read_only:
+            self._db: sqlite3.Connection = sqlite3.connect(
+                f"{path.resolve().as_uri()}?mode=ro&immutable=1", uri=True, check_same_thread=False
+            )
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS docs (
+                node_id TEXT PRIMARY KEY, ref_doc_id TEXT, length INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS docs_ref ON docs (ref_doc_id);
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT, node_id TEXT, tf INTEGER, PRIMARY KEY (term, node_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_node ON postings (node_id);
+            """
+        )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def _delete(self, node_ids: Sequence[str]) -> None:
+        for start in range(0, len(node_ids), 500):
+            batch: Sequence[str] = node_ids[start : start + 500]
+            marks: str = ",".join("?" * len(batch))
+            self._db.execute(f"DELETE FROM postings WHERE node_id IN ({marks})", batch)
+            self._db.execute(f"DELETE FROM docs WHERE node_id IN ({marks})", batch)
+
+    def add(self, nodes: Iterable[BaseNode]) -> None:
+        """
+        Indexes nodes, replacing those already indexed with the same ids.
+        """
+        docs: List[Tuple[str, str, int]] = []
+        postings: List[Tuple[str, str, int]] = []
+        for node in nodes:
+            terms: Counter[str] = Counter(
+                tokenize(node.get_content(metadata_mode=MetadataMode.EMBED))
+            )
+            docs.append((node.node_id, node.ref_doc_id or "", sum(terms.values())))
+            postings.extend((term, node.node_id, tf) for term, tf in terms.items())
+        with self._lock, self._db:
+            self._delete([node_id for node_id, _, _ in docs])
+            self._db.executemany("INSERT INTO docs VALUES (?, ?, ?)", docs)
+            self._db.executemany("INSERT INTO postings VALUES (?, ?, ?)", postings)
+
+    def delete(self, node_ids: Sequence[str]) -> None:
+        """
+        Removes nodes from the index.
+        """
+        with self._lock, self._db:
+            self._delete(list(node_ids))
+
+    def delete_documents(self, ref_doc_ids: Iterable[str]) -> None:
+        """
+        Removes every node of the given source documents.
+        """
+        ref_doc_ids = list(ref_doc_ids)
+        with self._lock, self._db:
+            node_ids: List[str] = []
+            for start in range(0, len(ref_doc_ids), 500):
+                batch: List[str] = ref_doc_ids[start : start + 500]
+                node_ids.extend(
+                    row[0]
+                    for row in self._db.execute(
+                        "SELECT node_id FROM docs WHERE ref_doc_id IN "
+                        f"({','.join('?' * len(batch))})",
+                        batch,
+                    )
+                )
+            self._delete(node_ids)
+
+    def ids(self) -> Set[str]:
+        """
+        The ids of the nodes indexed.
+        """
+        with self._lock:
+            return {row[0] for row in self._db.execute("SELECT node_id FROM docs")}
+
+    def clear(self) -> None:
+        """
+        Empties the index.
+        """
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM postings")
+            self._db.execute("DELETE FROM docs")
+
+    def search(
+        self, query: str, top_k: int, among: AbstractSet[str] | None = None
+    ) -> List[Tuple[str, float]]:
+        """
+        Returns the ids and BM25 scores of the best matching nodes, among the given ones if
+        any.
+        """
+        terms: List[str] = list(dict.fromkeys(tokenize(query)))
+        if not terms or (among is not None and not among):
+            return []
+        with self._lock:
+            count, total = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs"
+            ).fetchone()
+            if not count:
+                return []
+            frequencies: Dict[str, int] = {
+                term: self._db.execute(
+                    "SELECT COUNT(*) FROM postings WHERE term = ?", (term,)
+                ).fetchone()[0]
+                for term in terms
+            }
+            frequencies = {term: df for term, df in frequencies.items() if df}
+            if not frequencies:
+                return []
+            searched: Dict[str, int] = {
+                term: df for term, df in frequencies.items() if df <= self.max_df * count
+            } or dict([min(frequencies.items(), key=lambda f: f[1])])
+            average: float = total / count
+            parameters: List[Any] = [
+                value
+                for term, df in searched.items()
+                for value in (term, math.log(1 + (count - df + 0.5) / (df + 0.5)))
+            ]
+            values: str = ", ".join(["(?, ?)"] * len(searched))
+            restrict: str = ""
+            if among is not None:
+                self._db.execute(
+                    "CREATE TEMP TABLE IF NOT EXISTS among (node_id TEXT PRIMARY KEY)"
+                )
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO temp.among VALUES (?)", ((i,) for i in among)
+                )
+                restrict = "WHERE p.node_id IN (SELECT node_id FROM temp.among)"
+            try:
+                rows: List[Tuple[str, float]] = self._db.execute(
+                    f"WITH q (term, idf) AS (VALUES {values}) SELECT p.node_id, "
+                    "SUM(q.idf * p.tf * ? / (p.tf + ? + ? * d.length)) AS score "
+                    "FROM q JOIN postings p ON p.term = q.term "
+                    f"JOIN docs d ON d.node_id = p.node_id {restrict} "
+                    "GROUP BY p.node_id ORDER BY score DESC LIMIT ?",
+                    [
+                        *parameters,
+                        self.k1 + 1,
+                        self.k1 * (1 - self.b),
+                        self.k1 * self.b / average,
+                        top_k,
+                    ],
+                ).fetchall()
+            finally:
+                if among is not None:
+                    self._db.execute("DELETE FROM temp.among")
+                    self._db.commit()
+        return rows
+
+    def close(self) -> None:
+        """
+        Closes the database connection.
+        """
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,72 @@
+"""
+Bulk writes to Chroma collections.
+
+`ChromaVectorStore.add` writes nodes in the batches it is handed, and adds rather than upserts:
+a node already in the collection keeps its old vector. The store's bulk path upserts instead,
+in batches of a set size, from the records `node_records` builds.
+
+Chroma's local HNSW segment moves records from its brute-force buffer into the graph every
+`hnsw:batch_size` records (100 by default), and writes the index to disk every
+`hnsw:sync_threshold` records (1000 by default), rewriting its whole id mapping each time, which
+dominates large loads. The store creates its collections with both raised, see
+`BULK_HNSW_METADATA`, through Chroma's public collection metadata; the parameters are fixed
+when a collection is created, so older collections get them when compacted or re-embedded.
+Writes are logged in Chroma's SQLite queue as they happen, and the ones not yet persisted to
+the index are replayed from it when the collection is loaded, so nothing is lost.
+"""
+
+from typing import Any, Dict, List, Sequence
+
+from chromadb.api import ClientAPI
+from chromadb.api.models.Collection import Collection
+from llama_index.core.schema import BaseNode, MetadataMode
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
+
+# at most this many records are replayed into the index when a collection is loaded
+BULK_HNSW_METADATA: Dict[str, int] = {
+    "hnsw:batch_size": 1000,
+    "hnsw:sync_threshold": 10000,
+}
+
+
+def node_records(nodes: Sequence[BaseNode]) -> Dict[str, List[Any]]:
+    """
+    Converts embedded nodes into Chroma records, as `ChromaVectorStore` stores them.
+    """
+    records: Dict[str, List[Any]] = {
+        "ids": [],
+        "embeddings": [],
+        "metadatas": [],
+        "documents": [],
+    }
+    for node in nodes:
+        metadata: Dict[str, Any] = node_to_metadata_dict(
+            node, remove_text=True, flat_metadata=True
+        )
+        records["ids"].append(node.node_id)
+        records["embeddings"].append(node.get_embedding())
+        records["metadatas"].append(
+            {key: "" if value is None else value for key, value in metadata.items()}
+        )
+        records["documents"].append(node.get_content(metadata_mode=MetadataMode.NONE))
+    return records
+
+
+def bulk_metadata(metadata: Dict[str, Any] | None = None) -> Dict[str, Any]:
+    """
+    Returns collection metadata, e.g. a collection's being rebuilt, with the bulk-load HNSW
+    parameters.
+    """
+    return {**(metadata or {}), **BULK_HNSW_METADATA}
+
+
+def get_or_create_bulk_collection(client: ClientAPI, name: str) -> Collection:
+    """
+    Returns a collection, creating it with the bulk-load HNSW parameters if missing. An
+    existing collection's metadata is left as is.
+    """
+    try:
+        return client.get_collection(name)
+    except ValueError:
+        # also if created meanwhile by another process
+        return client.get_or_create_collection(name, metadata=bulk_metadata())
@@ -0,0 +1,301 @@
+"""
+Structure-aware Markdown chunking, sized in the embedding model's tokens.
+
+`MarkdownChunker` splits a document into blocks along its Markdown structure (headings, fenced
+code, paragraphs and lists, with `marko`'s grammar), then packs whole blocks into chunks of up
+to `chunk_size` tokens, preferring to start a chunk at a heading. HTML blocks embedded in the
+text are recognised too, when their tags open a line: `<h1>`-`<h6>` headings, and `<pre>`,
+`<ul>`, `<ol>` and `<table>` blocks, kept whole up to their closing tag. Only blocks too large
+for a chunk are split: code, HTML blocks and their lines at line ends, prose at sentence ends,
+and as a last resort anywhere.
+
+Chunks partition the text exactly, except for the `chunk_overlap` tokens of trailing blocks or
+sentences repeated at the start of the next chunk. A document's blocks are counted in a single
+batch; counts are cached by the model's shared `Tokenizer`, since the same blocks are counted
+again when packing and when checking the chunks.
+"""
+
+import re
+from typing import Any, List, NamedTuple, Sequence, Tuple
+
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.node_parser import NodeParser
+from llama_index.core.node_parser.node_utils import build_nodes_from_splits
+from llama_index.core.schema import BaseNode
+from marko import Markdown
+from marko.block import FencedCode, Heading
+
+from frag.typedefs.embed_types import ApiSource
+from .tokenizer import Tokenizer, get_tokenizer
+
+CONTEXT_KEYS: List[str] = ["before", "after"]
+
+_SENTENCE_END = re.compile(r"(?<=[.!?;:])(?=\s)")
+_HTML_HEADING = re.compile(r"^\s*<h([1-6])\b[^>]*>(.*?)</h\1\s*>\s*$", re.IGNORECASE)
+_HTML_BLOCK = re.compile(r"^\s*<(pre|ul|ol|table)\b", re.IGNORECASE)
+_HTML_TAG = re.compile(r"<[^>]+>")
+
+
+class _Unit(NamedTuple):
+    text: str
+    heading: bool
+    headings: Tuple[str, ...]
+
+
+def _plain_text(element: Any) -> str:
+    children: Any = getattr(element, "children", "")
+    if isinstance(children, str):
+        return children
+    return "".join(_plain_text(child) for child in children)
+
+
+def _html_depth(line: str, element: str) -> int:
+    """
+    Returns how many more `element` tags a line opens than it closes.
+    """
+    opened: int = len(re.findall(rf"<{element}\b", line, re.IGNORECASE))
+    return opened - len(re.findall(rf"</{element}\s*>", line, re.IGNORECASE))
+
+
+class MarkdownChunker(NodeParser):
+    """
+    Splits documents into structure-aligned chunks of at most `chunk_size` tokens.
+
+    Besides the document's metadata, each chunk gets `part`/`parts`, the text just `before`
+    and `after` it, and the `headings` it falls under, as in `RecordMeta`.
+    """
+
+    chunk_size: int = Field(512, description="Maximum tokens per chunk")
+    chunk_overlap: int = Field(0, description="Tokens repeated from the previous chunk")
+    context_chars: int = Field(200, description="Characters kept in before/after")
+    api_source: ApiSource = Field("OpenAI", description="Source of the embedding model")
+    api_model: str = Field(
+        "text-embedding-3-large", description="Embedding model, whose tokenizer is used"
+    )
+
+    _tokenizer: Tokenizer | None = PrivateAttr(default=None)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MarkdownChunker"
+
+    @property
+    def tokenizer(self) -> Tokenizer:
+        if self._tokenizer is None:
+            self._tokenizer = get_tokenizer(self.api_source, self.api_model)
+        return self._tokenizer
+
+    def count_tokens(self, text: str) -> int:
+        """
+        Counts the tokens of a text with the model's tokenizer, with a cache.
+        """
+        return self.tokenizer.count(text)
+
+    def _blocks(self, text: str) -> List[_Unit]:
+        """
+        Splits the text into blocks, each holding its trailing blank lines.
+        """
+        markdown: Markdown = Markdown()
+        headings: List[str] = []
+        blocks: List[_Unit] = []
+        lines: List[str] = []
+        fence: str | None = None
+        # the open HTML block's tag, and how many of them are open
+        element: str | None = None
+        depth: int = 0
+
+        def flush(heading: bool = False) -> None:
+            if lines:
+                blocks.append(_Unit("".join(lines), heading, tuple(h for h in headings if h)))
+                lines.clear()
+
+        def open_heading(level: int, title: str) -> None:
+            del headings[level - 1 :]
+            headings.extend([""] * (level - 1 - len(headings)))
+            headings.append(title)
+
+        for line in text.splitlines(keepends=True):
+            if fence is not None:
+                lines.append(line)
+                stripped: str = line.strip()
+                if stripped.startswith(fence) and not stripped.strip(fence[0]):
+                    fence = None
+                    flush()
+                continue
+            if element is not None:
+                lines.append(line)
+                depth += _html_depth(line, element)
+                if depth <= 0:
+                    element = None
+                    flush()
+                continue
+            if match := FencedCode.pattern.match(line):
+                if lines and lines[-1].strip():
+                    flush()
+                fence = match.group(2)
+                lines.append(line)
+            elif heading := Heading.pattern.match(line):
+                flush()
+                open_heading(
+                    len(heading.group(1)),
+                    _plain_text(markdown.parse(line).children[0]).strip(),
+                )
+                lines.append(line)
+                flush(heading=True)
+            elif html_heading := _HTML_HEADING.match(line):
+                flush()
+                open_heading(
+                    int(html_heading.group(1)),
+                    _HTML_TAG.sub("", html_heading.group(2)).strip(),
+                )
+                lines.append(line)
+                flush(heading=True)
+            elif html_block := _HTML_BLOCK.match(line):
+                flush()
+                lines.append(line)
+                depth = _html_depth(line, html_block.group(1).lower())
+                if depth > 0:
+                    element = html_block.group(1).lower()
+                else:
+                    flush()
+            elif not line.strip():
+                if blocks and not lines:
+                    # blank lines stay with the block they end
+                    blocks[-1] = blocks[-1]._replace(text=blocks[-1].text + line)
+                else:
+                    lines.append(line)
+                    flush()
+            else:
+                lines.append(line)
+        flush()
+        return blocks
+
+    def _split_unit(self, unit: _Unit) -> List[_Unit]:
+        """
+        Splits a unit larger than a chunk, at line ends for code, sentence ends for prose.
+        """
+        if self.count_tokens(unit.text) <= self.chunk_size:
+            return [unit]
+        code: bool = (
+            FencedCode.pattern.match(unit.text) is not None
+            or _HTML_BLOCK.match(unit.text) is not None
+        )
+        pieces: List[str] = (
+            unit.text.splitlines(keepends=True) if code else _SENTENCE_END.split(unit.text)
+        )
+        if len(pieces) > 1:
+            self.tokenizer.count_batch(pieces)
+            return [
+                split
+                for piece in self._pack([_Unit(p, False, unit.headings) for p in pieces])
+                for split in self._split_unit(_Unit(piece, False, unit.headings))
+            ]
+
+        # a single line or sentence too long for a chunk: cut it, keeping the cuts exact
+        cuts: List[_Unit] = []
+        text: str = unit.text
+        while (tokens := self.count_tokens(text)) > self.chunk_size:
+            cut: int = max(1, len(text) * self.chunk_size // tokens)
+            while cut > 1 and self.count_tokens(text[:cut]) > self.chunk_size:
+                cut = cut * 9 // 10
+            cuts.append(_Unit(text[:cut], False, unit.headings))
+            text = text[cut:]
+        return cuts + [_Unit(text, False, unit.headings)]
+
+    def _pack(self, units: Sequence[_Unit]) -> List[str]:
+        # used to regroup the pieces of a split unit, without overlap
+        texts: List[str] = []
+        current: str = ""
+        for unit in units:
+            if current and self.count_tokens(current + unit.text) > self.chunk_size:
+                texts.append(current)
+                current = ""
+            current += unit.text
+        if current:
+            texts.append(current)
+        return texts
+
+    def _overlap(self, units: List[_Unit]) -> List[_Unit]:
+        """
+        Returns the trailing units of a chunk that fit in `chunk_overlap` tokens.
+        """
+        overlap: List[_Unit] = []
+        tokens: int = 0
+        for unit in reversed(units[1:]):
+            pieces: List[str] = [p for p in _SENTENCE_END.split(unit.text) if p]
+            for piece, count in zip(
+                reversed(pieces), reversed(self.tokenizer.count_batch(pieces))
+            ):
+                tokens += count
+                if tokens > self.chunk_overlap:
+                    return overlap
+                overlap.insert(0, _Unit(piece, False, unit.headings))
+        return overlap
+
+    def chunk(self, text: str) -> List[Tuple[str, Tuple[str, ...]]]:
+        """
+        Splits a text into chunks.
+
+        :return: The chunks, with the headings each falls under.
+        """
+        blocks: List[_Unit] = self._blocks(text)
+        self.tokenizer.count_batch([block.text for block in blocks])
+        units: List[_Unit] = [split for block in blocks for split in self._split_unit(block)]
+        chunks: List[Tuple[str, Tuple[str, ...]]] = []
+        current: List[_Unit] = []
+        fresh: int = 0  # units of the current chunk that are not overlap
+        i: int = 0
+        while i < len(units):
+            unit: _Unit = units[i]
+            tokens: int = self.count_tokens("".join(u.text for u in current) + unit.text)
+            full: bool = tokens > self.chunk_size
+            # start sections on a new chunk, unless the current one is still small
+            section: bool = unit.heading and 2 * tokens > self.chunk_size
+            if fresh and (full or section):
+                chunks.append(("".join(u.text for u in current), current[-fresh].headings))
+                current = self._overlap(current) if self.chunk_overlap else []
+                fresh = 0
+                continue
+            if full and current:
+                # the overlap alone leaves no room for the unit
+                current = []
+                continue
+            current.append(unit)
+            fresh += 1
+            i += 1
+        if fresh:
+            chunks.append(("".join(u.text for u in current), current[-fresh].headings))
+        return [(text.strip(), headings) for text, headings in chunks if text.strip()]
+
+    def _parse_nodes(
+        self, nodes: Sequence[BaseNode], show_progress: bool = False, **kwargs: Any
+    ) -> List[BaseNode]:
+        all_nodes: List[BaseNode] = []
+        for node in nodes:
+            chunks: List[Tuple[str, Tuple[str, ...]]] = self.chunk(node.get_content())
+            texts: List[str] = [text for text, _ in chunks]
+            split_nodes: List[BaseNode] = build_nodes_from_splits(
+                texts, node, id_func=self.id_func
+            )
+            for i, (split, (_, headings)) in enumerate(zip(split_nodes, chunks)):
+                split.metadata.update(
+                    {
+                        "part": i + 1,
+                        "parts": len(split_nodes),
+                        "before": texts[i - 1][-self.context_chars :] if i > 0 else "",
+                        "after": (
+                            texts[i + 1][: self.context_chars] if i + 1 < len(texts) else ""
+                        ),
+                        "headings": " > ".join(headings),
+                    }
+                )
+                split.excluded_embed_metadata_keys = [
+                    *split.excluded_embed_metadata_keys,
+                    *(k for k in CONTEXT_KEYS if k not in split.excluded_embed_metadata_keys),
+                ]
+                split.excluded_llm_metadata_keys = [
+                    *split.excluded_llm_metadata_keys,
+                    *(k for k in CONTEXT_KEYS if k not in split.excluded_llm_metadata_keys),
+                ]
+            all_nodes.extend(split_nodes)
+        return all_nodes
@@ -0,0 +1,236 @@
+"""
+Compaction of a collection of the store.
+
+Chroma never shrinks a collection: deleted and replaced vectors stay in the HNSW index as
+tombstones, every write stays logged in the SQLite queue, and freed pages stay in the database
+file. `CompactJob` copies the live records of a collection, with their embeddings, into a new
+collection, switches the registry entry over to it, and vacuums the SQLite databases of the
+store.
+
+The old collection is kept, as retired in the registry entry, for the readers still using it
+until they reload the registry; the next compaction or garbage collection deletes it (its index
+files and its queue), see `drop_retired`. With `drop_old`, it is deleted right away.
+
+The size of the store and the latency of sample queries are measured before and after.
+"""
+
+import os
+import sqlite3
+import statistics
+import time
+from pathlib import Path
+from typing import Dict, List, Set, Tuple
+
+from chromadb.api.models.Collection import Collection
+from pydantic import BaseModel
+
+from frag.utils.console import console
+from .bulk import bulk_metadata
+from .reembed import _all_ids
+from .registry import CollectionEntry
+from .store import EmbeddingStore
+
+
+class CompactionReport(BaseModel):
+    """
+    The effect of a compaction. Sizes are in bytes, latencies in milliseconds.
+    """
+
+    collection: str
+    records: int
+    retired: str | None = None
+    size_before: int
+    size_after: int
+    p50_before: float
+    p95_before: float
+    p50_after: float
+    p95_after: float
+
+
+def directory_size(path: Path) -> int:
+    """
+    Total size of the files under a directory.
+    """
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def drop_retired(store: EmbeddingStore, collection_name: str) -> List[str]:
+    """
+    Deletes the physical collections a logical collection has retired.
+
+    :return: The collections deleted.
+    """
+    entry: CollectionEntry | None = store.registry.get(collection_name)
+    if entry is None or not entry.retired:
+        return []
+    existing: Set[str] = {c.name for c in store.db.list_collections()}
+    for name in entry.retired:
+        if name in existing:
+            store.db.delete_collection(name)
+            console.log(f"Deleted {name}, retired by {collection_name}")
+    dropped: List[str] = entry.retired
+    entry.retired = []
+    store.registry.put(collection_name, entry)
+    return dropped
+
+
+def query_latency(
+    collection: Collection, samples: int = 50, top_k: int = 5
+) -> Tuple[float, float]:
+    """
+    Times queries by the embeddings of the collection's first records.
+
+    :return: The median and 95th percentile latencies, in milliseconds.
+    """
+    embeddings: List = (
+        collection.get(limit=samples, include=["embeddings"])["embeddings"] or []
+    )
+    timings: List[float] = []
+    for embedding in embeddings:
+        started: float = time.perf_counter()
+        collection.query(query_embeddings=[embedding], n_results=top_k, include=["distances"])
+        timings.append((time.perf_counter() - started) * 1000)
+    if not timings:
+        return 0.0, 0.0
+    timings.sort()
+    return statistics.median(timings), timings[int(0.95 * (len(timings) - 1))]
+
+
+def vacuum(store: EmbeddingStore, collection_name: str) -> None:
+    """
+    Vacuums the SQLite databases of the store and of a collection's indexes, returning their
+    free pages to the file system.
+    """
+    for path in (
+        store.settings.path / "db" / "chroma.sqlite3",
+        store.settings.path / "bm25" / f"{collection_name}.sqlite3",
+        store.settings.path / "metadata" / f"{collection_name}.sqlite3",
+        store.settings.path / "dedup" / f"{collection_name}.sqlite3",
+    ):
+        if path.exists():
+            connection: sqlite3.Connection = sqlite3.connect(str(path))
+            try:
+                connection.execute("VACUUM")
+            finally:
+                connection.close()
+
+
+class CompactJob:
+    """
+    Rebuilds a collection of the store, and vacuums the store's databases.
+
+    :param store: The store.
+    :param collection_name: The logical collection to compact; defaults to the store's.
+    :param batch_size: Records copied at a time.
+    :param samples: Queries timed before and after.
+    :param drop_old: Delete the old collection after switching; otherwise it is retired, and
+        deleted by the next compaction or garbage collection.
+    """
+
+    def __init__(
+        self,
+        store: EmbeddingStore,
+        collection_name: str | None = None,
+        batch_size: int = 1000,
+        samples: int = 50,
+        drop_old: bool = False,
+    ) -> None:
+        self.store: EmbeddingStore = store
+        self.collection_name: str = collection_name or store.collection_name
+        self.batch_size: int = batch_size
+        self.samples: int = samples
+        self.drop_old: bool = drop_old
+
+    def _upsert(self, records: Dict[str, List], target: Collection) -> int:
+        if records["ids"]:
+            target.upsert(
+                ids=records["ids"],
+                embeddings=records["embeddings"],
+                documents=records["documents"],
+                metadatas=records["metadatas"],
+            )
+        return len(records["ids"])
+
+    def _copy(self, source: Collection, target: Collection) -> int:
+        copied: int = 0
+        while True:
+            records: Dict[str, List] = source.get(
+                limit=self.batch_size,
+                offset=copied,
+                include=["embeddings", "documents", "metadatas"],
+            )
+            if not records["ids"]:
+                return copied
+            copied += self._upsert(records, target)
+
+    def run(self) -> CompactionReport:
+        """
+        Runs the compaction.
+        """
+        store: EmbeddingStore = self.store
+        entry: CollectionEntry | None = store.registry.get(self.collection_name)
+        if entry is None:
+            raise ValueError(f"Unknown collection: {self.collection_name}")
+        if entry.migration is not None:
+            raise ValueError(
+                f"{self.collection_name} is being re-embedded: "
+                "compact it once the migration is over"
+            )
+
+        drop_retired(store, self.collection_name)
+        source: Collection = store.db.get_collection(entry.physical)
+        size_before: int = directory_size(store.settings.path)
+        p50_before, p95_before = query_latency(source, self.samples)
+
+        target_name: str = f"{self.collection_name[:48]}__c{int(time.time())}"
+        target: Collection = store.db.create_collection(
+            target_name, metadata=bulk_metadata(source.metadata)
+        )
+        console.log(f"Compacting {self.collection_name} into {target_name}")
+        records: int = self._copy(source, target)
+        # catch up with the records added or deleted during the copy
+        source_ids: Set[str] = _all_ids(source, self.batch_size)
+        target_ids: Set[str] = _all_ids(target, self.batch_size)
+        missing: List[str] = list(source_ids - target_ids)
+        for i in range(0, len(missing), self.batch_size):
+            records += self._upsert(
+                source.get(
+                    ids=missing[i : i + self.batch_size],
+                    include=["embeddings", "documents", "metadatas"],
+                ),
+                target,
+            )
+        if stale := list(target_ids - source_ids):
+            target.delete(ids=stale)
+            records -= len(stale)
+
+        store.registry.put(
+            self.collection_name,
+            CollectionEntry(
+                physical=target_name,
+                api_source=entry.api_source,
+                api_model=entry.api_model,
+                retired=[] if self.drop_old else [entry.physical],
+            ),
+        )
+        if self.drop_old:
+            store.db.delete_collection(entry.physical)
+        store.refresh()
+        vacuum(store, self.collection_name)
+
+        p50_after, p95_after = query_latency(target, self.samples)
+        return CompactionReport(
+            collection=self.collection_name,
+            records=records,
+            retired=None if self.drop_old else entry.physical,
+            size_before=size_before,
+            size_after=directory_size(store.settings.path),
+            p50_before=p50_before,
+            p95_before=p95_before,
+            p50_after=p50_after,
+            p95_after=p95_after,
+        )
@@ -0,0 +1,315 @@
+"""
+Chunk deduplication for the ingestion pipeline.
+
+Web pages repeat a lot of boilerplate (navbars, footers, versioned copies of the same page).
+`DedupTransform` sits between the node parser and the embedding model, and drops:
+
+- exact duplicates, detected by hashing the normalised chunk text;
+- near duplicates, detected via MinHash signatures bucketed with LSH;
+- chunks without any text once normalised (only punctuation or markup).
+
+The index of the chunks seen is kept in SQLite, under `.frag/dedup/`, next to the collection's
+keyword and metadata indexes: boilerplate ingested by one run is dropped by every following run,
+and memory stays flat however many chunks the index holds. Without a path, the index is kept in
+memory, for the lifetime of the transform. What was dropped is available in
+`DedupTransform.report`.
+"""
+
+import hashlib
+import random
+import re
+import sqlite3
+import struct
+from pathlib import Path
+from threading import Lock
+from typing import Iterable, List, Literal, Sequence, Set, Tuple
+
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+from llama_index.core.schema import BaseNode, MetadataMode, TransformComponent
+from pydantic import BaseModel
+
+_MERSENNE_PRIME: int = (1 << 61) - 1
+_MAX_HASH: int = (1 << 32) - 1
+_WORD_RE: re.Pattern[str] = re.compile(r"\w+")
+
+Signature = Tuple[int, ...]
+
+
+class DroppedChunk(BaseModel):
+    """
+    A chunk removed by the deduplicator.
+    """
+
+    node_id: str
+    duplicate_of: str
+    kind: Literal["exact", "near", "empty"]
+    similarity: float
+
+
+class DedupReport(BaseModel):
+    """
+    Summary of a deduplication run.
+    """
+
+    seen: int = 0
+    kept: int = 0
+    dropped: List[DroppedChunk] = []
+
+    @property
+    def exact(self) -> int:
+        return len([d for d in self.dropped if d.kind == "exact"])
+
+    @property
+    def near(self) -> int:
+        return len([d for d in self.dropped if d.kind == "near"])
+
+    @property
+    def empty(self) -> int:
+        return len([d for d in self.dropped if d.kind == "empty"])
+
+    def __str__(self) -> str:
+        return (
+            f"{self.seen} chunks, {self.kept} kept, "
+            f"{self.exact} exact and {self.near} near duplicates dropped, "
+            f"{self.empty} empty chunks dropped"
+        )
+
+
+def _normalise(text: str) -> str:
+    return " ".join(_WORD_RE.findall(text.lower()))
+
+
+def _hash64(value: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "little"
+    )
+
+
+class DedupTransform(TransformComponent):
+    """
+    Drops exact and near-duplicate nodes before they are embedded.
+
+    Attributes:
+        threshold: estimated Jaccard similarity above which two chunks are duplicates.
+        shingle_size: number of words per shingle.
+        num_perm: number of MinHash permutations.
+        bands: number of LSH bands; `num_perm` must be divisible by it.
+        path: the SQLite database of the index; kept in memory if None.
+    """
+
+    threshold: float = Field(0.85, description="Near-duplicate Jaccard threshold")
+    shingle_size: int = Field(5, description="Words per shingle")
+    num_perm: int = Field(64, description="Number of MinHash permutations")
+    bands: int = Field(16, description="Number of LSH bands")
+    path: str | None = Field(None, description="SQLite database of the index")
+
+    _permutations: List[Tuple[int, int]] = PrivateAttr(default_factory=list)
+    _db: sqlite3.Connection = PrivateAttr()
+    _lock: Lock = PrivateAttr(default_factory=Lock)
+    _report: DedupReport = PrivateAttr(default_factory=DedupReport)
+
+    def __init__(self, **kwargs: float | int | str | None) -> None:
+        super().__init__(**kwargs)
+        if self.num_perm % self.bands:
+            raise ValueError("num_perm must be divisible by bands")
+        rng = random.Random(self.num_perm)
+        self._permutations = [
+            (rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME))
+            for _ in range(self.num_perm)
+        ]
+        if self.path is not None:
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(self.path or ":memory:", check_same_thread=False)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS params (value TEXT);
+            CREATE TABLE IF NOT EXISTS chunks (
+                node_id TEXT PRIMARY KEY, ref_doc_id TEXT, digest TEXT, signature BLOB
+            );
+            CREATE INDEX IF NOT EXISTS chunks_digest ON chunks (digest);
+            CREATE INDEX IF NOT EXISTS chunks_doc ON chunks (ref_doc_id);
+            CREATE TABLE IF NOT EXISTS bands (
+                band INTEGER, key BLOB, node_id TEXT, PRIMARY KEY (band, key, node_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS bands_node ON bands (node_id);
+            """
+        )
+        params: str = f"{self.num_perm}:{self.bands}:{self.shingle_size}"
+        stored: Tuple[str] | None = self._db.execute("SELECT value FROM params").fetchone()
+        if stored is None or stored[0] != params:
+            # signatures computed with other parameters do not compare
+            with self._db:
+                self._db.execute("DELETE FROM bands")
+                self._db.execute("DELETE FROM chunks")
+                self._db.execute("DELETE FROM params")
+                self._db.execute("INSERT INTO params VALUES (?)", (params,))
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "DedupTransform"
+
+    @property
+    def report(self) -> DedupReport:
+        """
+        Report of the last run.
+        """
+        return self._report
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def __call__(self, nodes: Sequence[BaseNode], **kwargs: object) -> List[BaseNode]:
+        self._report = DedupReport()
+        kept: List[BaseNode] = []
+        with self._lock, self._db:
+            for node in nodes:
+                self._report.seen += 1
+                text: str = _normalise(node.get_content(metadata_mode=MetadataMode.NONE))
+                if not text:
+                    self._drop(node.node_id, "", "empty", 0.0)
+                    continue
+
+                digest: str = hashlib.sha256(text.encode("utf-8")).hexdigest()
+                original: Tuple[str] | None = self._db.execute(
+                    "SELECT node_id FROM chunks WHERE digest = ? LIMIT 1", (digest,)
+                ).fetchone()
+                if original is not None:
+                    self._drop(node.node_id, original[0], "exact", 1.0)
+                    continue
+
+                signature: Signature = self._signature(text)
+                match: Tuple[str, float] | None = self._near_match(signature)
+                if match is not None:
+                    self._drop(node.node_id, match[0], "near", match[1])
+                    continue
+
+                self._add(node, digest, signature)
+                kept.append(node)
+
+        self._report.kept = len(kept)
+        return kept
+
+    def forget(self, ref_doc_ids: Iterable[str]) -> None:
+        """
+        Remove every chunk belonging to the given documents from the index, so that
+        re-ingesting a document does not drop its own previous chunks.
+        """
+        doc_ids: List[str] = list(dict.fromkeys(ref_doc_ids))
+        with self._lock, self._db:
+            for start in range(0, len(doc_ids), 500):
+                batch: List[str] = doc_ids[start : start + 500]
+                self._remove(
+                    [
+                        row[0]
+                        for row in self._db.execute(
+                            "SELECT node_id FROM chunks WHERE ref_doc_id IN "
+                            f"({','.join('?' * len(batch))})",
+                            batch,
+                        )
+                    ]
+                )
+
+    def discard(self, node_ids: Iterable[str]) -> None:
+        """
+        Remove chunks from the index, e.g. once deleted from the collection.
+        """
+        with self._lock, self._db:
+            self._remove(list(node_ids))
+
+    def ids(self) -> Set[str]:
+        """
+        The ids of the chunks indexed.
+        """
+        with self._lock:
+            return {row[0] for row in self._db.execute("SELECT node_id FROM chunks")}
+
+    def close(self) -> None:
+        """
+        Closes the database connection.
+        """
+        with self._lock:
+            self._db.close()
+
+    def _remove(self, node_ids: List[str]) -> None:
+        for start in range(0, len(node_ids), 500):
+            batch: List[str] = node_ids[start : start + 500]
+            marks: str = ",".join("?" * len(batch))
+            self._db.execute(f"DELETE FROM bands WHERE node_id IN ({marks})", batch)
+            self._db.execute(f"DELETE FROM chunks WHERE node_id IN ({marks})", batch)
+
+    def _add(self, node: BaseNode, digest: str, signature: Signature) -> None:
+        self._db.execute(
+            "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?)",
+            (
+                node.node_id,
+                node.ref_doc_id or node.node_id,
+                digest,
+                struct.pack(f"<{self.num_perm}I", *signature),
+            ),
+        )
+        self._db.executemany(
+            "INSERT OR IGNORE INTO bands VALUES (?, ?, ?)",
+            (
+                (band, key, node.node_id)
+                for band, key in enumerate(self._band_keys(signature))
+            ),
+        )
+
+    def _drop(
+        self,
+        node_id: str,
+        duplicate_of: str,
+        kind: Literal["exact", "near", "empty"],
+        similarity: float,
+    ) -> None:
+        self._report.dropped.append(
+            DroppedChunk(
+                node_id=node_id,
+                duplicate_of=duplicate_of,
+                kind=kind,
+                similarity=similarity,
+            )
+        )
+
+    def _shingles(self, text: str) -> Set[int]:
+        words: List[str] = text.split(" ")
+        if len(words) <= self.shingle_size:
+            return {_hash64(text)}
+        return {
+            _hash64(" ".join(words[i : i + self.shingle_size]))
+            for i in range(len(words) - self.shingle_size + 1)
+        }
+
+    def _signature(self, text: str) -> Signature:
+        shingles: Set[int] = self._shingles(text)
+        return tuple(
+            min(((a * s + b) % _MERSENNE_PRIME) & _MAX_HASH for s in shingles)
+            for a, b in self._permutations
+        )
+
+    def _band_keys(self, signature: Signature) -> List[bytes]:
+        rows: int = self.num_perm // self.bands
+        return [
+            struct.pack(f"<{rows}I", *signature[i * rows : (i + 1) * rows])
+            for i in range(self.bands)
+        ]
+
+    def _near_match(self, signature: Signature) -> Tuple[str, float] | None:
+        keys: List[bytes] = self._band_keys(signature)
+        candidates: List[Tuple[str, bytes]] = self._db.execute(
+            "SELECT DISTINCT c.node_id, c.signature FROM bands b "
+            "JOIN chunks c ON c.node_id = b.node_id WHERE "
+            + " OR ".join(["(b.band = ? AND b.key = ?)"] * len(keys)),
+            [value for band, key in enumerate(keys) for value in (band, key)],
+        ).fetchall()
+
+        best: Tuple[str, float] | None = None
+        for candidate, packed in candidates:
+            other: Tuple[int, ...] = struct.unpack(f"<{self.num_perm}I", packed)
+            similarity: float = sum(
+                1 for x, y in zip(signature, other) if x == y
+            ) / float(self.num_perm)
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (candidate, similarity)
+        return best
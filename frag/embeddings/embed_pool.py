@@ -0,0 +1,198 @@
+"""
+A pool of embedding worker processes, for HuggingFace models.
+
+In a single process, tokenization and the pre/post-processing around inference hold the GIL,
+so local embedding cannot use every core. `EmbeddingPool` forks worker processes from a parent
+that has already loaded the model:
+- with the `torch` backend, the weights are loaded once, before forking, and shared by the
+  workers copy-on-write;
+- with the `onnx` backend, the export is made (or found) once; as ONNX Runtime's thread pools
+  do not survive a fork, each worker opens its own session on it.
+
+Results come back through shared memory: the pool allocates a slot per batch in flight, also
+before forking, into which the workers write their float32 embeddings; only the batch's shape is
+pickled back. The number of slots bounds the batches in flight: submitting more blocks until a
+slot is free, or fails after `timeout` seconds, which is the pool's backpressure.
+
+Forking is only available on POSIX systems. A forked worker only gets the thread that forked it:
+locks held by any other thread of the parent stay locked in the worker. The pool therefore forks
+every worker as it is created, rather than on first use; create it before the parent runs
+threads, or embeds in-process (which starts PyTorch's and OpenMP's thread pools). Workers and
+shared memory are released by `close`, or when the interpreter exits.
+"""
+
+import atexit
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from threading import Lock
+from typing import TYPE_CHECKING, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from frag.utils.console import console
+
+if TYPE_CHECKING:
+    from frag.embeddings.hf_embed_api import HFEmbedAPI
+
+# the state of each pool, inherited by its workers when they are forked
+_pools: Dict[int, Tuple["HFEmbedAPI", List[SharedMemory]]] = {}
+_ids = itertools.count()
+
+
+def _init_worker(pool_id: int, threads: int) -> None:
+    model, _ = _pools[pool_id]
+    if model.backend == "onnx":
+        model.threads = model.threads or threads
+    else:
+        import torch
+
+        torch.set_num_threads(threads)
+
+
+def _embed_into(pool_id: int, slot: int, texts: List[str]) -> Tuple[int, int]:
+    model, slots = _pools[pool_id]
+    vectors: np.ndarray = model._embed_array(texts)
+    np.ndarray(vectors.shape, dtype=np.float32, buffer=slots[slot].buf)[:] = vectors
+    return vectors.shape
+
+
+class EmbeddingPool:
+    """
+    Embeds texts with a HuggingFace model, across worker processes.
+
+    :param model: The model; its weights are loaded, or its ONNX export made, right away.
+    :param workers: Worker processes; all cores by default.
+    :param max_pending: Batches in flight, across callers, before submitting blocks; twice the
+        workers by default.
+    :param batch_size: Texts per batch sent to a worker.
+    :param timeout: Seconds to wait for a batch to be accepted before raising a `TimeoutError`;
+        None waits as long as needed.
+    """
+
+    def __init__(
+        self,
+        model: "HFEmbedAPI",
+        workers: int | None = None,
+        max_pending: int | None = None,
+        batch_size: int = 32,
+        timeout: float | None = None,
+    ) -> None:
+        self.model: "HFEmbedAPI" = model
+        self.workers: int = workers or os.cpu_count() or 1
+        self.max_pending: int = max_pending or 2 * self.workers
+        self.batch_size: int = batch_size
+        self.timeout: float | None = timeout
+        self.dimension: int = self._dimension()
+        self.id: int = next(_ids)
+        self._slots: List[SharedMemory] = [
+            SharedMemory(create=True, size=batch_size * self.dimension * 4)
+            for _ in range(self.max_pending)
+        ]
+        self._free: queue.Queue[int] = queue.Queue()
+        for slot in range(self.max_pending):
+            self._free.put(slot)
+        self._lock: Lock = Lock()
+        _pools[self.id] = (model, self._slots)
+        self._executor: ProcessPoolExecutor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_worker,
+            initargs=(self.id, max(1, (os.cpu_count() or 1) // self.workers)),
+        )
+        if threading.active_count() > 1:
+            console.log(
+                f"Forking {self.workers} embedding workers from a process running "
+                f"{threading.active_count()} threads: create the pool before starting threads"
+            )
+        # forks every worker now, in a known state, rather than on the first submission
+        self._executor.submit(os.getpid).result()
+        atexit.register(self.close)
+
+    def _dimension(self) -> int:
+        if self.model.backend == "onnx":
+            # the probe's session is dropped before forking, along with its threads
+            dimension: int = self.model._embed_array(["dimension probe"]).shape[1]
+            self.model._session = None
+            return dimension
+        return self.model.model.get_sentence_embedding_dimension()
+
+    def submit(self, texts: Sequence[str], out: np.ndarray) -> "Future[None]":
+        """
+        Sends a batch to a worker, blocking while `max_pending` batches are in flight.
+
+        :param texts: At most `batch_size` texts.
+        :param out: Receives the embeddings, one row per text.
+        :return: A future, done once `out` is filled.
+        """
+        if len(texts) > self.batch_size:
+            raise ValueError(f"Batches are limited to {self.batch_size} texts")
+        try:
+            slot: int = self._free.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(
+                f"The embedding pool has had {self.max_pending} batches in flight "
+                f"for {self.timeout}s"
+            )
+        done: Future[None] = Future()
+
+        def collect(result: "Future[Tuple[int, int]]") -> None:
+            try:
+                shape: Tuple[int, int] = result.result()
+                out[:] = np.ndarray(shape, dtype=np.float32, buffer=self._slots[slot].buf)
+            except BaseException as e:
+                done.set_exception(e)
+            else:
+                done.set_result(None)
+            finally:
+                self._free.put(slot)
+
+        try:
+            future = self._executor.submit(_embed_into, self.id, slot, list(texts))
+        except BaseException:
+            self._free.put(slot)
+            raise
+        future.add_done_callback(collect)
+        return done
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        Embeds texts, in batches spread across the workers.
+
+        :return: The embeddings, as a float32 matrix.
+        """
+        result: np.ndarray = np.empty((len(texts), self.dimension), dtype=np.float32)
+        futures: List[Future[None]] = [
+            self.submit(
+                texts[start : start + self.batch_size],
+                result[start : start + self.batch_size],
+            )
+            for start in range(0, len(texts), self.batch_size)
+        ]
+        for future in futures:
+            future.result()
+        return result
+
+    def close(self) -> None:
+        """
+        Stops the workers and frees the shared memory.
+        """
+        with self._lock:
+            if self.id not in _pools:
+                return
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            for shared in self._slots:
+                shared.close()
+                shared.unlink()
+            del _pools[self.id]
+        atexit.unregister(self.close)
+
+    def __enter__(self) -> "EmbeddingPool":
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.close()
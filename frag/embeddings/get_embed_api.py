@@ -1,9 +1,19 @@
+from typing import Literal
+
 from llama_index.core.embeddings import BaseEmbedding
 from frag.typedefs.embed_types import ApiSource
 
 
 def get_embed_api(
-    api_source: ApiSource, api_model: str | None, api_key: str | None = None
+    api_source: ApiSource,
+    api_model: str | None,
+    api_key: str | None = None,
+    backend: Literal["torch", "onnx"] = "torch",
+    quantize: bool = False,
+    threads: int | None = None,
+    cache_dir: str = ".frag",
+    workers: int = 0,
+    max_pending: int | None = None,
 ) -> BaseEmbedding:
     """
     Retrieves an embedding API instance based on the input.
@@ -11,6 +21,10 @@ def get_embed_api(
     Args:
         embed_api (EmbedAPI|str): The embedding API instance or a string identifier for the API.
             For OpenAI APIs, prepend 'oai:' to the API name.
+        backend, quantize, threads, cache_dir: For HuggingFace models, run an ONNX export of
+            the model instead of PyTorch; see `HFEmbedAPI`.
+        workers, max_pending: For HuggingFace models, embed in a pool of worker processes;
+            see `EmbeddingPool`.
 
     Returns:
         EmbedAPI: An instance of the requested embedding API.
@@ -25,12 +39,24 @@ def get_embed_api(
         from llama_index.embeddings.openai import OpenAIEmbedding
 
         return OpenAIEmbedding(model=api_model, api_key=api_key)
+    elif api_source == "HuggingFace" and (backend == "onnx" or workers):
+        from .hf_embed_api import HFEmbedAPI
+
+        return HFEmbedAPI(
+            name=api_model,
+            backend=backend,
+            quantize=quantize,
+            threads=threads,
+            cache_dir=cache_dir,
+            workers=workers,
+            max_pending=max_pending,
+        )
     elif api_source == "HuggingFace":
         from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 
         try:
-            embed_api = HuggingFaceEmbedding(model=api_model)
+            return HuggingFaceEmbedding(model_name=api_model)
         except ValueError:
             raise ValueError(f"Invalid embedding API: {api_model} on {api_source}")
 
-    raise ValueError("Invalid embedding API type: %s" % type(embed_api))
+    raise ValueError("Invalid embedding API source: %s" % api_source)
@@ -1,15 +1,43 @@
 """
 This module allows for embedding with HuggingFace models.
+
+`HFEmbedAPI` has two backends:
+- `torch`: the sentence-transformers model, as is;
+- `onnx`: the same model exported to ONNX, optionally quantized to int8, and run with ONNX
+  Runtime on the CPU, with a set number of threads. The export is cached under
+  `<cache_dir>/onnx/<model>/`, so that later runs load neither PyTorch nor the original
+  weights.
+
+With `workers`, embedding is spread across worker processes, by an `EmbeddingPool`, which is
+started, and its workers forked, as the model is created.
+
+`parity` checks that the ONNX embeddings match the PyTorch ones, and `benchmark` compares the
+throughput of the backends.
 """
 
-from typing import List
-from pydantic import Field
+import json
+import re
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Literal, Sequence
+
+import numpy as np
 from chromadb.api.types import EmbeddingFunction, Documents
 from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
-from sentence_transformers import SentenceTransformer
-
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
 from llama_index.core.embeddings import BaseEmbedding
 
+from frag.utils.console import console
+from .tokenizer import Tokenizer, get_tokenizer
+
+if TYPE_CHECKING:
+    # imports PyTorch: only loaded when the torch backend, or an export, needs it
+    from sentence_transformers import SentenceTransformer
+
+    from .embed_pool import EmbeddingPool
+
+Backend = Literal["torch", "onnx"]
+
 
 class HFEmbedAPI(BaseEmbedding):
     """
@@ -18,20 +46,52 @@ class HFEmbedAPI(BaseEmbedding):
     Attributes:
         name: The name of the HuggingFace embedding model, for example "gpt2".
         max_tokens: The maximum number of tokens to embed.
+        backend: `torch`, or `onnx` to run an ONNX export of the model.
+        quantize: With the ONNX backend, quantize the weights to int8.
+        threads: With the ONNX backend, threads used per inference; all cores by default.
+        cache_dir: Where the ONNX exports are kept, under `onnx/`.
+        workers: Embed in this many worker processes; 0 embeds in the calling process.
+        max_pending: With workers, batches in flight before embedding blocks.
     """
 
     name: str = Field(
         "all-MiniLM-L6-v2", description="Name for HuggingFace embeddings model"
     )
     max_tokens: int = Field(512, description="Maximum tokens to embed")
+    backend: Backend = Field("torch", description="Inference backend")
+    quantize: bool = Field(False, description="Quantize the ONNX model to int8")
+    threads: int | None = Field(None, description="ONNX Runtime intra-op threads")
+    cache_dir: str = Field(".frag", description="Directory of the ONNX exports")
+    workers: int = Field(0, description="Embedding worker processes")
+    max_pending: int | None = Field(None, description="Batches in flight, with workers")
+
+    _api: Any = PrivateAttr(default=None)
+    _session: Any = PrivateAttr(default=None)
+    _tokenizer: Any = PrivateAttr(default=None)
+    _pooling: Dict[str, Any] = PrivateAttr(default_factory=dict)
+    _pool: Any = PrivateAttr(default=None)
 
-    _api: SentenceTransformer | None = None
+    def __init__(self, **kwargs: Any) -> None:
+        kwargs.setdefault("model_name", kwargs.get("name", "all-MiniLM-L6-v2"))
+        if kwargs.get("workers"):
+            # large enough batches to keep every worker busy
+            kwargs.setdefault("embed_batch_size", 64 * kwargs["workers"])
+        super().__init__(**kwargs)
+        if self.workers:
+            # forked now, before the caller starts any thread, see `EmbeddingPool`
+            self._pool = self._start_pool()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "HFEmbedAPI"
 
     @property
-    def model(self) -> SentenceTransformer:
+    def model(self) -> "SentenceTransformer":
 
         if self._api is None:
             try:
+                from sentence_transformers import SentenceTransformer
+
                 self._api = SentenceTransformer(self.name)
             except ImportError:
                 raise ImportError(
@@ -43,14 +103,272 @@ class HFEmbedAPI(BaseEmbedding):
         return self._api
 
     def encode(self, text: str) -> List[int]:
+        if self.backend == "onnx":
+            self._load_onnx()
+            return self._tokenizer.encode(text)
         return self.model.tokenizer.encode(text)
 
     def decode(self, tokens: List[int]) -> str:
+        if self.backend == "onnx":
+            self._load_onnx()
+            return self._tokenizer.decode(tokens)
         return self.model.tokenizer.decode(tokens)
 
+    @property
+    def tokenizer(self) -> Tokenizer:
+        """
+        The model's shared tokenizer, with its cache of token counts; it does not load the
+        model.
+        """
+        return get_tokenizer("HuggingFace", self.name)
+
+    def encode_batch(self, texts: Sequence[str]) -> List[List[int]]:
+        """
+        Tokenizes texts in a single call to the fast tokenizer, without special tokens.
+        """
+        return self.tokenizer.encode_batch(texts)
+
+    def count_tokens(self, texts: Sequence[str]) -> List[int]:
+        """
+        Counts the tokens of texts, tokenizing only those not counted before.
+        """
+        return self.tokenizer.count_batch(texts)
+
+    def truncate(self, text: str, max_tokens: int | None = None) -> str:
+        """
+        Cuts a text to the tokens the model embeds, `max_tokens` by default.
+        """
+        return self.tokenizer.truncate(text, max_tokens or self.max_tokens)
+
+    def _start_pool(self) -> "EmbeddingPool":
+        from .embed_pool import EmbeddingPool
+
+        return EmbeddingPool(self, workers=self.workers, max_pending=self.max_pending)
+
+    @property
+    def pool(self) -> "EmbeddingPool":
+        """
+        The worker pool, started with the model; started again if used after `close`.
+        """
+        if self._pool is None:
+            self._pool = self._start_pool()
+        return self._pool
+
+    def close(self) -> None:
+        """
+        Stops the worker pool, if any. It is also stopped when the interpreter exits.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
     @property
     def embed_function(self) -> EmbeddingFunction[Documents]:
         try:
             return SentenceTransformerEmbeddingFunction(model_name=self.name)
         except Exception as e:
             raise ValueError(f"Error embedding text with HF model: {e}")
+
+    @property
+    def export_dir(self) -> Path:
+        """
+        Directory of the model's ONNX export.
+        """
+        return Path(self.cache_dir) / "onnx" / re.sub(r"[^a-zA-Z0-9_.-]+", "--", self.name)
+
+    @property
+    def onnx_path(self) -> Path:
+        """
+        The ONNX model run by the backend, quantized or not.
+        """
+        return self.export_dir / ("model.int8.onnx" if self.quantize else "model.onnx")
+
+    def export(self) -> Path:
+        """
+        Exports the model to ONNX (and quantizes it, if set), unless already cached.
+        """
+        if self.onnx_path.exists():
+            return self.onnx_path
+
+        export_dir: Path = self.export_dir
+        export_dir.mkdir(parents=True, exist_ok=True)
+        fp32_path: Path = export_dir / "model.onnx"
+        if not fp32_path.exists():
+            console.log(f"Exporting {self.name} to ONNX in {export_dir}")
+            import torch
+
+            transformer: Any = self.model[0]
+            tokenizer: Any = transformer.tokenizer
+            sample: Dict[str, Any] = dict(
+                tokenizer(["an example sentence"], padding=True, return_tensors="pt")
+            )
+            names: List[str] = [
+                n for n in ("input_ids", "attention_mask", "token_type_ids") if n in sample
+            ]
+
+            class _Encoder(torch.nn.Module):
+                def __init__(self, model: Any) -> None:
+                    super().__init__()
+                    self.model = model
+
+                def forward(self, *inputs: Any) -> Any:
+                    return self.model(**dict(zip(names, inputs))).last_hidden_state
+
+            axes: Dict[str, Dict[int, str]] = {
+                n: {0: "batch", 1: "sequence"} for n in [*names, "last_hidden_state"]
+            }
+            tmp_path: Path = fp32_path.with_suffix(".tmp")
+            with torch.no_grad():
+                torch.onnx.export(
+                    _Encoder(transformer.auto_model).eval(),
+                    tuple(sample[n] for n in names),
+                    str(tmp_path),
+                    input_names=names,
+                    output_names=["last_hidden_state"],
+                    dynamic_axes=axes,
+                    opset_version=14,
+                )
+            tokenizer.save_pretrained(str(export_dir))
+            (export_dir / "pooling.json").write_text(
+                json.dumps(self._pooling_config()), encoding="utf-8"
+            )
+            tmp_path.replace(fp32_path)
+
+        if self.quantize:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            console.log(f"Quantizing {self.name} to int8")
+            tmp_path = self.onnx_path.with_suffix(".tmp")
+            quantize_dynamic(str(fp32_path), str(tmp_path), weight_type=QuantType.QInt8)
+            tmp_path.replace(self.onnx_path)
+        return self.onnx_path
+
+    def _pooling_config(self) -> Dict[str, Any]:
+        # how sentence-transformers turns token embeddings into a sentence embedding
+        config: Dict[str, Any] = {
+            "mode": "mean",
+            "normalize": False,
+            "max_length": min(self.max_tokens, self.model.max_seq_length or self.max_tokens),
+        }
+        for module in self.model:
+            if type(module).__name__ == "Pooling":
+                if module.pooling_mode_cls_token:
+                    config["mode"] = "cls"
+                elif module.pooling_mode_max_tokens:
+                    config["mode"] = "max"
+            elif type(module).__name__ == "Normalize":
+                config["normalize"] = True
+        return config
+
+    def _load_onnx(self) -> None:
+        if self._session is not None:
+            return
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError(
+                "The ONNX backend requires ONNX Runtime. Please install it using "
+                "`pip install frag[onnx]` (or `pip install onnxruntime onnx`)"
+            )
+        from transformers import AutoTokenizer
+
+        path: Path = self.export()
+        options = onnxruntime.SessionOptions()
+        if self.threads is not None:
+            options.intra_op_num_threads = self.threads
+        options.inter_op_num_threads = 1
+        self._session = onnxruntime.InferenceSession(
+            str(path), sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self._tokenizer = AutoTokenizer.from_pretrained(str(self.export_dir))
+        self._pooling = json.loads(
+            (self.export_dir / "pooling.json").read_text(encoding="utf-8")
+        )
+
+    def _embed_onnx(self, texts: List[str]) -> np.ndarray:
+        self._load_onnx()
+        encoded: Dict[str, np.ndarray] = dict(
+            self._tokenizer(
+                texts,
+                padding=True,
+                truncation=True,
+                max_length=self._pooling["max_length"],
+                return_tensors="np",
+            )
+        )
+        feed: Dict[str, np.ndarray] = {
+            i.name: encoded[i.name].astype(np.int64) for i in self._session.get_inputs()
+        }
+        tokens: np.ndarray = self._session.run(None, feed)[0]
+        mask: np.ndarray = encoded["attention_mask"][..., None].astype(tokens.dtype)
+        if self._pooling["mode"] == "cls":
+            vectors: np.ndarray = tokens[:, 0]
+        elif self._pooling["mode"] == "max":
+            vectors = np.where(mask > 0, tokens, -np.inf).max(axis=1)
+        else:
+            vectors = (tokens * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self._pooling["normalize"]:
+            vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors.astype(np.float32)
+
+    def _embed_array(self, texts: List[str]) -> np.ndarray:
+        # embeds in this process, whatever the workers
+        if self.backend == "onnx":
+            return self._embed_onnx(texts)
+        return self.model.encode(
+            texts, batch_size=self.embed_batch_size, convert_to_numpy=True
+        ).astype(np.float32)
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        if self.workers:
+            return self.pool.embed(texts).tolist()
+        return self._embed_array(texts).tolist()
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._get_text_embeddings([query])[0]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+
+def parity(model: HFEmbedAPI, texts: Sequence[str]) -> float:
+    """
+    Compares a model's ONNX embeddings with its PyTorch ones.
+
+    :return: The lowest cosine similarity between the two embeddings of a text.
+    """
+    reference: np.ndarray = np.asarray(
+        HFEmbedAPI(name=model.name, max_tokens=model.max_tokens).get_text_embedding_batch(
+            list(texts)
+        )
+    )
+    candidate: np.ndarray = np.asarray(model.get_text_embedding_batch(list(texts)))
+    similarities: np.ndarray = (reference * candidate).sum(axis=1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1)
+    )
+    return float(similarities.min())
+
+
+def benchmark(
+    models: Dict[str, HFEmbedAPI], texts: Sequence[str], rounds: int = 3
+) -> Dict[str, float]:
+    """
+    Measures the throughput of models, in texts per second, after a warm-up batch.
+
+    :param models: The models to compare, by label.
+    :param texts: The texts embedded in each round.
+    :param rounds: Rounds per model; the best one counts.
+    """
+    results: Dict[str, float] = {}
+    for label, model in models.items():
+        model.get_text_embedding_batch(list(texts[: model.embed_batch_size]))
+        best: float = float("inf")
+        for _ in range(rounds):
+            started: float = time.perf_counter()
+            model.get_text_embedding_batch(list(texts))
+            best = min(best, time.perf_counter() - started)
+        results[label] = len(texts) / best
+    return results
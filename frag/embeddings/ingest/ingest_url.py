@@ -32,6 +32,7 @@ class URLIngestor(BaseModel):
         """
         if isinstance(data, str):
             data = [data]
-        self.store.get_pipeline(self.pipeline_addons).run(
+        self.store.ingest(
             documents=BeautifulSoupWebReader().load_data(urls=data),
+            addons=self.pipeline_addons,
         )
@@ -0,0 +1,275 @@
+"""
+Sharded, resumable, multi-process ingestion.
+
+The input items (URLs or file paths) are split into shards, whose progress is checkpointed
+under `.frag/checkpoints/<job>/`. Worker processes load, parse and chunk the items; the parent
+deduplicates the chunks and links neighbours, then sends them back to the workers in batches to
+be embedded, at most `embed_rpm` batches a minute. The parent is the only process writing to
+the store: once an item's nodes are written, it is marked done in its shard's checkpoint, and a
+restarted job skips it. The checkpoints are deleted once every item is done; a job whose items
+or shard size changed since its checkpoints were written starts over.
+
+Document and node ids are derived from the item, so re-processing an item interrupted after its
+nodes were written overwrites them instead of duplicating them.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Any, Dict, List, Sequence, Set, Tuple
+
+from llama_index.core.schema import BaseNode, Document, MetadataMode, NodeRelationship
+from pydantic import BaseModel, ConfigDict, Field
+
+from frag.completions.scheduler import TokenBucket
+from frag.embeddings.neighbours import AdjacencyTransform
+from frag.embeddings.store import EmbeddingStore, make_node_parser
+from frag.settings.embed_settings import EmbedSettings
+from frag.utils.console import console, error_console
+
+_worker_settings: EmbedSettings | None = None
+
+
+def _stable_id(*parts: str) -> str:
+    return hashlib.sha1(":".join(parts).encode("utf-8")).hexdigest()
+
+
+def _init_worker(settings: Dict[str, Any]) -> None:
+    global _worker_settings
+    _worker_settings = EmbedSettings(**settings)
+
+
+def load_item(item: str) -> List[Document]:
+    """
+    Loads the documents of an item: a URL, a file or a directory.
+    """
+    if item.startswith("http://") or item.startswith("https://"):
+        from llama_index.readers.web import BeautifulSoupWebReader
+
+        return BeautifulSoupWebReader().load_data(urls=[item])
+
+    from llama_index.core import SimpleDirectoryReader
+
+    if Path(item).is_dir():
+        return SimpleDirectoryReader(input_dir=item, recursive=True).load_data()
+    return SimpleDirectoryReader(input_files=[item]).load_data()
+
+
+def _chunk_item(item: str) -> List[BaseNode]:
+    """
+    Worker: loads and chunks an item, with ids derived from the item.
+    """
+    assert _worker_settings is not None
+    documents: List[Document] = load_item(item)
+    for i, document in enumerate(documents):
+        document.id_ = _stable_id(item, str(i))
+
+    nodes: List[BaseNode] = make_node_parser(_worker_settings)(documents)
+    counters: Dict[str, int] = {}
+    ids: Dict[str, str] = {}
+    for node in nodes:
+        index: int = counters.get(node.ref_doc_id or "", 0)
+        counters[node.ref_doc_id or ""] = index + 1
+        ids[node.node_id] = _stable_id(node.ref_doc_id or item, str(index))
+    for node in nodes:
+        node.id_ = ids[node.node_id]
+        for relationship in (NodeRelationship.PREVIOUS, NodeRelationship.NEXT):
+            if (related := node.relationships.get(relationship)) is not None:
+                related.node_id = ids.get(related.node_id, related.node_id)
+    return nodes
+
+
+def _embed_texts(texts: List[str]) -> List[List[float]]:
+    """
+    Worker: embeds a batch of texts.
+    """
+    assert _worker_settings is not None
+    return _worker_settings.api.get_text_embedding_batch(texts)
+
+
+class Shard(BaseModel):
+    """
+    A shard's items and checkpoint.
+    """
+
+    index: int
+    items: List[str]
+    done: List[str] = Field(default_factory=list)
+
+
+class ShardedIngestor(BaseModel):
+    """
+    Ingests items across worker processes, checkpointing per shard.
+
+    Attributes:
+        store: The embedding store to write to.
+        workers: Number of worker processes.
+        shard_size: Items per shard.
+        job: Name of the job, used for the checkpoints directory; derived from the items and
+            the collection if not given, so that re-running the same command resumes it.
+    """
+
+    store: EmbeddingStore
+    workers: int = Field(default_factory=lambda: os.cpu_count() or 1)
+    shard_size: int = 16
+    job: str | None = None
+
+    model_config: ConfigDict = ConfigDict(arbitrary_types_allowed=True)
+
+    def _job_dir(self, items: Sequence[str]) -> Path:
+        job: str = self.job or _stable_id(self.store.collection_name, *sorted(items))[:12]
+        return self.store.settings.path / "checkpoints" / job
+
+    def _load_shards(self, job_dir: Path, items: Sequence[str]) -> List[Shard]:
+        expected: List[List[str]] = [
+            list(items[start : start + self.shard_size])
+            for start in range(0, len(items), self.shard_size)
+        ]
+        saved: List[Shard] = [
+            Shard(**json.loads(path.read_text(encoding="utf-8")))
+            for path in sorted(job_dir.glob("shard-*.json"))
+        ]
+        if saved and [shard.items for shard in saved] != expected:
+            # e.g. a named job run with other items, or another shard size
+            console.log(f"Ingestion job {job_dir.name} has other items: starting it over")
+            shutil.rmtree(job_dir)
+            saved = []
+        if saved:
+            return saved
+
+        job_dir.mkdir(parents=True, exist_ok=True)
+        shards: List[Shard] = [
+            Shard(index=index, items=shard_items) for index, shard_items in enumerate(expected)
+        ]
+        for shard in shards:
+            self._checkpoint(job_dir, shard)
+        return shards
+
+    @staticmethod
+    def _checkpoint(job_dir: Path, shard: Shard) -> None:
+        path: Path = job_dir / f"shard-{shard.index:05d}.json"
+        tmp_path: Path = path.with_suffix(".tmp")
+        tmp_path.write_text(shard.model_dump_json(), encoding="utf-8")
+        os.replace(tmp_path, path)
+
+    def _submit_embeddings(
+        self, pool: ProcessPoolExecutor, nodes: List[BaseNode], limiter: TokenBucket | None
+    ) -> List[Tuple[List[BaseNode], Future[List[List[float]]]]]:
+        batch_size: int = self.store.settings.embed_batch_size
+        batches: List[Tuple[List[BaseNode], Future[List[List[float]]]]] = []
+        for start in range(0, len(nodes), batch_size):
+            batch: List[BaseNode] = nodes[start : start + batch_size]
+            if limiter is not None:
+                time.sleep(limiter.delay(1))
+                limiter.take(1)
+            texts: List[str] = [n.get_content(metadata_mode=MetadataMode.EMBED) for n in batch]
+            batches.append((batch, pool.submit(_embed_texts, texts)))
+        return batches
+
+    def _prepare(self, nodes: List[BaseNode]) -> List[BaseNode]:
+        if self.store.deduplicator is not None:
+            self.store.deduplicator.forget({n.ref_doc_id or n.node_id for n in nodes})
+            nodes = self.store.deduplicator(nodes)
+        return AdjacencyTransform()(nodes)
+
+    def ingest(self, items: Sequence[str]) -> None:
+        """
+        Ingests the items, resuming the job if it was interrupted.
+        """
+        job_dir: Path = self._job_dir(items)
+        shards: List[Shard] = self._load_shards(job_dir, items)
+        queue: List[Tuple[Shard, str]] = [
+            (shard, item) for shard in shards for item in shard.items if item not in shard.done
+        ]
+        done_count: int = sum(len(shard.done) for shard in shards)
+        console.log(
+            f"Ingestion job {job_dir.name}: {len(queue)} items to go, "
+            f"{done_count} already done, {self.workers} workers"
+        )
+        if queue:
+            self._run(job_dir, queue, done_count, len(items))
+        if all(len(shard.done) == len(shard.items) for shard in shards):
+            shutil.rmtree(job_dir, ignore_errors=True)
+        else:
+            console.log(
+                f"Ingestion job {job_dir.name}: run it again to retry the failed items"
+            )
+
+    def _run(
+        self, job_dir: Path, queue: List[Tuple[Shard, str]], done_count: int, total: int
+    ) -> None:
+        """
+        Ingests the queued items, checkpointing their shards as they are written.
+        """
+        settings: EmbedSettings = self.store.settings
+        limiter: TokenBucket | None = (
+            TokenBucket(settings.embed_rpm) if settings.embed_rpm else None
+        )
+        queue.reverse()
+        with ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_worker,
+            # embed with the model the collection was built with, see CollectionRegistry
+            initargs=(
+                {
+                    **settings.model_dump(),
+                    "api_source": self.store.entry.api_source,
+                    "api_model": self.store.entry.api_model,
+                },
+            ),
+        ) as pool:
+            chunking: Dict[Future, Tuple[Shard, str]] = {}
+            embedding: Dict[Future, Tuple[Shard, str]] = {}
+            batches: Dict[str, List[Tuple[List[BaseNode], Future]]] = {}
+            while queue or chunking or embedding:
+                # keep the workers busy, without holding every item's nodes at once
+                while queue and len(chunking) + len(batches) < self.workers * 2:
+                    shard, item = queue.pop()
+                    chunking[pool.submit(_chunk_item, item)] = (shard, item)
+
+                ready: Set[Future]
+                ready, _ = wait([*chunking, *embedding], return_when=FIRST_COMPLETED)
+                for future in ready:
+                    if future in chunking:
+                        shard, item = chunking.pop(future)
+                        try:
+                            nodes: List[BaseNode] = self._prepare(future.result())
+                        except Exception as e:
+                            error_console.log(f"Failed to ingest {item}: {e}")
+                            continue
+                        batches[item] = self._submit_embeddings(pool, nodes, limiter)
+                        embedding.update({f: (shard, item) for _, f in batches[item]})
+                        if batches[item]:
+                            continue
+                    else:
+                        shard, item = embedding.pop(future)
+                        if item not in batches or any(
+                            not f.done() for _, f in batches[item]
+                        ):
+                            continue
+
+                    item_batches = batches.pop(item)
+                    try:
+                        written: int = 0
+                        started: float = time.time()
+                        for batch, batch_future in item_batches:
+                            for node, vector in zip(batch, batch_future.result()):
+                                node.embedding = vector
+                            written += len(self.store.add_nodes(batch))
+                        # an item ingested again replaces its earlier nodes
+                        self.store.retire_superseded(
+                            [node for batch, _ in item_batches for node in batch], started
+                        )
+                    except Exception as e:
+                        error_console.log(f"Failed to ingest {item}: {e}")
+                        for _, batch_future in item_batches:
+                            embedding.pop(batch_future, None)
+                        continue
+                    shard.done.append(item)
+                    self._checkpoint(job_dir, shard)
+                    done_count += 1
+                    console.log(f"[{done_count}/{total}] {item}: {written} nodes")
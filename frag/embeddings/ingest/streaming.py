@@ -0,0 +1,233 @@
+"""
+Streaming ingestion of large files, in bounded memory.
+
+The readers here are generators: they read their file line by line and yield one `Document`
+at a time, so that a dump never has to fit in memory. `StreamIngestor` feeds them to the
+store in fixed-size windows (see `EmbeddingStore.ingest_stream`).
+
+- JSONL (optionally gzipped): one document per record;
+- Markdown: one document per section, split at headings (outside fenced code) with `marko`'s
+  grammar, and at paragraph boundaries when a section grows past `max_section_chars`.
+"""
+
+import gzip
+import hashlib
+import json
+from pathlib import Path
+from typing import IO, Any, Dict, Iterable, Iterator, List, Sequence
+
+from llama_index.core.schema import Document
+from marko import Markdown
+from marko.block import FencedCode, Heading
+from pydantic import BaseModel, ConfigDict
+
+from frag.embeddings.metadata_index import SOURCE_KEY
+from frag.embeddings.store import AddOns, EmbeddingStore
+from frag.utils.console import console, error_console
+
+JSONL_SUFFIXES: List[str] = [".jsonl", ".ndjson"]
+MARKDOWN_SUFFIXES: List[str] = [".md", ".markdown"]
+
+
+def _stable_id(*parts: str) -> str:
+    return hashlib.sha1(":".join(parts).encode("utf-8")).hexdigest()
+
+
+def _open(path: Path) -> IO[str]:
+    if path.suffix == ".gz":
+        return gzip.open(path, "rt", encoding="utf-8")
+    return path.open("r", encoding="utf-8")
+
+
+def _suffix(path: Path) -> str:
+    return path.with_suffix("").suffix if path.suffix == ".gz" else path.suffix
+
+
+def is_streamable(path: str | Path) -> bool:
+    """
+    Whether a file has a streaming reader.
+    """
+    return _suffix(Path(path)).lower() in JSONL_SUFFIXES + MARKDOWN_SUFFIXES
+
+
+def _metadata_value(value: Any) -> str | int | float | bool | None:
+    # chroma only stores flat metadata
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return json.dumps(value, ensure_ascii=False)
+
+
+def iter_jsonl(
+    path: str | Path,
+    text_key: str = "text",
+    id_key: str | None = None,
+    metadata_keys: Sequence[str] | None = None,
+) -> Iterator[Document]:
+    """
+    Reads a JSONL file (or a gzipped one), one document per record.
+
+    :param path: The file.
+    :param text_key: The field holding the text.
+    :param id_key: The field holding the document id; by default, ids are derived from the
+        file and line number, so that re-ingesting the file replaces its documents.
+    :param metadata_keys: The fields kept as metadata; all other fields by default. The file and
+        line number are added, as `frag_source` and `line`.
+    :return: The documents; malformed records and records without text are skipped.
+    """
+    path = Path(path)
+    with _open(path) as file:
+        for number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            try:
+                record: Any = json.loads(line)
+            except json.JSONDecodeError as e:
+                error_console.log(f"{path}:{number}: skipping malformed record: {e}")
+                continue
+            if not isinstance(record, dict) or not isinstance(record.get(text_key), str):
+                error_console.log(f"{path}:{number}: skipping record without {text_key!r}")
+                continue
+
+            keys: Iterable[str] = (
+                metadata_keys
+                if metadata_keys is not None
+                else (k for k in record if k not in (text_key, id_key))
+            )
+            metadata: Dict[str, Any] = {
+                key: value
+                for key in keys
+                if (value := _metadata_value(record.get(key))) is not None
+            }
+            metadata.update({SOURCE_KEY: str(path), "line": number})
+            doc_id: str = (
+                str(record[id_key])
+                if id_key is not None and record.get(id_key) is not None
+                else _stable_id(str(path), str(number))
+            )
+            yield Document(id_=doc_id, text=record[text_key], metadata=metadata)
+
+
+def _plain_text(element: Any) -> str:
+    children: Any = getattr(element, "children", "")
+    if isinstance(children, str):
+        return children
+    return "".join(_plain_text(child) for child in children)
+
+
+def iter_markdown(path: str | Path, max_section_chars: int = 8000) -> Iterator[Document]:
+    """
+    Reads a Markdown file, one document per section.
+
+    Each document's metadata holds the file (`frag_source`), its heading (`title`), the path of
+    headings leading to it (`section`) and its first line (`line`).
+
+    :param path: The file.
+    :param max_section_chars: Sections longer than this are split at the next blank line, or at
+        the next line if they reach twice this size.
+    """
+    path = Path(path)
+    markdown: Markdown = Markdown()
+    headings: List[str] = []
+    lines: List[str] = []
+    size: int = 0
+    start: int = 1
+    part: int = 0
+    fence: str | None = None
+
+    def section() -> Document:
+        title: str = headings[-1] if headings else path.stem
+        return Document(
+            id_=_stable_id(str(path), str(start)),
+            text="".join(lines),
+            metadata={
+                SOURCE_KEY: str(path),
+                "title": title,
+                "section": " > ".join(h for h in headings if h) or title,
+                "line": start,
+                "section_part": part,
+            },
+        )
+
+    with _open(path) as file:
+        for number, line in enumerate(file, start=1):
+            heading = None
+            if fence is not None:
+                stripped: str = line.strip()
+                if stripped.startswith(fence) and not stripped.strip(fence[0]):
+                    fence = None
+            elif match := FencedCode.pattern.match(line):
+                fence = match.group(2)
+            else:
+                heading = Heading.pattern.match(line)
+
+            blank: bool = fence is None and not line.strip()
+            if heading is not None or (
+                size >= max_section_chars and (blank or size >= 2 * max_section_chars)
+            ):
+                if "".join(lines).strip():
+                    yield section()
+                    part += 1
+                lines, size, start = [], 0, number
+
+            if heading is not None:
+                level: int = len(heading.group(1))
+                del headings[level - 1 :]
+                headings.extend([""] * (level - 1 - len(headings)))
+                headings.append(_plain_text(markdown.parse(line).children[0]).strip())
+                part = 0
+            lines.append(line)
+            size += len(line)
+
+        if "".join(lines).strip():
+            yield section()
+
+
+class StreamIngestor(BaseModel):
+    """
+    Ingests JSONL and Markdown files into the embedding store, in bounded memory.
+
+    Attributes:
+        store: The embedding store to write to.
+        window: Documents run through the pipeline at a time.
+        text_key: For JSONL, the field holding the text.
+        id_key: For JSONL, the field holding the document id, if any.
+        max_section_chars: For Markdown, the size past which sections are split.
+    """
+
+    store: EmbeddingStore
+    window: int = 256
+    text_key: str = "text"
+    id_key: str | None = None
+    max_section_chars: int = 8000
+
+    model_config: ConfigDict = ConfigDict(arbitrary_types_allowed=True)
+
+    @property
+    def pipeline_addons(self) -> AddOns:
+        return {
+            "extractors": [],
+            "preprocessors": [],
+        }
+
+    def read(self, path: str | Path) -> Iterator[Document]:
+        """
+        Streams the documents of a file, with the reader matching its extension.
+        """
+        suffix: str = _suffix(Path(path)).lower()
+        if suffix in JSONL_SUFFIXES:
+            return iter_jsonl(path, text_key=self.text_key, id_key=self.id_key)
+        if suffix in MARKDOWN_SUFFIXES:
+            return iter_markdown(path, max_section_chars=self.max_section_chars)
+        raise ValueError(f"No streaming reader for {path}")
+
+    def ingest(self, paths: List[str] | str) -> None:
+        """
+        Ingests the files into the embedding store.
+        """
+        if isinstance(paths, str):
+            paths = [paths]
+        for path in paths:
+            count: int = self.store.ingest_stream(
+                self.read(path), addons=self.pipeline_addons, window=self.window
+            )
+            console.log(f"{path}: {count} nodes")
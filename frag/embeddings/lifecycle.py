@@ -0,0 +1,131 @@
+"""
+Lifecycle of the documents in the store: expiry, and garbage collection.
+
+Ingesting a source (a URL or a path) again replaces the nodes ingested from it before, see
+`EmbeddingStore.retire_superseded`. Nodes can also be given a time to live, with the `ttl_days`
+setting or per ingestion; the metadata index records when each node expires.
+
+`collect_garbage` deletes, in one pass:
+- the expired nodes, from the collection, its indexes and the caches;
+- the orphaned index entries (deduplication index included), whose records are no longer in
+  the collection, e.g. after an interrupted write;
+- the orphaned records, which the metadata index does not know about (every write indexes the
+  records it adds), e.g. written by an interrupted ingestion, or before the store tracked
+  sources.
+
+An ingestion running meanwhile, in another process, writes records before indexing them: they
+would look orphaned. Records missing from the indexes are therefore only deleted once found so
+by a collection at least `grace` seconds earlier (an hour by default), and kept if indexed
+since; the metadata index remembers when each was first found.
+
+The docstore is kept in memory, by each process, for the documents it ingested: the records
+of other processes, orphaned ones included, are not in it, and there is nothing to delete
+there.
+
+It also deletes the collections retired by the last compaction, see `drop_retired`, then
+vacuums the store's SQLite databases, and measures the store before and after. Chroma's
+vector index keeps deleted vectors until the collection is rebuilt: `frag store:compact` (or
+`store:gc --compact`) reclaims that space too.
+"""
+
+import time
+from typing import Dict, List, Set
+
+from pydantic import BaseModel
+
+from frag.utils.console import console
+from .compact import directory_size, drop_retired, vacuum
+from .reembed import _all_ids
+from .store import EmbeddingStore
+
+
+class GCReport(BaseModel):
+    """
+    The effect of a garbage collection. Sizes are in bytes.
+    """
+
+    collection: str
+    expired: int
+    orphaned: int
+    unindexed: int
+    pending: int
+    records: int
+    size_before: int
+    size_after: int
+
+    @property
+    def reclaimed(self) -> int:
+        return max(0, self.size_before - self.size_after)
+
+
+def collect_garbage(
+    store: EmbeddingStore,
+    collection_name: str | None = None,
+    now: float | None = None,
+    batch_size: int = 1000,
+    grace: float = 3600.0,
+) -> GCReport:
+    """
+    Deletes the expired nodes of a collection, the orphaned entries of its indexes, and its
+    records missing from them.
+
+    :param store: The store.
+    :param collection_name: The logical collection; defaults to the store's.
+    :param now: The time to expire nodes at, as a timestamp; defaults to now.
+    :param batch_size: Records read at a time.
+    :param grace: Seconds a record must have been missing from the indexes, according to
+        earlier collections, to be deleted; 0 deletes them right away, which is only safe while
+        no other process writes to the collection.
+    """
+    store._check_writable()
+    name: str = collection_name or store.collection_name
+    if name != store.collection_name:
+        store.change_collection(name)
+    if store.entry.migration is not None:
+        raise ValueError(f"{name} is being re-embedded: collect it once the migration is over")
+    size_before: int = directory_size(store.settings.path)
+    drop_retired(store, name)
+
+    now = time.time() if now is None else now
+    expired: List[str] = store.metadata.expired(now)
+    store.delete_nodes(expired)
+    console.log(f"Deleted {len(expired)} expired nodes from {name}")
+
+    # records are written before their index entries: the entries read before the records are
+    # orphaned if their record is missing, and the records are if still not indexed afterwards
+    indexed: Set[str] = store.metadata.ids() | store.sparse.ids()
+    records: Set[str] = _all_ids(store.collection, batch_size)
+    orphaned: Set[str] = indexed - records
+    if orphaned:
+        store.sparse.delete(list(orphaned))
+        store.metadata.delete(list(orphaned))
+    if store.deduplicator is not None:
+        store.deduplicator.discard(store.deduplicator.ids() - records)
+    console.log(f"Dropped {len(orphaned)} orphaned index entries of {name}")
+    sightings: Dict[str, float] = store.metadata.sight_unindexed(
+        records - store.metadata.ids(), now
+    )
+    unindexed: List[str] = [
+        node_id for node_id, seen_at in sightings.items() if seen_at <= now - grace
+    ]
+    store.delete_nodes(unindexed)
+    console.log(f"Deleted {len(unindexed)} records of {name} missing from its indexes")
+    if pending := len(sightings) - len(unindexed):
+        console.log(
+            f"Kept {pending} records of {name} missing from its indexes for now, in case they "
+            "are being written: the next collection deletes them once the grace period is over"
+        )
+
+    if store.retrieval_cache is not None:
+        store.retrieval_cache.clear()
+    vacuum(store, name)
+    return GCReport(
+        collection=name,
+        expired=len(expired),
+        orphaned=len(orphaned),
+        unindexed=len(unindexed),
+        pending=pending,
+        records=len(records) - len(unindexed),
+        size_before=size_before,
+        size_after=directory_size(store.settings.path),
+    )
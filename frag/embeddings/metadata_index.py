@@ -0,0 +1,447 @@
+"""
+Secondary index of the nodes' document metadata, kept alongside each collection, for filtered
+retrieval.
+
+Filtering on `DocMeta` fields ("documents by X, published after 2024") would otherwise mean
+reading the metadata of every record. `MetadataIndex`, in SQLite under `.frag/metadata/`, is
+updated whenever the store writes nodes, and holds:
+- the publish dates, in a sorted index, for date ranges;
+- the values of `author`, `url` and of the selected extra keys, in an index on `(key, value)`,
+  for equality lookups;
+- the source of each node (see `source_key`), when it was written and when it expires, for the
+  store's lifecycle management (see `frag.embeddings.lifecycle`).
+
+`MetadataIndex.candidates` answers a `MetadataFilter` with the set of ids of the nodes
+matching it, which the store then searches by vector and keyword only.
+"""
+
+import hashlib
+import sqlite3
+import time
+from datetime import date, datetime, timezone
+from pathlib import Path
+from threading import Lock
+from typing import Any, Dict, Iterable, List, Sequence, Set, Tuple
+
+from llama_index.core.schema import BaseNode
+from pydantic import BaseModel, ConfigDict, Field
+
+from frag.utils.console import console
+
+Scalar = str | int | float | date
+
+INDEXED_KEYS: Tuple[str, ...] = ("author", "url")
+# where frag's own readers record the file a document comes from
+SOURCE_KEY: str = "frag_source"
+# where readers record where a document comes from: frag's, web readers, directory readers
+SOURCE_KEYS: Tuple[str, ...] = (SOURCE_KEY, "url", "file_path")
+
+
+def normalise_date(value: Any) -> str | None:
+    """
+    Converts a publish date (a date, a datetime, or an ISO 8601 string) to a sortable ISO
+    string, in UTC for aware datetimes; None for anything else, e.g. "March 3, 2024".
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.isoformat(timespec="seconds")
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day).isoformat(timespec="seconds")
+    return None
+
+
+def source_key(node: BaseNode) -> str:
+    """
+    The source of a node: the file, URL or path of its document, as its reader recorded it,
+    or else the document's id. Other metadata, e.g. a `source` field of the document itself,
+    is not trusted to name where the document was read from.
+    """
+    for key in SOURCE_KEYS:
+        if value := node.metadata.get(key):
+            return str(value)
+    return node.ref_doc_id or node.node_id
+
+
+def _value(value: Scalar) -> str:
+    if isinstance(value, date):
+        return normalise_date(value)  # type: ignore[return-value]
+    return str(value)
+
+
+class MetadataFilter(BaseModel):
+    """
+    Conditions on the nodes' document metadata; a node matches if it meets all of them.
+    A list of values matches any of them.
+    """
+
+    model_config = ConfigDict(frozen=True)
+
+    author: str | List[str] | None = Field(None, description="Author of the document")
+    url: str | List[str] | None = Field(None, description="URL of the document")
+    published_after: datetime | date | None = Field(
+        None, description="Earliest publish date, included"
+    )
+    published_before: datetime | date | None = Field(
+        None, description="Latest publish date, excluded"
+    )
+    extra: Dict[str, Scalar | List[Scalar]] = Field(
+        default_factory=dict, description="Values of indexed extra metadata keys"
+    )
+
+    @property
+    def key(self) -> str:
+        """
+        Identifies the filter, e.g. to scope cached results.
+        """
+        return hashlib.sha1(
+            self.model_dump_json(exclude_defaults=True).encode("utf-8")
+        ).hexdigest()
+
+    def terms(self) -> Dict[str, List[str]]:
+        """
+        The equality conditions, as the index stores them.
+        """
+        terms: Dict[str, List[str]] = {}
+        for key, values in (
+            ("author", self.author),
+            ("url", self.url),
+            *self.extra.items(),
+        ):
+            if values is not None:
+                terms[key] = [
+                    _value(v) for v in (values if isinstance(values, list) else [values])
+                ]
+        return terms
+
+
+class MetadataIndex:
+    """
+    An index of a collection's nodes by publish date and metadata values.
+
+    :param path: The SQLite database file.
+    :param keys: Extra metadata keys to index, besides `author` and `url`.
+    :param read_only: Open an existing index that never changes, e.g. a published snapshot's,
+        for lookups only, without taking any locks.
+    """
+
+    def __init__(
+        self, path: Path, keys: Sequence[str] = (), read_only: bool = False
+    ) -> None:
+        self.path: Path = path
+        self.keys: Tuple[str, ...] = tuple(dict.fromkeys((*INDEXED_KEYS, *keys)))
+        # publish dates indexed as unknown, as `normalise_date` could not read them
+        self.unparsed_dates: int = 0
+        self._lock: Lock = Lock()
+        if read_only:
+            self._db: sqlite3.Connection = sqlite3.connect(
+                f"{path.resolve().as_uri()}?mode=ro&immutable=1", uri=True, check_same_thread=False
+            )
+            # the keys indexed by the process that wrote it
+            self.keys += tuple(
+                key
+                for (key,) in self._db.execute("SELECT DISTINCT key FROM terms")
+                if key not in self.keys
+            )
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        columns: Set[str] = {row[1] for row in self._db.execute("PRAGMA table_info(nodes)")}
+        if columns and "expires_at" not in columns:
+            # written before lifecycle tracking: emptied, and rebuilt by the store
+            self._db.executescript("DROP TABLE nodes; DROP TABLE terms;")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS nodes (
+                node_id TEXT PRIMARY KEY, ref_doc_id TEXT, publish_date TEXT,
+                source TEXT, ingested_at REAL, expires_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS nodes_ref ON nodes (ref_doc_id);
+            CREATE INDEX IF NOT EXISTS nodes_date ON nodes (publish_date);
+            CREATE INDEX IF NOT EXISTS nodes_source ON nodes (source);
+            CREATE INDEX IF NOT EXISTS nodes_expiry ON nodes (expires_at);
+            CREATE TABLE IF NOT EXISTS terms (
+                key TEXT, value TEXT, node_id TEXT, PRIMARY KEY (key, value, node_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS terms_node ON terms (node_id);
+            CREATE TABLE IF NOT EXISTS unindexed (node_id TEXT PRIMARY KEY, seen_at REAL);
+            """
+        )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+
+    def _metadata(self, node: BaseNode) -> Dict[str, Any]:
+        # extra metadata is either flattened into the node's metadata, or nested as in DocMeta
+        metadata: Dict[str, Any] = dict(node.metadata)
+        nested: Any = metadata.pop("extra_metadata", None)
+        if isinstance(nested, dict):
+            metadata = {**nested, **metadata}
+        return metadata
+
+    def _delete(self, node_ids: Sequence[str]) -> None:
+        for start in range(0, len(node_ids), 500):
+            batch: Sequence[str] = node_ids[start : start + 500]
+            marks: str = ",".join("?" * len(batch))
+            self._db.execute(f"DELETE FROM terms WHERE node_id IN ({marks})", batch)
+            self._db.execute(f"DELETE FROM nodes WHERE node_id IN ({marks})", batch)
+
+    def add(
+        self,
+        nodes: Iterable[BaseNode],
+        ingested_at: float | None = None,
+        expires_at: float | None = None,
+    ) -> None:
+        """
+        Indexes nodes, replacing those already indexed with the same ids.
+
+        :param ingested_at: When the nodes were written, as a timestamp; unknown if None.
+        :param expires_at: When the nodes expire, as a timestamp; never if None.
+        """
+        rows: List[Tuple[str, str, str | None, str, float | None, float | None]] = []
+        terms: List[Tuple[str, str, str]] = []
+        unparsed: List[Any] = []
+        for node in nodes:
+            metadata: Dict[str, Any] = self._metadata(node)
+            publish_date: str | None = normalise_date(metadata.get("publish_date"))
+            if publish_date is None and metadata.get("publish_date") not in (None, ""):
+                unparsed.append(metadata["publish_date"])
+            rows.append(
+                (
+                    node.node_id,
+                    node.ref_doc_id or "",
+                    publish_date,
+                    source_key(node),
+                    ingested_at,
+                    expires_at,
+                )
+            )
+            terms.extend(
+                (key, _value(metadata[key]), node.node_id)
+                for key in self.keys
+                if metadata.get(key) not in (None, "")
+            )
+        with self._lock, self._db:
+            self._delete([row[0] for row in rows])
+            self._db.executemany("INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._db.executemany("INSERT OR IGNORE INTO terms VALUES (?, ?, ?)", terms)
+        if unparsed:
+            self.unparsed_dates += len(unparsed)
+            console.log(
+                f"{len(unparsed)} publish dates are not ISO 8601 (e.g. {unparsed[0]!r}): "
+                "these nodes never match a date filter"
+            )
+
+    def delete(self, node_ids: Sequence[str]) -> Set[str]:
+        """
+        Removes nodes from the index.
+
+        :return: The ids of the documents left without nodes.
+        """
+        node_ids = list(node_ids)
+        with self._lock, self._db:
+            documents: Set[str] = set()
+            for start in range(0, len(node_ids), 500):
+                batch: List[str] = node_ids[start : start + 500]
+                documents.update(
+                    row[0]
+                    for row in self._db.execute(
+                        "SELECT DISTINCT ref_doc_id FROM nodes WHERE node_id IN "
+                        f"({','.join('?' * len(batch))})",
+                        batch,
+                    )
+                )
+            self._delete(node_ids)
+            remaining: Set[str] = set()
+            batches: List[str] = list(documents)
+            for start in range(0, len(batches), 500):
+                batch = batches[start : start + 500]
+                remaining.update(
+                    row[0]
+                    for row in self._db.execute(
+                        "SELECT DISTINCT ref_doc_id FROM nodes WHERE ref_doc_id IN "
+                        f"({','.join('?' * len(batch))})",
+                        batch,
+                    )
+                )
+        return documents - remaining - {""}
+
+    def delete_documents(self, ref_doc_ids: Iterable[str]) -> None:
+        """
+        Removes every node of the given source documents.
+        """
+        ref_doc_ids = list(ref_doc_ids)
+        with self._lock, self._db:
+            node_ids: List[str] = []
+            for start in range(0, len(ref_doc_ids), 500):
+                batch: List[str] = ref_doc_ids[start : start + 500]
+                node_ids.extend(
+                    row[0]
+                    for row in self._db.execute(
+                        "SELECT node_id FROM nodes WHERE ref_doc_id IN "
+                        f"({','.join('?' * len(batch))})",
+                        batch,
+                    )
+                )
+            self._delete(node_ids)
+
+    def ids(self) -> Set[str]:
+        """
+        The ids of the nodes indexed.
+        """
+        with self._lock:
+            return {row[0] for row in self._db.execute("SELECT node_id FROM nodes")}
+
+    def sight_unindexed(self, node_ids: Iterable[str], now: float) -> Dict[str, float]:
+        """
+        Records the nodes found in the collection but missing from the index, replacing those
+        recorded before.
+
+        :param now: When they were found, as a timestamp.
+        :return: When each of them was first found missing.
+        """
+        with self._lock, self._db:
+            seen: Dict[str, float] = dict(
+                self._db.execute("SELECT node_id, seen_at FROM unindexed").fetchall()
+            )
+            sightings: Dict[str, float] = {
+                node_id: seen.get(node_id, now) for node_id in node_ids
+            }
+            self._db.execute("DELETE FROM unindexed")
+            self._db.executemany("INSERT INTO unindexed VALUES (?, ?)", sightings.items())
+        return sightings
+
+    def superseded(
+        self,
+        sources: Iterable[str],
+        keep: Iterable[str],
+        since: float,
+        documents: Iterable[str] = (),
+    ) -> List[str]:
+        """
+        Returns the nodes of the given sources or documents written before `since` (or at an
+        unknown time), except those of the documents to keep: what a new ingestion of the
+        sources replaces.
+        """
+        kept: Set[str] = set(keep)
+        stale: Dict[str, None] = {}
+        with self._lock:
+            for column, values in (("source", list(sources)), ("ref_doc_id", list(documents))):
+                for start in range(0, len(values), 500):
+                    batch: List[str] = values[start : start + 500]
+                    stale.update(
+                        (node_id, None)
+                        for node_id, ref_doc_id in self._db.execute(
+                            f"SELECT node_id, ref_doc_id FROM nodes WHERE {column} IN "
+                            f"({','.join('?' * len(batch))}) "
+                            "AND (ingested_at IS NULL OR ingested_at < ?)",
+                            (*batch, since),
+                        )
+                        if ref_doc_id not in kept
+                    )
+        return list(stale)
+
+    def expired(self, now: float | None = None) -> List[str]:
+        """
+        Returns the nodes expired by now.
+        """
+        with self._lock:
+            return [
+                row[0]
+                for row in self._db.execute(
+                    "SELECT node_id FROM nodes WHERE expires_at <= ?",
+                    (time.time() if now is None else now,),
+                )
+            ]
+
+    def clear(self) -> None:
+        """
+        Empties the index.
+        """
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM terms")
+            self._db.execute("DELETE FROM nodes")
+            self._db.execute("DELETE FROM unindexed")
+
+    def close(self) -> None:
+        """
+        Closes the database connection.
+        """
+        with self._lock:
+            self._db.close()
+
+    def candidates(self, filters: MetadataFilter) -> Set[str]:
+        """
+        Returns the ids of the nodes matching a filter.
+        """
+        terms: Dict[str, List[str]] = filters.terms()
+        if unindexed := set(terms) - set(self.keys):
+            raise ValueError(
+                f"Metadata keys not indexed: {', '.join(sorted(unindexed))}; "
+                "add them to the `metadata_index_keys` setting"
+            )
+        after: str | None = normalise_date(filters.published_after)
+        before: str | None = normalise_date(filters.published_before)
+        dates: Tuple[str, List[str]] | None = None
+        if after is not None or before is not None:
+            # ISO strings sort as dates do, and "~" after any of them
+            dates = ("publish_date >= ? AND publish_date < ?", [after or "", before or "~"])
+        with self._lock:
+            # the most selective condition picks the nodes, through its index; the others are
+            # checked node by node, through the primary keys
+            sizes: List[Tuple[int, str | None]] = [
+                (
+                    self._db.execute(
+                        "SELECT COUNT(*) FROM terms WHERE key = ? AND value IN "
+                        f"({','.join('?' * len(values))})",
+                        (key, *values),
+                    ).fetchone()[0],
+                    key,
+                )
+                for key, values in terms.items()
+            ]
+            if dates is not None:
+                sizes.append(
+                    (
+                        self._db.execute(
+                            f"SELECT COUNT(*) FROM nodes WHERE {dates[0]}", dates[1]
+                        ).fetchone()[0],
+                        None,
+                    )
+                )
+            if any(size == 0 for size, _ in sizes):
+                return set()
+            driver: str | None = min(sizes, key=lambda s: s[0])[1] if sizes else None
+
+            query: str = "SELECT n.node_id FROM nodes n"
+            conditions: List[str] = []
+            parameters: List[str] = []
+            if driver is not None:
+                query = (
+                    "SELECT n.node_id FROM terms t JOIN nodes n ON n.node_id = t.node_id"
+                )
+                conditions.append(
+                    f"t.key = ? AND t.value IN ({','.join('?' * len(terms[driver]))})"
+                )
+                parameters.extend((driver, *terms[driver]))
+            if dates is not None:
+                conditions.append(dates[0])
+                parameters.extend(dates[1])
+            for key, values in terms.items():
+                if key != driver:
+                    conditions.append(
+                        "EXISTS (SELECT 1 FROM terms WHERE key = ? AND value IN "
+                        f"({','.join('?' * len(values))}) AND node_id = n.node_id)"
+                    )
+                    parameters.extend((key, *values))
+            if conditions:
+                query += f" WHERE {' AND '.join(conditions)}"
+            return {row[0] for row in self._db.execute(query, parameters)}
@@ -0,0 +1,149 @@
+"""
+Chunk adjacency.
+
+At ingestion time, `AdjacencyTransform` records, for every chunk, its position in the source
+document (`part`/`parts`, as in `RecordMeta`) and the ids of the previous and next chunk.
+
+At retrieval time, `merge_neighbours` groups hits that are adjacent or overlapping in the same
+source document into a single `Document`, so that each run of chunks costs a single archivist
+call.
+"""
+
+from typing import Dict, List, Sequence
+
+from llama_index.core.schema import (
+    BaseNode,
+    Document,
+    MetadataMode,
+    NodeWithScore,
+    TransformComponent,
+)
+
+ADJACENCY_KEYS: List[str] = ["part", "parts", "prev_id", "next_id"]
+
+
+class AdjacencyTransform(TransformComponent):
+    """
+    Stores part/parts and prev_id/next_id in each node's metadata.
+
+    It must run after any transform that drops nodes, so that the chain only links chunks that
+    actually reach the store.
+    """
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "AdjacencyTransform"
+
+    def __call__(self, nodes: Sequence[BaseNode], **kwargs: object) -> List[BaseNode]:
+        by_doc: Dict[str, List[BaseNode]] = {}
+        for node in nodes:
+            by_doc.setdefault(node.ref_doc_id or node.node_id, []).append(node)
+
+        for doc_nodes in by_doc.values():
+            for i, node in enumerate(doc_nodes):
+                node.metadata.update(
+                    {
+                        "part": i + 1,
+                        "parts": len(doc_nodes),
+                        # chroma does not accept None as a metadata value
+                        "prev_id": doc_nodes[i - 1].node_id if i > 0 else "",
+                        "next_id": (
+                            doc_nodes[i + 1].node_id if i + 1 < len(doc_nodes) else ""
+                        ),
+                    }
+                )
+                for keys in (
+                    node.excluded_embed_metadata_keys,
+                    node.excluded_llm_metadata_keys,
+                ):
+                    keys.extend(k for k in ADJACENCY_KEYS if k not in keys)
+        return list(nodes)
+
+
+def _join(left: str, right: str, overlap: int = 0, min_overlap: int = 16) -> str:
+    """
+    Concatenate two chunks, removing the text they share if they were split with an overlap.
+
+    :param overlap: The chunk overlap the chunks were split with, in tokens; without one,
+        adjacent chunks share no text, and are joined as they are.
+    :param min_overlap: The shortest shared text, in characters, taken for an overlap rather
+        than a coincidence (e.g. a code fence closing one chunk and opening the next).
+    """
+    if overlap > 0:
+        # a token is rarely longer than 8 characters
+        longest: int = min(len(left), len(right), overlap * 8)
+        for size in range(longest, min_overlap - 1, -1):
+            if left.endswith(right[:size]):
+                return left + right[size:]
+    return f"{left}\n{right}"
+
+
+def _to_document(run: List[NodeWithScore], overlap: int = 0) -> Document:
+    first: BaseNode = run[0].node
+    last: BaseNode = run[-1].node
+    text: str = first.get_content(metadata_mode=MetadataMode.NONE)
+    for hit in run[1:]:
+        text = _join(text, hit.node.get_content(metadata_mode=MetadataMode.NONE), overlap)
+
+    metadata: Dict[str, object] = {
+        k: v for k, v in first.metadata.items() if k not in ADJACENCY_KEYS
+    }
+    ref_doc_id: str = first.ref_doc_id or first.node_id
+    metadata.update(
+        {
+            "ref_doc_id": ref_doc_id,
+            "node_ids": [hit.node.node_id for hit in run],
+            "part": first.metadata.get("part", 1),
+            "last_part": last.metadata.get("part", 1),
+            "parts": first.metadata.get("parts", 1),
+            "score": max(hit.score or 0.0 for hit in run),
+        }
+    )
+    return Document(
+        doc_id=(
+            first.node_id
+            if len(run) == 1
+            else f"{ref_doc_id}:{metadata['part']}-{metadata['last_part']}"
+        ),
+        text=text,
+        metadata=metadata,
+    )
+
+
+def merge_neighbours(hits: Sequence[NodeWithScore], overlap: int = 0) -> List[Document]:
+    """
+    Merge adjacent or overlapping hits from the same source document.
+
+    Hits without adjacency metadata (ingested before it was recorded) are kept as they are.
+
+    Args:
+        hits (Sequence[NodeWithScore]): The retrieved nodes, possibly expanded to their
+            neighbours.
+        overlap (int): The chunk overlap the collection was split with, in tokens.
+
+    Returns:
+        List[Document]: One document per run of adjacent chunks, best score first.
+    """
+    by_doc: Dict[str, Dict[int, NodeWithScore]] = {}
+    documents: List[Document] = []
+    for hit in hits:
+        part: object = hit.node.metadata.get("part")
+        if not isinstance(part, int):
+            documents.append(_to_document([hit]))
+            continue
+        parts: Dict[int, NodeWithScore] = by_doc.setdefault(
+            hit.node.ref_doc_id or hit.node.node_id, {}
+        )
+        if part not in parts or (hit.score or 0.0) > (parts[part].score or 0.0):
+            parts[part] = hit
+
+    for parts in by_doc.values():
+        run: List[NodeWithScore] = []
+        for part in sorted(parts):
+            if run and part != run[-1].node.metadata["part"] + 1:
+                documents.append(_to_document(run, overlap))
+                run = []
+            run.append(parts[part])
+        documents.append(_to_document(run, overlap))
+
+    return sorted(documents, key=lambda d: d.metadata["score"], reverse=True)
@@ -0,0 +1,245 @@
+"""
+Re-embedding of a collection with a new embedding model, without downtime.
+
+`ReembedJob` copies the records of a collection into a shadow collection, re-embedding the
+stored node text with the model named in the settings, in batches of ids taken in sorted order.
+After each batch, the last id copied is checkpointed in the collections registry, so an
+interrupted job resumes where it stopped. While it runs, `EmbeddingStore.retrieve` reads from
+both collections.
+
+Writers keep writing to the source collection meanwhile, from any process. Once every record
+is copied, catch-up passes compare the two collections record by record: the records added, or
+re-ingested with another text or metadata, are copied again, and the records deleted are
+deleted from the shadow collection. Passes repeat until one finds nothing to change (or
+`catch_up_passes` ran), then the registry entry is switched to the shadow collection in a
+single atomic write. Writes that land between the last pass and the switch are not migrated,
+nor are writes from processes that have not reloaded the registry yet: pause the writers for
+the switch when that matters. Run one migration of a collection at a time: the registry is only
+locked within a process.
+"""
+
+import re
+from threading import Thread
+from typing import Dict, List, Set, Tuple
+
+from chromadb.api.models.Collection import Collection
+from llama_index.core.schema import BaseNode, MetadataMode
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+
+from frag.typedefs.embed_types import BaseEmbedding
+from frag.utils.console import console
+from .bulk import bulk_metadata
+from .registry import CollectionEntry, Migration
+from .store import EmbeddingStore
+
+
+def _all_ids(collection: Collection, page_size: int) -> Set[str]:
+    ids: Set[str] = set()
+    offset: int = 0
+    while page := collection.get(limit=page_size, offset=offset, include=[])["ids"]:
+        ids.update(page)
+        offset += len(page)
+    return ids
+
+
+class ReembedJob:
+    """
+    Migrates a collection of the store to the embedding model in the store's settings.
+
+    :param store: The store.
+    :param collection_name: The logical collection to migrate; defaults to the store's.
+    :param batch_size: Records embedded and checkpointed at a time.
+    :param drop_old: Delete the old collection after switching; otherwise it is kept, so that
+        readers still using it finish their queries.
+    :param catch_up_passes: Catch-up passes at most before switching, while writers still
+        change the collection.
+    """
+
+    def __init__(
+        self,
+        store: EmbeddingStore,
+        collection_name: str | None = None,
+        batch_size: int = 256,
+        drop_old: bool = False,
+        catch_up_passes: int = 3,
+    ) -> None:
+        self.store: EmbeddingStore = store
+        self.collection_name: str = collection_name or store.collection_name
+        self.batch_size: int = batch_size
+        self.drop_old: bool = drop_old
+        self.catch_up_passes: int = catch_up_passes
+
+    def start(self) -> Thread:
+        """
+        Runs the job in a background thread.
+        """
+        thread = Thread(target=self.run, name=f"reembed-{self.collection_name}")
+        thread.start()
+        return thread
+
+    def _migration(self, entry: CollectionEntry) -> Migration:
+        settings = self.store.settings
+        migration: Migration | None = entry.migration
+        if migration is not None and migration.api_model == settings.api_model:
+            console.log(
+                f"Resuming migration of {self.collection_name} after {migration.cursor}"
+            )
+            return migration
+
+        slug: str = re.sub(r"[^a-zA-Z0-9_-]+", "-", settings.api_model).strip("-")
+        target: str = f"{self.collection_name}__{slug}"[:63]
+        if migration is not None:
+            # the settings changed model again: restart towards the new one
+            self.store.db.delete_collection(migration.target)
+        if target in [c.name for c in self.store.db.list_collections()]:
+            self.store.db.delete_collection(target)
+        return Migration(
+            target=target,
+            api_source=settings.api_source,
+            api_model=settings.api_model,
+            total=self.store.db.get_collection(entry.physical).count(),
+        )
+
+    def _copy(
+        self, ids: List[str], source: Collection, target: Collection, model: BaseEmbedding
+    ) -> None:
+        records: Dict[str, List] = source.get(ids=ids, include=["documents", "metadatas"])
+        self._upsert(records, target, model)
+
+    @staticmethod
+    def _upsert(records: Dict[str, List], target: Collection, model: BaseEmbedding) -> None:
+        if not records["ids"]:
+            return
+        nodes: List[BaseNode] = [
+            metadata_dict_to_node(metadata, text=text)
+            for text, metadata in zip(records["documents"], records["metadatas"])
+        ]
+        target.upsert(
+            ids=records["ids"],
+            embeddings=model.get_text_embedding_batch(
+                [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+            ),
+            documents=records["documents"],
+            metadatas=records["metadatas"],
+        )
+
+    def _catch_up(
+        self, source: Collection, target: Collection, model: BaseEmbedding
+    ) -> Tuple[int, int]:
+        """
+        Copies the source records missing from the target or different there, and deletes the
+        target records no longer in the source.
+
+        :return: The records copied and deleted.
+        """
+        include: List[str] = ["documents", "metadatas"]
+        source_ids: Set[str] = _all_ids(source, self.batch_size)
+        copied: int = 0
+        ids: List[str] = sorted(source_ids)
+        for i in range(0, len(ids), self.batch_size):
+            records: Dict[str, List] = source.get(
+                ids=ids[i : i + self.batch_size], include=include
+            )
+            copies: Dict[str, Tuple[str, dict]] = {
+                node_id: (text, metadata)
+                for node_id, text, metadata in zip(
+                    records["ids"], records["documents"], records["metadatas"]
+                )
+            }
+            current: Dict[str, List] = target.get(ids=records["ids"], include=include)
+            for node_id, text, metadata in zip(
+                current["ids"], current["documents"], current["metadatas"]
+            ):
+                if copies.get(node_id) == (text, metadata):
+                    del copies[node_id]
+            if copies:
+                self._upsert(
+                    {
+                        "ids": list(copies),
+                        "documents": [text for text, _ in copies.values()],
+                        "metadatas": [metadata for _, metadata in copies.values()],
+                    },
+                    target,
+                    model,
+                )
+                copied += len(copies)
+
+        # paging over a collection being written can skip records: only delete the ones that
+        # a lookup by id confirms are gone
+        candidates: List[str] = list(_all_ids(target, self.batch_size) - source_ids)
+        stale: List[str] = []
+        for i in range(0, len(candidates), self.batch_size):
+            batch: List[str] = candidates[i : i + self.batch_size]
+            found: Set[str] = set(source.get(ids=batch, include=[])["ids"])
+            stale.extend(node_id for node_id in batch if node_id not in found)
+        if stale:
+            target.delete(ids=stale)
+        return copied, len(stale)
+
+    def run(self) -> None:
+        """
+        Runs the job to completion, resuming from the last checkpoint.
+        """
+        store: EmbeddingStore = self.store
+        entry: CollectionEntry | None = store.registry.get(self.collection_name)
+        if entry is None:
+            raise ValueError(f"Unknown collection: {self.collection_name}")
+        if entry.api_model == store.settings.api_model and entry.migration is None:
+            console.log(f"{self.collection_name} is already embedded with {entry.api_model}")
+            return
+
+        migration: Migration = self._migration(entry)
+        source: Collection = store.db.get_collection(entry.physical)
+        target: Collection = store.db.get_or_create_collection(
+            migration.target, metadata=bulk_metadata(source.metadata)
+        )
+        model: BaseEmbedding = store.get_embed_model(
+            migration.api_source, migration.api_model
+        )
+        entry.migration = migration
+        store.registry.put(self.collection_name, entry)
+
+        # sorted, so that the checkpoint holds whatever the collection becomes meanwhile
+        ids: List[str] = sorted(_all_ids(source, self.batch_size))
+        if migration.cursor is not None:
+            done: int = len([i for i in ids if i <= migration.cursor])
+            migration.offset, ids = done, ids[done:]
+        for i in range(0, len(ids), self.batch_size):
+            batch: List[str] = ids[i : i + self.batch_size]
+            self._copy(batch, source, target, model)
+            migration.offset += len(batch)
+            migration.cursor = batch[-1]
+            store.registry.put(self.collection_name, entry)
+            console.log(
+                f"Re-embedded {migration.offset}/{migration.total} records "
+                f"of {self.collection_name}"
+            )
+
+        for _ in range(self.catch_up_passes):
+            copied, deleted = self._catch_up(source, target, model)
+            console.log(f"Caught up: {copied} records copied, {deleted} removed")
+            if not copied and not deleted:
+                break
+        else:
+            console.log(
+                f"{self.collection_name} still changes: the writes after the last catch-up "
+                "pass are not migrated"
+            )
+
+        store.registry.put(
+            self.collection_name,
+            CollectionEntry(
+                physical=migration.target,
+                api_source=migration.api_source,
+                api_model=migration.api_model,
+                retired=entry.retired,
+            ),
+        )
+        console.log(
+            f"[b]{self.collection_name}[/b] now reads from {migration.target} "
+            f"({migration.api_model})"
+        )
+        if self.drop_old:
+            store.db.delete_collection(entry.physical)
+            console.log(f"Deleted {entry.physical}")
+        store.refresh()
@@ -0,0 +1,105 @@
+"""
+Registry of the store's collections, persisted in `.frag/collections.json`.
+
+Collections are referred to by a logical name (e.g. `default`), which the registry maps to the
+chroma collection actually holding the vectors, along with the embedding model that produced
+them. Re-embedding into a new collection then switches reads over by rewriting one entry, and
+the file is replaced atomically, so readers never see a partial registry.
+"""
+
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List
+
+from pydantic import BaseModel, Field
+
+from frag.typedefs.embed_types import ApiSource
+
+
+class Migration(BaseModel):
+    """
+    A re-embedding in progress, with its checkpoint.
+    """
+
+    target: str = Field(..., description="Shadow collection being filled")
+    api_source: ApiSource
+    api_model: str
+    offset: int = Field(0, description="Records of the source already re-embedded")
+    cursor: str | None = Field(None, description="Last id re-embedded, in sorted order")
+    total: int = Field(0, description="Records in the source when the migration started")
+    started_at: datetime = Field(default_factory=datetime.now)
+
+
+class CollectionEntry(BaseModel):
+    """
+    Where a logical collection lives, and how its vectors were made.
+    """
+
+    physical: str = Field(..., description="Name of the chroma collection")
+    api_source: ApiSource
+    api_model: str
+    migration: Migration | None = None
+    retired: List[str] = Field(
+        default_factory=list,
+        description="Former chroma collections, kept for readers until the next compaction",
+    )
+
+
+class CollectionRegistry:
+    """
+    Reads and atomically writes the collections registry.
+
+    `put` reads, updates and rewrites the file under a lock held within the process only:
+    processes writing different entries at the same time can lose one of the writes.
+
+    :param path: The registry file.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path: Path = path
+        self._lock: Lock = Lock()
+
+    @property
+    def version(self) -> float:
+        """
+        Changes whenever the registry is rewritten; 0 if it does not exist.
+        """
+        try:
+            return self.path.stat().st_mtime
+        except FileNotFoundError:
+            return 0.0
+
+    def load(self) -> Dict[str, CollectionEntry]:
+        """
+        Returns every entry, by logical name.
+        """
+        if not self.path.exists():
+            return {}
+        raw: Dict[str, dict] = json.loads(self.path.read_text(encoding="utf-8"))
+        return {name: CollectionEntry(**entry) for name, entry in raw.items()}
+
+    def get(self, name: str) -> CollectionEntry | None:
+        """
+        Returns the entry for a logical collection, if registered.
+        """
+        return self.load().get(name)
+
+    def put(self, name: str, entry: CollectionEntry) -> None:
+        """
+        Writes an entry, replacing the registry file atomically.
+        """
+        with self._lock:
+            entries: Dict[str, CollectionEntry] = self.load()
+            entries[name] = entry
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path: Path = self.path.with_suffix(f".{os.getpid()}.tmp")
+            tmp_path.write_text(
+                json.dumps(
+                    {k: v.model_dump(mode="json") for k, v in entries.items()}, indent=2
+                ),
+                encoding="utf-8",
+            )
+            os.replace(tmp_path, self.path)
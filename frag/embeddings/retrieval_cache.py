@@ -0,0 +1,195 @@
+"""
+Semantic cache of retrieval results.
+
+Users often ask paraphrases of the same question. `RetrievalCache` keeps the hits (node ids and
+scores) of recent queries with their embeddings; a query whose embedding is close enough to a
+cached one gets its hits back, without a vector or keyword search. An identical query does not
+even need embedding.
+
+Entries are scoped to a collection and stamped with its version: once the collection is written
+to, its entries no longer match, and are dropped. Eviction is LRU, above `max_size` entries.
+
+The lookup itself is generic, in `SemanticCache`, which also backs the prompter's answer cache.
+
+`VectorCache` keeps the candidate vectors of recent metadata filters, so that filtered queries
+repeating a filter compare the query with them without fetching them from the collection again.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from typing import Generic, Hashable, List, NamedTuple, Sequence, Tuple, TypeVar
+
+import numpy as np
+
+T = TypeVar("T")
+
+Hits = List[Tuple[str, float]]
+
+
+class _Entry(NamedTuple):
+    scope: Hashable
+    version: Hashable
+    embedding: np.ndarray
+    value: object
+
+
+class SemanticCache(Generic[T]):
+    """
+    A thread-safe, size-bounded LRU cache of values, looked up by query similarity within a
+    scope, and only valid for the version of the scope they were stored with.
+
+    :param max_size: Maximum number of cached queries, across all scopes.
+    :param threshold: Minimum cosine similarity between two queries' embeddings for one to
+        reuse the other's value.
+    """
+
+    def __init__(self, max_size: int = 1024, threshold: float = 0.95) -> None:
+        self.max_size: int = max_size
+        self.threshold: float = threshold
+        self.hits: int = 0
+        self.misses: int = 0
+        self._entries: OrderedDict[Tuple[Hashable, str], _Entry] = OrderedDict()
+        self._lock: Lock = Lock()
+
+    def _drop_stale(self, scope: Hashable, version: Hashable) -> None:
+        for key in [
+            key
+            for key, entry in self._entries.items()
+            if entry.scope == scope and entry.version != version
+        ]:
+            del self._entries[key]
+
+    def get_exact(self, scope: Hashable, version: Hashable, query: str) -> T | None:
+        """
+        Returns the value cached for this very query, if any.
+        """
+        with self._lock:
+            entry: _Entry | None = self._entries.get((scope, query))
+            if entry is None or entry.version != version:
+                return None
+            self._entries.move_to_end((scope, query))
+            self.hits += 1
+            return entry.value  # type: ignore[return-value]
+
+    def get(
+        self, scope: Hashable, version: Hashable, embedding: Sequence[float]
+    ) -> T | None:
+        """
+        Returns the value of the most similar cached query, if similar enough.
+        """
+        vector: np.ndarray = _normalise(embedding)
+        with self._lock:
+            self._drop_stale(scope, version)
+            keys: List[Tuple[Hashable, str]] = [
+                key
+                for key, entry in self._entries.items()
+                if entry.scope == scope and len(entry.embedding) == len(vector)
+            ]
+            if keys:
+                similarities: np.ndarray = (
+                    np.stack([self._entries[key].embedding for key in keys]) @ vector
+                )
+                best: int = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self._entries.move_to_end(keys[best])
+                    self.hits += 1
+                    return self._entries[keys[best]].value  # type: ignore[return-value]
+            self.misses += 1
+            return None
+
+    def put(
+        self,
+        scope: Hashable,
+        version: Hashable,
+        query: str,
+        embedding: Sequence[float],
+        value: T,
+    ) -> None:
+        """
+        Caches the value of a query, evicting the least recently used entries above
+        `max_size`.
+        """
+        with self._lock:
+            self._entries[(scope, query)] = _Entry(scope, version, _normalise(embedding), value)
+            self._entries.move_to_end((scope, query))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """
+        Drops every cached query.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+class RetrievalCache(SemanticCache[Hits]):
+    """
+    Cache of retrieval hits (node ids and scores), per collection.
+    """
+
+
+class VectorCache:
+    """
+    A thread-safe LRU cache of node ids and their vectors, per scope, only valid for the version
+    of the scope they were stored with.
+
+    :param max_rows: Maximum number of vectors, across all scopes.
+    """
+
+    def __init__(self, max_rows: int = 10000) -> None:
+        self.max_rows: int = max_rows
+        self._entries: OrderedDict[Hashable, Tuple[Hashable, List[str], np.ndarray]] = (
+            OrderedDict()
+        )
+        self._rows: int = 0
+        self._lock: Lock = Lock()
+
+    def get(self, scope: Hashable, version: Hashable) -> Tuple[List[str], np.ndarray] | None:
+        """
+        Returns the ids and vectors cached for the scope, if still valid.
+        """
+        with self._lock:
+            entry = self._entries.get(scope)
+            if entry is None:
+                return None
+            if entry[0] != version:
+                self._pop(scope)
+                return None
+            self._entries.move_to_end(scope)
+            return entry[1], entry[2]
+
+    def put(
+        self, scope: Hashable, version: Hashable, ids: List[str], vectors: np.ndarray
+    ) -> None:
+        """
+        Caches the vectors of a scope, evicting the least recently used scopes above
+        `max_rows` vectors; vectors that do not fit on their own are not cached.
+        """
+        if len(ids) > self.max_rows:
+            return
+        with self._lock:
+            self._pop(scope)
+            self._entries[scope] = (version, ids, vectors)
+            self._rows += len(ids)
+            while self._rows > self.max_rows:
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, scope: Hashable) -> None:
+        entry = self._entries.pop(scope, None)
+        if entry is not None:
+            self._rows -= len(entry[1])
+
+    def clear(self) -> None:
+        """
+        Drops every cached vector.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._rows = 0
+
+
+def _normalise(embedding: Sequence[float]) -> np.ndarray:
+    vector: np.ndarray = np.asarray(embedding, dtype=np.float32)
+    norm: float = float(np.linalg.norm(vector))
+    return vector / norm if norm else vector
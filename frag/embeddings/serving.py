@@ -0,0 +1,301 @@
+"""
+Read-only serving of a collection from published snapshots, shared by worker processes.
+
+Every process opening `.frag/db` loads its own copy of Chroma's index. In read-only mode (the
+`read_only` setting), `EmbeddingStore` does not open Chroma at all: it serves the collection
+from a snapshot (see `frag.embeddings.snapshot`) published under
+`.frag/serving/<collection>/`. The snapshot's files never change once published, so:
+- the vectors are memory-mapped, and the operating system keeps a single copy of their pages,
+  shared by every worker; so are the records, read line by line through their offsets;
+- the keyword and metadata indexes are opened as immutable, without any locks.
+
+Search is exact: a matrix product over the memory-mapped vectors. Records are looked up by id
+with a binary search over each segment's sorted ids. Per process, the snapshot costs a norm, a
+line offset and an id per record, whatever the number of workers.
+
+`publish` copies a snapshot into the serving directory, then points `CURRENT` to it by
+replacing that file, which is atomic: readers check it before each query, and switch to the new
+snapshot as a whole. Older snapshots are deleted; processes still reading them keep their
+mappings until they switch.
+"""
+
+import json
+import mmap
+import os
+import re
+import shutil
+import time
+from pathlib import Path
+from threading import Lock
+from typing import AbstractSet, Any, Dict, Iterable, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+from llama_index.core.schema import BaseNode, NodeWithScore
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+
+from frag.utils.console import console
+from .bm25 import BM25Index
+from .metadata_index import MetadataIndex
+from .snapshot import Manifest, bucket, load_segment, read_manifest
+
+
+# the top-level id of a record: its keys are sorted, and quotes within strings are escaped, so
+# the first match on a line follows the document, and precedes the metadata
+_ID: re.Pattern[bytes] = re.compile(rb', "id": "((?:[^"\\]|\\.)*)"')
+
+
+def serving_dir(path: Path, collection_name: str) -> Path:
+    """
+    Where the snapshots of a collection are published.
+    """
+    return path / "serving" / collection_name
+
+
+def top_k_cosine(
+    query: Sequence[float], vectors: np.ndarray, top_k: int, norms: np.ndarray | None = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the rows of a matrix most similar to a query, by cosine similarity.
+
+    :param norms: The norms of the rows, if known.
+    :return: The rows, best first, and their similarities.
+    """
+    if not len(vectors) or top_k <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    query = np.asarray(query, dtype=np.float32)
+    query = query / (np.linalg.norm(query) or 1.0)
+    if norms is None:
+        norms = np.sqrt(np.einsum("ij,ij->i", vectors, vectors))
+    scores: np.ndarray = (vectors @ query) / np.where(norms == 0, 1, norms)
+    top_k = min(top_k, len(scores))
+    rows: np.ndarray = np.argpartition(-scores, top_k - 1)[:top_k]
+    rows = rows[np.argsort(-scores[rows])]
+    return rows, scores[rows]
+
+
+def _link_or_copy(source: str, target: str) -> None:
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def publish(path: Path, collection_name: str, snapshot: Path, keep: int = 2) -> Path:
+    """
+    Publishes a snapshot to the read-only readers of a collection, checking its checksums.
+
+    :param path: The store's directory (`.frag`).
+    :param collection_name: The logical collection.
+    :param snapshot: The snapshot directory; its files are hard-linked when possible.
+    :param keep: Snapshots kept in the serving directory, the published one included.
+    :return: The published copy of the snapshot.
+    """
+    manifest: Manifest = read_manifest(snapshot)
+    for segment in manifest.segments:
+        load_segment(snapshot, segment)
+    directory: Path = serving_dir(path, collection_name)
+    directory.mkdir(parents=True, exist_ok=True)
+    name: str = str(time.time_ns())
+    staging: Path = directory / f"{name}.partial"
+    shutil.copytree(snapshot, staging, copy_function=_link_or_copy)
+    staging.rename(directory / name)
+
+    pointer: Path = directory / "CURRENT.tmp"
+    pointer.write_text(name, encoding="utf-8")
+    pointer.replace(directory / "CURRENT")
+    console.log(f"Published {snapshot} as {collection_name}/{name}")
+
+    published: List[Path] = sorted(
+        (p for p in directory.iterdir() if p.is_dir() and p.name.isdigit()),
+        key=lambda p: int(p.name),
+    )
+    for old in published[:-keep]:
+        shutil.rmtree(old, ignore_errors=True)
+    return directory / name
+
+
+class _Segment(NamedTuple):
+    vectors: np.ndarray
+    norms: np.ndarray
+    records: mmap.mmap | None
+    offsets: np.ndarray
+    ids: np.ndarray
+
+
+def _record_id(records: mmap.mmap, start: int, end: int) -> bytes:
+    match: re.Match[bytes] | None = _ID.search(records, start, end)
+    if match is None:
+        return json.loads(records[start:end])["id"].encode("utf-8")
+    found: bytes = match.group(1)
+    return json.loads(b'"' + found + b'"').encode("utf-8") if b"\\" in found else found
+
+
+class ServedSnapshot:
+    """
+    A published snapshot, memory-mapped.
+
+    :param path: The snapshot directory.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path: Path = path
+        self.name: str = path.name
+        self.manifest: Manifest = read_manifest(path)
+        self.segments: List[_Segment] = [
+            self._open(segment.name) for segment in self.manifest.segments
+        ]
+        keyword_index: Path = path / "bm25.sqlite3"
+        self.sparse: BM25Index = (
+            BM25Index(keyword_index, read_only=True)
+            if keyword_index.exists()
+            else BM25Index(Path(":memory:"))
+        )
+        metadata_index: Path = path / "metadata.sqlite3"
+        self.metadata: MetadataIndex = (
+            MetadataIndex(metadata_index, read_only=True)
+            if metadata_index.exists()
+            else MetadataIndex(Path(":memory:"))
+        )
+
+    def _open(self, name: str) -> _Segment:
+        vectors: np.ndarray = np.load(self.path / "segments" / f"{name}.npy", mmap_mode="r")
+        norms: np.ndarray = np.sqrt(np.einsum("ij,ij->i", vectors, vectors))
+        with open(self.path / "segments" / f"{name}.jsonl", "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return _Segment(
+                    vectors, norms, None, np.zeros(1, dtype=np.int64), np.zeros(0, dtype="S1")
+                )
+            records: mmap.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        ends: np.ndarray = np.flatnonzero(np.frombuffer(records, dtype=np.uint8) == 10) + 1
+        offsets: np.ndarray = np.concatenate([[0], ends])
+        # sorted, as the records are: UTF-8 preserves the order of the strings
+        ids: np.ndarray = np.array(
+            [
+                _record_id(records, int(start), int(end))
+                for start, end in zip(offsets[:-1], offsets[1:])
+            ],
+            dtype=np.bytes_,
+        )
+        return _Segment(vectors, norms, records, offsets, ids)
+
+    def record(self, segment: int, row: int) -> Dict[str, Any]:
+        """
+        Reads a record of a segment.
+        """
+        part: _Segment = self.segments[segment]
+        start, end = int(part.offsets[row]), int(part.offsets[row + 1])
+        return json.loads(part.records[start:end])  # type: ignore[index]
+
+    def find(self, node_id: str) -> Tuple[int, int] | None:
+        """
+        Locates a record, by binary search in its segment's ids.
+        """
+        return self.locate([node_id]).get(node_id)
+
+    def locate(self, node_ids: Iterable[str]) -> Dict[str, Tuple[int, int]]:
+        """
+        Locates records, by binary search in their segments' ids, a segment at a time.
+
+        :return: The segment and row of each record found, by id.
+        """
+        by_segment: Dict[int, List[str]] = {}
+        for node_id in node_ids:
+            by_segment.setdefault(bucket(node_id, len(self.segments)), []).append(node_id)
+        locations: Dict[str, Tuple[int, int]] = {}
+        for segment, wanted in by_segment.items():
+            ids: np.ndarray = self.segments[segment].ids
+            if not len(ids):
+                continue
+            keys: np.ndarray = np.array([i.encode("utf-8") for i in wanted], dtype=np.bytes_)
+            rows: np.ndarray = np.minimum(np.searchsorted(ids, keys), len(ids) - 1)
+            for node_id, row, found in zip(wanted, rows, ids[rows] == keys):
+                if found:
+                    locations[node_id] = (segment, int(row))
+        return locations
+
+    def _node(self, segment: int, row: int) -> BaseNode:
+        record: Dict[str, Any] = self.record(segment, row)
+        return metadata_dict_to_node(record["metadata"], text=record["document"])
+
+    def search(
+        self,
+        embedding: Sequence[float],
+        top_k: int,
+        among: AbstractSet[str] | None = None,
+    ) -> List[NodeWithScore]:
+        """
+        Returns the records most similar to an embedding, by cosine similarity; among the
+        given ones, if any.
+        """
+        if among is not None:
+            locations: List[Tuple[int, int]] = list(self.locate(among).values())
+            if not locations:
+                return []
+            rows, scores = top_k_cosine(
+                embedding,
+                np.stack([self.segments[i].vectors[row] for i, row in locations]),
+                top_k,
+            )
+            return [
+                NodeWithScore(node=self._node(*locations[row]), score=float(score))
+                for row, score in zip(rows, scores)
+            ]
+        best: List[Tuple[float, int, int]] = []
+        for i, part in enumerate(self.segments):
+            rows, scores = top_k_cosine(embedding, part.vectors, top_k, part.norms)
+            best.extend((float(score), i, int(row)) for row, score in zip(rows, scores))
+        best.sort(reverse=True)
+        return [
+            NodeWithScore(node=self._node(segment, row), score=score)
+            for score, segment, row in best[:top_k]
+        ]
+
+    def get_nodes(self, node_ids: Sequence[str]) -> List[BaseNode]:
+        locations: Dict[str, Tuple[int, int]] = self.locate(node_ids)
+        return [self._node(*locations[i]) for i in node_ids if i in locations]
+
+    def get_embeddings(self, node_ids: Sequence[str]) -> Dict[str, List[float]]:
+        return {
+            node_id: self.segments[segment].vectors[row].tolist()
+            for node_id, (segment, row) in self.locate(node_ids).items()
+        }
+
+
+class SnapshotReader:
+    """
+    Follows the snapshot published for a collection.
+
+    :param directory: The collection's serving directory.
+    """
+
+    def __init__(self, directory: Path) -> None:
+        self.directory: Path = directory
+        self._snapshot: ServedSnapshot | None = None
+        self._lock: Lock = Lock()
+
+    def refresh(self) -> bool:
+        """
+        Switches to the published snapshot, if it changed.
+
+        :return: Whether it changed.
+        """
+        try:
+            name: str = (self.directory / "CURRENT").read_text(encoding="utf-8").strip()
+        except FileNotFoundError:
+            raise ValueError(
+                f"No snapshot is published in {self.directory}: run `frag store:publish`"
+            )
+        if self._snapshot is not None and self._snapshot.name == name:
+            return False
+        with self._lock:
+            if self._snapshot is None or self._snapshot.name != name:
+                # the previous snapshot stays mapped until its last reader lets go of it
+                self._snapshot = ServedSnapshot(self.directory / name)
+                return True
+        return False
+
+    @property
+    def current(self) -> ServedSnapshot:
+        if self._snapshot is None:
+            self.refresh()
+        return self._snapshot  # type: ignore[return-value]
@@ -0,0 +1,400 @@
+"""
+Snapshots of a collection, to build it on one machine and serve it from others.
+
+A snapshot is a directory, independent of Chroma's on-disk format:
+
+    manifest.json           format version, collection, embedding model, dimension, settings
+                            fingerprint, and the segments with their checksums
+    segments/00000.npy      the segment's vectors, one float32 row per record
+    segments/00000.jsonl    the segment's records, in the same order: id, text and metadata
+    bm25.sqlite3            the collection's keyword index, if it has one
+    metadata.sqlite3        the collection's metadata index, if it has one
+
+Records go to segments by a hash of their id, and are sorted by id within a segment, so that
+exporting the same records again gives the same files. An export keeps the segment count of a
+`base` snapshot, so that the segments whose records did not change keep their checksums.
+
+Importing loads the vectors as they are, without re-embedding, and records the checksum of each
+segment it loads under `.frag/snapshots/`: importing the next snapshot only loads the segments
+whose checksums changed, deleting the records that left them, and an interrupted import resumes
+at the first segment not yet loaded.
+"""
+
+import hashlib
+import json
+import math
+import shutil
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, IO, List, Tuple
+
+import numpy as np
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+from pydantic import BaseModel, Field
+
+from frag.typedefs.embed_types import ApiSource
+from frag.utils.console import console
+from .registry import CollectionEntry
+
+if TYPE_CHECKING:
+    # the store serves snapshots, see `frag.embeddings.serving`
+    from .store import EmbeddingStore
+
+FORMAT: int = 1
+SEGMENT_RECORDS: int = 8192
+
+
+class Segment(BaseModel):
+    """
+    A segment of a snapshot, and the checksums of its files.
+    """
+
+    name: str
+    records: int
+    vectors_sha256: str
+    records_sha256: str
+
+    @property
+    def checksum(self) -> str:
+        return hashlib.sha256(
+            f"{self.vectors_sha256}:{self.records_sha256}".encode("utf-8")
+        ).hexdigest()
+
+
+class Manifest(BaseModel):
+    """
+    What a snapshot holds.
+    """
+
+    format: int = FORMAT
+    collection: str
+    api_source: ApiSource
+    api_model: str
+    dimension: int
+    fingerprint: str = Field(..., description="Fingerprint of the exporting settings")
+    created_at: datetime = Field(default_factory=datetime.now)
+    segments: List[Segment] = Field(default_factory=list)
+    keyword_index_sha256: str | None = Field(None, description="Checksum of bm25.sqlite3")
+    metadata_index_sha256: str | None = Field(
+        None, description="Checksum of metadata.sqlite3"
+    )
+
+
+def bucket(node_id: str, segments: int) -> int:
+    """
+    The segment of a record.
+    """
+    return int(hashlib.sha1(node_id.encode("utf-8")).hexdigest()[:8], 16) % segments
+
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while block := file.read(1 << 20):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_manifest(path: Path) -> Manifest:
+    """
+    Reads the manifest of a snapshot, checking that its format is supported.
+    """
+    manifest: Manifest = Manifest.model_validate_json(
+        (path / "manifest.json").read_text(encoding="utf-8")
+    )
+    if manifest.format > FORMAT:
+        raise ValueError(
+            f"{path} is a snapshot of format {manifest.format}; "
+            f"this version of frag reads format {FORMAT} and below"
+        )
+    return manifest
+
+
+def export_snapshot(
+    store: "EmbeddingStore",
+    path: Path,
+    collection_name: str | None = None,
+    base: Path | None = None,
+    page_size: int = 1000,
+) -> Manifest:
+    """
+    Exports a collection of the store to a snapshot.
+
+    :param store: The store.
+    :param path: The snapshot directory, replaced if it exists.
+    :param collection_name: The logical collection; defaults to the store's.
+    :param base: A previous snapshot, whose segment count is kept.
+    :param page_size: Records read from the collection at a time.
+    """
+    name: str = collection_name or store.collection_name
+    entry: CollectionEntry | None = store.registry.get(name)
+    if entry is None:
+        raise ValueError(f"Unknown collection: {name}")
+    if entry.api_model != store.settings.api_model or entry.migration is not None:
+        raise ValueError(
+            f"{name} is not embedded with {store.settings.api_model} yet: "
+            "run `frag store:reembed` first"
+        )
+    collection = store.db.get_collection(entry.physical)
+    count: int = collection.count()
+    segments: int = (
+        len(read_manifest(base).segments)
+        if base is not None
+        else 2 ** max(0, math.ceil(math.log2(max(count, 1) / SEGMENT_RECORDS)))
+    )
+
+    staging: Path = path.with_name(f"{path.name}.partial")
+    shutil.rmtree(staging, ignore_errors=True)
+    (staging / "segments").mkdir(parents=True)
+    # records are spread over the segments first, then each segment is sorted
+    records: List[IO[str]] = [
+        open(staging / "segments" / f"{i:05d}.unsorted", "w", encoding="utf-8")
+        for i in range(segments)
+    ]
+    dimension: int = 0
+    try:
+        offset: int = 0
+        while True:
+            page: Dict[str, List] = collection.get(
+                limit=page_size,
+                offset=offset,
+                include=["embeddings", "documents", "metadatas"],
+            )
+            if not page["ids"]:
+                break
+            for node_id, embedding, document, metadata in zip(
+                page["ids"], page["embeddings"], page["documents"], page["metadatas"]
+            ):
+                dimension = dimension or len(embedding)
+                records[bucket(node_id, segments)].write(
+                    json.dumps(
+                        {
+                            "id": node_id,
+                            "document": document,
+                            "metadata": metadata,
+                            "embedding": list(embedding),
+                        }
+                    )
+                    + "\n"
+                )
+            offset += len(page["ids"])
+    finally:
+        for file in records:
+            file.close()
+
+    manifest = Manifest(
+        collection=name,
+        api_source=entry.api_source,
+        api_model=entry.api_model,
+        dimension=dimension,
+        fingerprint=store.settings.fingerprint,
+    )
+    for i in range(segments):
+        unsorted: Path = staging / "segments" / f"{i:05d}.unsorted"
+        lines: List[Dict[str, Any]] = sorted(
+            (json.loads(line) for line in unsorted.read_text(encoding="utf-8").splitlines()),
+            key=lambda record: record["id"],
+        )
+        unsorted.unlink()
+        vectors_path: Path = staging / "segments" / f"{i:05d}.npy"
+        records_path: Path = staging / "segments" / f"{i:05d}.jsonl"
+        np.save(
+            vectors_path,
+            np.asarray(
+                [record.pop("embedding") for record in lines], dtype=np.float32
+            ).reshape(len(lines), dimension),
+        )
+        with open(records_path, "w", encoding="utf-8") as file:
+            for record in lines:
+                file.write(json.dumps(record, sort_keys=True) + "\n")
+        manifest.segments.append(
+            Segment(
+                name=f"{i:05d}",
+                records=len(lines),
+                vectors_sha256=_sha256(vectors_path),
+                records_sha256=_sha256(records_path),
+            )
+        )
+    indexes: Dict[str, Path] = {
+        "bm25.sqlite3": store.settings.path / "bm25" / f"{name}.sqlite3",
+        "metadata.sqlite3": store.settings.path / "metadata" / f"{name}.sqlite3",
+    }
+    for file_name, index in indexes.items():
+        if not index.exists():
+            continue
+        source: sqlite3.Connection = sqlite3.connect(str(index))
+        target: sqlite3.Connection = sqlite3.connect(str(staging / file_name))
+        try:
+            source.backup(target)
+        finally:
+            source.close()
+            target.close()
+    if (staging / "bm25.sqlite3").exists():
+        manifest.keyword_index_sha256 = _sha256(staging / "bm25.sqlite3")
+    if (staging / "metadata.sqlite3").exists():
+        manifest.metadata_index_sha256 = _sha256(staging / "metadata.sqlite3")
+    (staging / "manifest.json").write_text(manifest.model_dump_json(indent=2), encoding="utf-8")
+
+    shutil.rmtree(path, ignore_errors=True)
+    staging.rename(path)
+    console.log(f"Exported {offset} records of {name} to {path}, in {segments} segments")
+    return manifest
+
+
+def load_segment(path: Path, segment: Segment) -> Tuple[np.ndarray, List[Dict[str, Any]]]:
+    """
+    Reads a segment of a snapshot, checking its files against their checksums.
+
+    :return: The vectors, memory-mapped, and the records.
+    """
+    vectors_path: Path = path / "segments" / f"{segment.name}.npy"
+    records_path: Path = path / "segments" / f"{segment.name}.jsonl"
+    if (
+        _sha256(vectors_path) != segment.vectors_sha256
+        or _sha256(records_path) != segment.records_sha256
+    ):
+        raise ValueError(f"Segment {segment.name} of {path} does not match its checksum")
+    vectors: np.ndarray = np.load(vectors_path, mmap_mode="r")
+    with open(records_path, encoding="utf-8") as file:
+        records: List[Dict[str, Any]] = [json.loads(line) for line in file]
+    return vectors, records
+
+
+class ImportState:
+    """
+    The segments of a collection loaded from snapshots, under `.frag/snapshots/<collection>/`:
+    for each, its checksum and the ids of its records; and the layout they were loaded with,
+    the physical collection, the snapshots' fingerprint and their segment count.
+    """
+
+    def __init__(self, directory: Path) -> None:
+        self.directory: Path = directory
+        directory.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def layout(self) -> Dict[str, Any] | None:
+        """
+        The physical collection, fingerprint and segment count of the snapshots loaded, if any.
+        """
+        path: Path = self.directory / "layout.json"
+        return json.loads(path.read_text(encoding="utf-8")) if path.exists() else None
+
+    @layout.setter
+    def layout(self, layout: Dict[str, Any]) -> None:
+        path: Path = self.directory / "layout.json"
+        tmp: Path = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(layout), encoding="utf-8")
+        tmp.replace(path)
+
+    def get(self, segment: str) -> Tuple[str | None, List[str]]:
+        path: Path = self.directory / f"{segment}.json"
+        if not path.exists():
+            return None, []
+        state: Dict[str, Any] = json.loads(path.read_text(encoding="utf-8"))
+        return state["checksum"], state["ids"]
+
+    def put(self, segment: str, checksum: str, ids: List[str]) -> None:
+        path: Path = self.directory / f"{segment}.json"
+        tmp: Path = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"checksum": checksum, "ids": ids}), encoding="utf-8")
+        tmp.replace(path)
+
+    def clear(self) -> List[str]:
+        """
+        Forgets every segment, and returns the ids of their records.
+        """
+        ids: List[str] = []
+        for path in self.directory.glob("*.json"):
+            if path.name != "layout.json":
+                ids.extend(self.get(path.stem)[1])
+            path.unlink()
+        (self.directory / "segments.txt").unlink(missing_ok=True)
+        return ids
+
+
+def import_snapshot(
+    store: "EmbeddingStore",
+    path: Path,
+    collection_name: str | None = None,
+    force: bool = False,
+) -> int:
+    """
+    Loads a snapshot into a collection of the store, skipping the segments already loaded.
+
+    :param store: The store.
+    :param path: The snapshot directory.
+    :param collection_name: The logical collection; defaults to the snapshot's.
+    :param force: Import even if the snapshot was made with other embedding settings.
+    :return: The number of records written.
+    """
+    manifest: Manifest = read_manifest(path)
+    name: str = collection_name or manifest.collection
+    if manifest.fingerprint != store.settings.fingerprint and not force:
+        raise ValueError(
+            f"{path} was exported with other embedding settings ({manifest.api_model}); "
+            "use --force to import it anyway"
+        )
+    entry: CollectionEntry | None = store.registry.get(name)
+    if entry is not None and (
+        entry.api_source != manifest.api_source or entry.api_model != manifest.api_model
+    ):
+        raise ValueError(
+            f"{name} is embedded with {entry.api_model}, the snapshot with "
+            f"{manifest.api_model}: import it into another collection"
+        )
+    if entry is None:
+        store.registry.put(
+            name,
+            CollectionEntry(
+                physical=name,
+                api_source=manifest.api_source,
+                api_model=manifest.api_model,
+            ),
+        )
+    store.change_collection(name)
+
+    batch_size: int = store.settings.upsert_batch_size
+    state = ImportState(store.settings.path / "snapshots" / name)
+    layout: Dict[str, Any] = {
+        "physical": store.entry.physical,
+        "fingerprint": manifest.fingerprint,
+        "segments": len(manifest.segments),
+    }
+    if state.layout != layout:
+        # the collection was rebuilt (compacted, re-embedded, deleted), the snapshots come
+        # from other settings, or their records are spread differently: the segments loaded
+        # before say nothing of the collection, and every segment is loaded again
+        stale: List[str] = state.clear()
+        for start in range(0, len(stale), batch_size):
+            store.collection.delete(ids=stale[start : start + batch_size])
+        store.sparse.delete(stale)
+        store.metadata.delete(stale)
+        state.layout = layout
+
+    written: int = 0
+    for segment in manifest.segments:
+        checksum, previous = state.get(segment.name)
+        if checksum == segment.checksum:
+            continue
+        vectors, records = load_segment(path, segment)
+        ids: List[str] = [record["id"] for record in records]
+        if gone := list(set(previous) - set(ids)):
+            store.collection.delete(ids=gone)
+            store.sparse.delete(gone)
+            store.metadata.delete(gone)
+        for start in range(0, len(records), batch_size):
+            nodes: List[BaseNode] = []
+            for record, vector in zip(
+                records[start : start + batch_size], vectors[start : start + batch_size]
+            ):
+                node: BaseNode = metadata_dict_to_node(
+                    record["metadata"], text=record["document"]
+                )
+                node.embedding = vector.tolist()
+                nodes.append(node)
+            written += len(store.bulk_upsert(nodes))
+        state.put(segment.name, segment.checksum, ids)
+        console.log(f"Loaded segment {segment.name}: {len(ids)} records")
+    return written
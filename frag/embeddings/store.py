@@ -1,21 +1,51 @@
-from typing import List, TypedDict, Self
+import time
+from itertools import islice
+from typing import (
+    AbstractSet,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Sequence,
+    Set,
+    Tuple,
+    TypedDict,
+    Self,
+)
 
+import numpy as np
 from llama_index.core import StorageContext, VectorStoreIndex
 from llama_index.core.ingestion import IngestionCache, IngestionPipeline
 from llama_index.core.extractors import BaseExtractor
 from llama_index.core.node_parser import NodeParser
-from llama_index.core.schema import TransformComponent
+from llama_index.core.schema import (
+    BaseNode,
+    Document,
+    NodeWithScore,
+    TransformComponent,
+)
 from llama_index.core.storage.docstore import SimpleDocumentStore
 from llama_index.core.retrievers import BaseRetriever
 from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.vector_stores import VectorStoreQuery, VectorStoreQueryResult
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
 from llama_index.vector_stores.chroma import ChromaVectorStore
 from chromadb.api import ClientAPI
 from chromadb.api.models.Collection import Collection
 from chromadb import PersistentClient
-from trio import Path
 from frag.settings.embed_settings import EmbedSettings
-from frag.utils import SingletonMixin
-from frag.typedefs.embed_types import BaseEmbedding
+from frag.utils import SingletonMixin, console
+from frag.typedefs.embed_types import ApiSource, BaseEmbedding
+from .get_embed_api import get_embed_api
+from .bm25 import BM25Index, reciprocal_rank_fusion
+from .bulk import get_or_create_bulk_collection, node_records
+from .chunker import MarkdownChunker
+from .dedup import DedupTransform
+from .metadata_index import MetadataFilter, MetadataIndex, source_key
+from .neighbours import AdjacencyTransform, merge_neighbours
+from .retrieval_cache import Hits, RetrievalCache, VectorCache
+from .registry import CollectionEntry, CollectionRegistry
+from .serving import ServedSnapshot, SnapshotReader, serving_dir, top_k_cosine
 
 ArgType = TypedDict(
     "ArgType",
@@ -28,6 +58,19 @@ AddOns = TypedDict(
 )
 
 
+def make_node_parser(settings: EmbedSettings) -> NodeParser:
+    """
+    Build the node parser for the given settings. Also used by ingestion worker processes,
+    which rebuild it from the settings.
+    """
+    return MarkdownChunker(
+        chunk_size=settings.chunk_size,
+        chunk_overlap=settings.chunk_overlap,
+        api_source=settings.api_source,
+        api_model=settings.api_model,
+    )
+
+
 class EmbeddingStore(SingletonMixin[type(ArgType)]):
     embed_model: BaseEmbedding
     db: ClientAPI
@@ -38,9 +81,17 @@ class EmbeddingStore(SingletonMixin[type(ArgType)]):
     settings: EmbedSettings
     index: BaseRetriever
     collection_name: str
-    text_splitter: SentenceSplitter
+    text_splitter: NodeParser
     docstore: SimpleDocumentStore
     vector_store: ChromaVectorStore
+    deduplicator: DedupTransform | None
+    registry: CollectionRegistry
+    entry: CollectionEntry
+    sparse: BM25Index
+    metadata: MetadataIndex
+    retrieval_cache: RetrievalCache | None
+    vector_cache: VectorCache
+    reader: SnapshotReader | None = None
 
     def __init__(
         self,
@@ -49,14 +100,30 @@ class EmbeddingStore(SingletonMixin[type(ArgType)]):
     ) -> None:
         self.settings = settings
         self.collection_name = collection_name or self.settings.default_collection
-        self.db = PersistentClient(
-            path=str(settings.path / "db"),
-        )
-        self.embed_model = settings.api
+        if not settings.read_only:
+            # read-only stores serve published snapshots instead, see `frag.embeddings.serving`
+            self.db = PersistentClient(
+                path=str(settings.path / "db"),
+            )
+        self.registry = CollectionRegistry(settings.path / "collections.json")
+        self._writes: int = 0
+        self._embed_models: Dict[Tuple[ApiSource, str], BaseEmbedding] = {
+            (settings.api_source, settings.api_model): settings.api
+        }
+        self.deduplicator = None
         self.change_collection(collection_name=collection_name)
-        self.text_splitter = SentenceSplitter()
+        self.text_splitter = make_node_parser(settings)
         self.docstore = SimpleDocumentStore()
-        self.vector_store = ChromaVectorStore(chroma_collection=self.collection)
+        self.retrieval_cache = (
+            RetrievalCache(
+                max_size=settings.retrieval_cache_size,
+                threshold=settings.retrieval_cache_threshold,
+            )
+            if settings.retrieval_cache_size > 0
+            else None
+        )
+        # the candidates of the most recent filters, for exact filtered searches
+        self.vector_cache = VectorCache(max_rows=settings.filter_exact_limit * 10)
 
     @classmethod
     def create(
@@ -86,31 +153,685 @@ class EmbeddingStore(SingletonMixin[type(ArgType)]):
         )
         return index.as_retriever()
 
+    def get_embed_model(self, api_source: ApiSource, api_model: str) -> BaseEmbedding:
+        """
+        Get an embedding model, loading it on first use.
+        """
+        key: Tuple[ApiSource, str] = (api_source, api_model)
+        if key not in self._embed_models:
+            self._embed_models[key] = get_embed_api(
+                api_source=api_source, api_model=api_model, **self.settings.backend_options
+            )
+        return self._embed_models[key]
+
     def change_collection(self, collection_name: str | None = None) -> None:
         """
-        Change the collection name
+        Change the collection name.
+
+        The collection is resolved through the registry, and is read and written with the
+        embedding model that built it, even if the settings name another one: run
+        `frag store:reembed` to migrate it.
         """
         self.collection_name = collection_name or self.settings.default_collection
-        self.collection = self.db.get_or_create_collection(name=self.collection_name)
+        if self.settings.read_only:
+            self.reader = SnapshotReader(serving_dir(self.settings.path, self.collection_name))
+            self._serve(self.reader.current)
+            return
+        self._registry_version: float = self.registry.version
+        entry: CollectionEntry | None = self.registry.get(self.collection_name)
+        if entry is None:
+            entry = CollectionEntry(
+                physical=self.collection_name,
+                api_source=self.settings.api_source,
+                api_model=self.settings.api_model,
+            )
+            self.registry.put(self.collection_name, entry)
+            self._registry_version = self.registry.version
+        elif entry.api_model != self.settings.api_model and entry.migration is None:
+            console.log(
+                f"[b]{self.collection_name}[/b] was embedded with {entry.api_model}, "
+                f"not {self.settings.api_model}: run `frag store:reembed` to migrate it"
+            )
+        self.entry = entry
+        self.embed_model = self.get_embed_model(entry.api_source, entry.api_model)
+        self.collection = get_or_create_bulk_collection(self.db, entry.physical)
+        self.vector_store = ChromaVectorStore(chroma_collection=self.collection)
         self.index = self.get_index()
+        for index in (
+            getattr(self, "sparse", None),
+            getattr(self, "metadata", None),
+            self.deduplicator,
+        ):
+            if index is not None:
+                index.close()
+        # keyed by the logical name, since re-embedding does not change the text
+        self.sparse = BM25Index(self.settings.path / "bm25" / f"{self.collection_name}.sqlite3")
+        self.metadata = MetadataIndex(
+            self.settings.path / "metadata" / f"{self.collection_name}.sqlite3",
+            keys=self.settings.metadata_index_keys,
+        )
+        self.deduplicator = (
+            DedupTransform(
+                threshold=self.settings.dedup_threshold,
+                path=str(self.settings.path / "dedup" / f"{self.collection_name}.sqlite3"),
+            )
+            if self.settings.dedup
+            else None
+        )
+        if self.settings.hybrid and len(self.sparse) == 0 and self.collection.count() > 0:
+            self.rebuild_sparse_index()
+        if len(self.metadata) == 0 and self.collection.count() > 0:
+            self.rebuild_metadata_index()
+
+    def _serve(self, snapshot: ServedSnapshot) -> None:
+        self._registry_version = 0.0
+        self.entry = CollectionEntry(
+            physical=snapshot.name,
+            api_source=snapshot.manifest.api_source,
+            api_model=snapshot.manifest.api_model,
+        )
+        self.embed_model = self.get_embed_model(self.entry.api_source, self.entry.api_model)
+        self.sparse = snapshot.sparse
+        self.metadata = snapshot.metadata
+
+    def _check_writable(self) -> None:
+        if self.settings.read_only:
+            raise ValueError("The store is read-only: write to it from a read-write process")
+
+    def _pages(self, page_size: int) -> Iterator[List[BaseNode]]:
+        offset: int = 0
+        while True:
+            result: Dict[str, List] = self.collection.get(
+                limit=page_size, offset=offset, include=["documents", "metadatas"]
+            )
+            if not result["ids"]:
+                return
+            yield [
+                metadata_dict_to_node(metadata, text=text)
+                for text, metadata in zip(result["documents"], result["metadatas"])
+            ]
+            offset += len(result["ids"])
+
+    def rebuild_sparse_index(self, page_size: int = 1000) -> None:
+        """
+        Rebuild the BM25 index of the collection from the nodes it holds.
+        """
+        console.log(f"Building the keyword index of [b]{self.collection_name}[/b]")
+        self.sparse.clear()
+        for nodes in self._pages(page_size):
+            self.sparse.add(nodes)
+
+    def rebuild_metadata_index(self, page_size: int = 1000) -> None:
+        """
+        Rebuild the metadata index of the collection from the nodes it holds.
+        """
+        console.log(f"Building the metadata index of [b]{self.collection_name}[/b]")
+        self.metadata.clear()
+        for nodes in self._pages(page_size):
+            self.metadata.add(nodes)
+
+    @property
+    def version(self) -> Tuple[str, float, int, int]:
+        """
+        Changes whenever the collection is written to: by this process, or by another one,
+        as seen from the modification time of its keyword index.
+        """
+        try:
+            modified: int = self.sparse.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            modified = 0
+        return (self.entry.physical, self._registry_version, self._writes, modified)
+
+    def refresh(self) -> None:
+        """
+        Reload the collection if the registry changed, e.g. when a migration switched reads
+        over to a new collection; in read-only mode, if another snapshot was published.
+        """
+        if self.reader is not None:
+            if self.reader.refresh():
+                self._serve(self.reader.current)
+        elif self.registry.version != self._registry_version:
+            self.change_collection(self.collection_name)
 
     def get_pipeline(
         self,
         addons: AddOns,
     ) -> IngestionPipeline:
         """
-        Ingest a URL into the embedding store.
+        Build the ingestion pipeline for the current collection.
         """
         return IngestionPipeline(
-            transformations=[
-                *addons["preprocessors"],
-                self.text_splitter,
-                self.embed_model,
-                *addons["extractors"],
-            ],
+            transformations=self._transformations(addons),
             cache=IngestionCache(
                 collection=f"{self.collection_name}-{self.embed_model.model_name}"
             ),
             vector_store=self.vector_store,
             docstore=self.docstore,
         )
+
+    def _transformations(self, addons: AddOns) -> List[TransformComponent]:
+        return [
+            *addons["preprocessors"],
+            self.text_splitter,
+            *([self.deduplicator] if self.deduplicator else []),
+            AdjacencyTransform(),
+            self.embed_model,
+            *addons["extractors"],
+        ]
+
+    def ingest(
+        self,
+        documents: Sequence[Document],
+        addons: AddOns,
+        ttl_days: float | None = None,
+    ) -> List[BaseNode]:
+        """
+        Run the ingestion pipeline on the given documents.
+
+        Documents from a source (URL or path) already in the collection replace the nodes
+        ingested from it before.
+
+        Args:
+            documents (Sequence[Document]): The documents to ingest.
+            addons (AddOns): Extra preprocessors and extractors for the pipeline.
+            ttl_days (float | None): Days before the nodes expire, and `frag store:gc`
+                deletes them; defaults to the `ttl_days` setting.
+
+        Returns:
+            List[BaseNode]: The nodes added to the store.
+        """
+        self._check_writable()
+        if self.deduplicator is not None:
+            self.deduplicator.forget(doc.doc_id for doc in documents)
+
+        started: float = time.time()
+        nodes: List[BaseNode] = self.get_pipeline(addons).run(documents=documents)
+        self._writes += 1
+        self.sparse.add(nodes)
+        self.metadata.add(nodes, ingested_at=started, expires_at=self._expiry(ttl_days))
+        # the nodes written before from the same sources or documents are deleted, vectors
+        # included: the docstore only knows the documents ingested by this process. Unchanged
+        # documents are skipped by the pipeline, and kept
+        written: Set[str] = {node.ref_doc_id or node.node_id for node in nodes}
+        self.retire_superseded(
+            nodes,
+            started,
+            keep=[doc.doc_id for doc in documents if doc.doc_id not in written],
+        )
+
+        if self.deduplicator is not None:
+            console.log(f"[b]Deduplication:[/b] {self.deduplicator.report}")
+        return nodes
+
+    def ingest_stream(
+        self,
+        documents: Iterable[Document],
+        addons: AddOns,
+        window: int = 256,
+        ttl_days: float | None = None,
+    ) -> int:
+        """
+        Run the ingestion pipeline on a stream of documents, `window` documents at a time.
+
+        Unlike `ingest`, nothing is kept once a window is written: there is no transformation
+        cache nor docstore, and the nodes are not returned, so memory stays flat however long
+        the stream. The deduplication index, if enabled, is the collection's, kept on disk.
+
+        Documents already in the collection are replaced, and so are the nodes ingested
+        before from the same sources (URLs or paths).
+
+        Args:
+            documents (Iterable[Document]): The documents, e.g. from a generator.
+            addons (AddOns): Extra preprocessors and extractors for the pipeline.
+            window (int): Documents run through the pipeline at a time.
+            ttl_days (float | None): Days before the nodes expire; defaults to the `ttl_days`
+                setting.
+
+        Returns:
+            int: The number of nodes added to the store.
+        """
+        self._check_writable()
+        pipeline: IngestionPipeline = IngestionPipeline(
+            transformations=self._transformations(addons),
+            disable_cache=True,
+        )
+        iterator: Iterator[Document] = iter(documents)
+        count: int = 0
+        # nodes written since the stream started are kept: a source may span windows
+        started: float = time.time()
+        while batch := list(islice(iterator, window)):
+            doc_ids: List[str] = [document.doc_id for document in batch]
+            if self.deduplicator is not None:
+                self.deduplicator.forget(doc_ids)
+            self.collection.delete(where={"document_id": {"$in": doc_ids}})
+            self.sparse.delete_documents(doc_ids)
+            self.metadata.delete_documents(doc_ids)
+            nodes: Sequence[BaseNode] = pipeline.run(documents=batch)
+            count += len(self.bulk_upsert(nodes, ttl_days=ttl_days))
+            self.retire_superseded(nodes, started)
+        return count
+
+    def add_nodes(
+        self, nodes: Sequence[BaseNode], ttl_days: float | None = None
+    ) -> List[str]:
+        """
+        Write embedded nodes to the collection, for ingestion paths that run their own
+        transformations.
+        """
+        return self.bulk_upsert(nodes, ttl_days=ttl_days)
+
+    def bulk_upsert(
+        self,
+        nodes: Sequence[BaseNode],
+        batch_size: int | None = None,
+        ttl_days: float | None = None,
+    ) -> List[str]:
+        """
+        Write embedded nodes to the collection, replacing the nodes with the same ids.
+
+        Args:
+            nodes (Sequence[BaseNode]): The nodes, with their embeddings.
+            batch_size (int | None): Records per upsert; defaults to the `upsert_batch_size`
+                setting, within Chroma's limit.
+            ttl_days (float | None): Days before the nodes expire; defaults to the `ttl_days`
+                setting.
+
+        Returns:
+            List[str]: The ids of the nodes written.
+        """
+        self._check_writable()
+        nodes = [node for node in nodes if node.embedding is not None]
+        if not nodes:
+            return []
+        size: int = min(
+            batch_size or self.settings.upsert_batch_size, self.db.max_batch_size
+        )
+        for start in range(0, len(nodes), size):
+            self.collection.upsert(**node_records(nodes[start : start + size]))
+        self.sparse.add(nodes)
+        self.metadata.add(nodes, ingested_at=time.time(), expires_at=self._expiry(ttl_days))
+        self._writes += 1
+        return [node.node_id for node in nodes]
+
+    def _expiry(self, ttl_days: float | None) -> float | None:
+        ttl_days = self.settings.ttl_days if ttl_days is None else ttl_days
+        return time.time() + ttl_days * 86400 if ttl_days else None
+
+    def retire_superseded(
+        self, nodes: Sequence[BaseNode], since: float, keep: Iterable[str] = ()
+    ) -> int:
+        """
+        Delete the nodes ingested before `since` from the same sources (URLs or paths), or
+        documents, as the given nodes, which replace them: re-ingesting a source upserts it,
+        and a document that shrank loses its trailing chunks.
+
+        Args:
+            nodes (Sequence[BaseNode]): The nodes just written, and indexed.
+            since (float): When they started being written, as a timestamp.
+            keep (Iterable[str]): Ids of documents whose nodes are kept regardless, e.g.
+                unchanged documents the pipeline skipped.
+
+        Returns:
+            int: The number of nodes deleted.
+        """
+        written: Set[str] = {node.node_id for node in nodes}
+        stale: List[str] = [
+            node_id
+            for node_id in self.metadata.superseded(
+                {source_key(node) for node in nodes},
+                keep,
+                since,
+                documents={node.ref_doc_id for node in nodes if node.ref_doc_id},
+            )
+            if node_id not in written
+        ]
+        return self.delete_nodes(stale)
+
+    def delete_nodes(self, node_ids: Sequence[str]) -> int:
+        """
+        Delete nodes from the collection, its indexes, the docstore and the caches.
+
+        The docstore only holds the documents ingested by this process, and is only told of the
+        documents left without nodes that the metadata index knew about.
+
+        Returns:
+            int: The number of nodes deleted.
+        """
+        self._check_writable()
+        node_ids = list(node_ids)
+        if not node_ids:
+            return 0
+        size: int = self.db.max_batch_size
+        for start in range(0, len(node_ids), size):
+            self.collection.delete(ids=node_ids[start : start + size])
+        self.sparse.delete(node_ids)
+        documents: Set[str] = self.metadata.delete(node_ids)
+        for ref_doc_id in documents:
+            self.docstore.delete_ref_doc(ref_doc_id, raise_error=False)
+        if self.deduplicator is not None:
+            self.deduplicator.discard(node_ids)
+        self._writes += 1
+        return len(node_ids)
+
+    def retrieve(
+        self,
+        query: str,
+        top_k: int = 5,
+        neighbours: int = 0,
+        hybrid: bool | None = None,
+        embedding: List[float] | None = None,
+        filters: MetadataFilter | None = None,
+    ) -> List[NodeWithScore]:
+        """
+        Retrieve the closest chunks to a query.
+
+        Args:
+            query (str): The query text.
+            top_k (int): The number of chunks to retrieve.
+            neighbours (int): How many chunks before and after each hit to add to the results.
+                Neighbours are fetched by id, without another vector query.
+            hybrid (bool | None): Fuse the vector search results with the BM25 ones, by
+                reciprocal rank; defaults to the `hybrid` setting.
+            embedding (List[float] | None): The query's embedding, if the caller has it.
+            filters (MetadataFilter | None): Only retrieve chunks whose document metadata
+                matches; the metadata index narrows the search down to them first.
+
+        Returns:
+            List[NodeWithScore]: The hits, followed by their neighbours (scored 0).
+
+        The hits of a query similar enough to a recent one (see `RetrievalCache`) are served
+        from the cache, until the collection changes.
+        """
+        self.refresh()
+        hybrid = self.settings.hybrid if hybrid is None else hybrid
+        cache: RetrievalCache | None = self.retrieval_cache
+        among: Set[str] | None = None
+        if filters is not None:
+            among = self.metadata.candidates(filters)
+            if not among:
+                return []
+        scope: Tuple[str, int, bool, str | None] = (
+            self.collection_name,
+            top_k,
+            hybrid,
+            filters.key if filters is not None else None,
+        )
+        version: Tuple[str, float, int, int] = self.version
+
+        cached: Hits | None = cache.get_exact(scope, version, query) if cache else None
+        if cached is None:
+            embedding = embedding or self.embed_model.get_query_embedding(query)
+            cached = cache.get(scope, version, embedding) if cache else None
+
+        hits: List[NodeWithScore]
+        if cached is not None:
+            nodes: Dict[str, BaseNode] = {
+                node.node_id: node for node in self.get_nodes([i for i, _ in cached])
+            }
+            hits = [
+                NodeWithScore(node=nodes[node_id], score=score)
+                for node_id, score in cached
+                if node_id in nodes
+            ]
+        else:
+            hits = self._search(
+                query, embedding, top_k, hybrid, among, filters.key if filters else None
+            )
+            if cache is not None:
+                cache.put(
+                    scope,
+                    version,
+                    query,
+                    embedding,
+                    [(hit.node.node_id, hit.score or 0.0) for hit in hits],
+                )
+        if neighbours > 0:
+            hits.extend(self._expand(hits, neighbours))
+        return hits
+
+    def _search(
+        self,
+        query: str,
+        embedding: List[float],
+        top_k: int,
+        hybrid: bool,
+        among: AbstractSet[str] | None = None,
+        filter_key: str | None = None,
+    ) -> List[NodeWithScore]:
+        if not hybrid:
+            return self._dense(query, embedding, top_k, among, filter_key)
+        # fuse deeper rankings than needed, so that hits ranked well by both surface
+        candidates: int = top_k * 4
+        dense: List[NodeWithScore] = self._dense(
+            query, embedding, candidates, among, filter_key
+        )
+        return reciprocal_rank_fusion(
+            dense, self._keyword(query, candidates, dense, among), k=self.settings.rrf_k
+        )[:top_k]
+
+    def _keyword(
+        self,
+        query: str,
+        top_k: int,
+        known: List[NodeWithScore],
+        among: AbstractSet[str] | None = None,
+    ) -> List[NodeWithScore]:
+        ranked: List[Tuple[str, float]] = self.sparse.search(query, top_k, among)
+        nodes: Dict[str, BaseNode] = {hit.node.node_id: hit.node for hit in known}
+        missing: List[str] = [node_id for node_id, _ in ranked if node_id not in nodes]
+        nodes.update({node.node_id: node for node in self.get_nodes(missing)})
+        return [
+            NodeWithScore(node=nodes[node_id], score=score)
+            for node_id, score in ranked
+            if node_id in nodes
+        ]
+
+    def _dense(
+        self,
+        query: str,
+        embedding: List[float],
+        top_k: int,
+        among: AbstractSet[str] | None = None,
+        filter_key: str | None = None,
+    ) -> List[NodeWithScore]:
+        if self.reader is not None:
+            return self.reader.current.search(embedding, top_k, among)
+        if among is not None:
+            if len(among) <= self.settings.filter_exact_limit:
+                return self._exact(embedding, top_k, among, filter_key)
+            return self._widened(query, embedding, top_k, among)
+        hits: List[NodeWithScore] = self._query(self.vector_store, embedding, top_k)
+        if (migration := self.entry.migration) is not None and migration.offset > 0:
+            # dual read: the shadow collection holds the records migrated so far
+            shadow: List[NodeWithScore] = self._query(
+                ChromaVectorStore(
+                    chroma_collection=self.db.get_collection(migration.target)
+                ),
+                self.get_embed_model(
+                    migration.api_source, migration.api_model
+                ).get_query_embedding(query),
+                top_k,
+            )
+            # the two models' similarities are not comparable: fuse the rankings instead
+            hits = reciprocal_rank_fusion(hits, shadow, k=self.settings.rrf_k)[:top_k]
+        return hits
+
+    def _exact(
+        self,
+        embedding: List[float],
+        top_k: int,
+        among: AbstractSet[str],
+        filter_key: str | None = None,
+        batch_size: int = 1000,
+    ) -> List[NodeWithScore]:
+        # a few candidates: compare the query with each of them, rather than search the index;
+        # their vectors are fetched once per filter, until the collection changes
+        scope: Tuple[str, str | None] = (self.collection_name, filter_key)
+        cached: Tuple[List[str], np.ndarray] | None = (
+            self.vector_cache.get(scope, self.version) if filter_key else None
+        )
+        if cached is None:
+            ids: List[str] = list(among)
+            embeddings: Dict[str, List[float]] = {}
+            for start in range(0, len(ids), batch_size):
+                embeddings.update(self.get_embeddings(ids[start : start + batch_size]))
+            ids = list(embeddings)
+            vectors: np.ndarray = np.asarray(list(embeddings.values()), dtype=np.float32)
+            if filter_key:
+                self.vector_cache.put(scope, self.version, ids, vectors)
+        else:
+            ids, vectors = cached
+        if not ids:
+            return []
+        rows, scores = top_k_cosine(embedding, vectors, top_k)
+        return self._scored([ids[row] for row in rows], scores)
+
+    def _widened(
+        self, query: str, embedding: List[float], top_k: int, among: AbstractSet[str]
+    ) -> List[NodeWithScore]:
+        # many candidates: search the index deeper and deeper, until enough hits are among them;
+        # past `filter_widen_limit` hits, the candidates are mostly far from the query, and are
+        # scanned instead
+        total: int = self.collection.count()
+        if total == 0:
+            return []
+        limit: int = min(total, self.settings.filter_widen_limit)
+        fetch: int = top_k * 4
+        while True:
+            hits: List[NodeWithScore] = [
+                hit
+                for hit in self._dense(query, embedding, min(fetch, limit))
+                if hit.node.node_id in among
+            ]
+            if len(hits) >= top_k or fetch >= total:
+                return hits[:top_k]
+            if fetch >= limit:
+                return self._scan(embedding, top_k, among)
+            fetch *= 4
+
+    def _scan(
+        self,
+        embedding: List[float],
+        top_k: int,
+        among: AbstractSet[str],
+        batch_size: int = 1000,
+    ) -> List[NodeWithScore]:
+        # compares the query with every candidate, a batch of vectors at a time, keeping only
+        # the best so far
+        ids: List[str] = list(among)
+        best: List[str] = []
+        scores: np.ndarray = np.zeros(0, dtype=np.float32)
+        for start in range(0, len(ids), batch_size):
+            embeddings: Dict[str, List[float]] = self.get_embeddings(
+                ids[start : start + batch_size]
+            )
+            if not embeddings:
+                continue
+            batch: List[str] = list(embeddings)
+            rows, batch_scores = top_k_cosine(
+                embedding, np.asarray(list(embeddings.values()), dtype=np.float32), top_k
+            )
+            best += [batch[row] for row in rows]
+            scores = np.concatenate([scores, batch_scores])
+            order: np.ndarray = np.argsort(-scores, kind="stable")[:top_k]
+            best, scores = [best[i] for i in order], scores[order]
+        return self._scored(best, scores)
+
+    def _scored(self, ids: List[str], scores: np.ndarray) -> List[NodeWithScore]:
+        nodes: Dict[str, BaseNode] = {node.node_id: node for node in self.get_nodes(ids)}
+        return [
+            NodeWithScore(node=nodes[node_id], score=float(score))
+            for node_id, score in zip(ids, scores)
+            if node_id in nodes
+        ]
+
+    def retrieve_documents(
+        self,
+        query: str,
+        top_k: int = 5,
+        neighbours: int = 0,
+        hybrid: bool | None = None,
+        embedding: List[float] | None = None,
+        filters: MetadataFilter | None = None,
+    ) -> List[Document]:
+        """
+        Retrieve the closest chunks to a query, merging adjacent ones into single documents.
+
+        See `retrieve` for the arguments.
+        """
+        return merge_neighbours(
+            self.retrieve(
+                query,
+                top_k=top_k,
+                neighbours=neighbours,
+                hybrid=hybrid,
+                embedding=embedding,
+                filters=filters,
+            ),
+            overlap=self.settings.chunk_overlap,
+        )
+
+    def get_nodes(self, node_ids: Sequence[str]) -> List[BaseNode]:
+        """
+        Fetch nodes from the collection by id.
+        """
+        if not node_ids:
+            return []
+        if self.reader is not None:
+            return self.reader.current.get_nodes(node_ids)
+        result: Dict[str, List] = self.collection.get(
+            ids=list(node_ids), include=["documents", "metadatas"]
+        )
+        nodes: List[BaseNode] = []
+        for text, metadata in zip(result["documents"], result["metadatas"]):
+            nodes.append(metadata_dict_to_node(metadata, text=text))
+        return nodes
+
+    def get_embeddings(self, node_ids: Sequence[str]) -> Dict[str, List[float]]:
+        """
+        Fetch the embeddings of nodes of the collection, by id.
+        """
+        if not node_ids:
+            return {}
+        if self.reader is not None:
+            return self.reader.current.get_embeddings(node_ids)
+        result: Dict[str, List] = self.collection.get(
+            ids=list(node_ids), include=["embeddings"]
+        )
+        return {
+            node_id: list(embedding)
+            for node_id, embedding in zip(result["ids"], result["embeddings"])
+        }
+
+    @staticmethod
+    def _query(
+        vector_store: ChromaVectorStore,
+        embedding: List[float],
+        top_k: int,
+    ) -> List[NodeWithScore]:
+        result: VectorStoreQueryResult = vector_store.query(
+            VectorStoreQuery(
+                query_embedding=embedding,
+                similarity_top_k=top_k,
+            )
+        )
+        return [
+            NodeWithScore(node=node, score=score)
+            for node, score in zip(result.nodes or [], result.similarities or [])
+        ]
+
+    def _expand(self, hits: List[NodeWithScore], steps: int) -> List[NodeWithScore]:
+        seen: Set[str] = {hit.node.node_id for hit in hits}
+        frontier: List[BaseNode] = [hit.node for hit in hits]
+        expanded: List[NodeWithScore] = []
+        for _ in range(steps):
+            ids: List[str] = [
+                i
+                for node in frontier
+                for i in (node.metadata.get("prev_id"), node.metadata.get("next_id"))
+                if i and i not in seen
+            ]
+            seen.update(ids)
+            frontier = self.get_nodes(ids)
+            expanded.extend(NodeWithScore(node=node, score=0.0) for node in frontier)
+        return expanded
@@ -0,0 +1,195 @@
+"""
+Tokenizers matching the models, to size chunks and batches in real tokens.
+
+HuggingFace models use their own (fast) tokenizer, through `transformers`; OpenAI models, for
+embeddings and completions, use `tiktoken`'s encoding for the model; other completion models use
+`litellm`'s tokenizer for the model. All but the latter encode in batches, in a single call.
+
+The same texts get counted over and over: blocks while chunking, then again while packing a
+chunk, documents each time they are packed for the archivists. Each `Tokenizer` keeps the token
+counts of the texts it has seen, keyed by a hash of their content, in a bounded LRU cache; the
+tokenizers are shared per model, and so are their caches.
+"""
+
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
+from threading import Lock
+from typing import Callable, List, Sequence
+
+from frag.typedefs.embed_types import ApiSource
+
+Encoder = Callable[[str], List[int]]
+BatchEncoder = Callable[[List[str]], List[List[int]]]
+Decoder = Callable[[List[int]], str]
+BatchCounter = Callable[[List[str]], List[int]]
+
+
+def _digest(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+class Tokenizer:
+    """
+    A model's tokenizer, encoding in batches, with a cache of token counts.
+
+    :param encode_batch: Encodes texts into tokens, without special tokens.
+    :param decode: Decodes tokens into text.
+    :param count_batch: Counts the tokens of texts, if cheaper than encoding them.
+    :param cache_size: Token counts kept in cache.
+    """
+
+    def __init__(
+        self,
+        encode_batch: BatchEncoder,
+        decode: Decoder,
+        count_batch: BatchCounter | None = None,
+        cache_size: int = 65536,
+    ) -> None:
+        self._encode_batch: BatchEncoder = encode_batch
+        self._decode: Decoder = decode
+        self._count_batch: BatchCounter = count_batch or (
+            lambda texts: [len(tokens) for tokens in encode_batch(texts)]
+        )
+        self.cache_size: int = cache_size
+        self.hits: int = 0
+        self.misses: int = 0
+        self._counts: OrderedDict[bytes, int] = OrderedDict()
+        self._lock: Lock = Lock()
+
+    def encode(self, text: str) -> List[int]:
+        return self._encode_batch([text])[0]
+
+    def encode_batch(self, texts: Sequence[str]) -> List[List[int]]:
+        """
+        Encodes texts in a single call, and caches their counts.
+        """
+        if not texts:
+            return []
+        encoded: List[List[int]] = self._encode_batch(list(texts))
+        with self._lock:
+            for text, tokens in zip(texts, encoded):
+                self._store(_digest(text), len(tokens))
+        return encoded
+
+    def decode(self, tokens: List[int]) -> str:
+        return self._decode(tokens)
+
+    def count(self, text: str) -> int:
+        """
+        Counts the tokens of a text.
+        """
+        return self.count_batch([text])[0]
+
+    def count_batch(self, texts: Sequence[str]) -> List[int]:
+        """
+        Counts the tokens of texts, encoding only those not in cache, in a single call.
+        """
+        keys: List[bytes] = [_digest(text) for text in texts]
+        counts: List[int | None] = []
+        with self._lock:
+            for key in keys:
+                count: int | None = self._counts.get(key)
+                if count is not None:
+                    self._counts.move_to_end(key)
+                counts.append(count)
+            missing: List[int] = [i for i, count in enumerate(counts) if count is None]
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        if missing:
+            # a text repeated in the batch is encoded once
+            unique: List[int] = list({keys[i]: i for i in missing}.values())
+            fresh = dict(
+                zip(
+                    [keys[i] for i in unique],
+                    self._count_batch([texts[i] for i in unique]),
+                )
+            )
+            with self._lock:
+                for key, count in fresh.items():
+                    self._store(key, count)
+            for i in missing:
+                counts[i] = fresh[keys[i]]
+        return counts  # type: ignore[return-value]
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """
+        Cuts a text to its first `max_tokens` tokens.
+        """
+        if self.count(text) <= max_tokens:
+            return text
+        return self.decode(self.encode(text)[:max_tokens])
+
+    def _store(self, key: bytes, count: int) -> None:
+        self._counts[key] = count
+        self._counts.move_to_end(key)
+        while len(self._counts) > self.cache_size:
+            self._counts.popitem(last=False)
+
+
+@lru_cache(maxsize=16)
+def get_tokenizer(api_source: ApiSource, api_model: str) -> Tokenizer:
+    """
+    Returns the (shared) tokenizer of an embedding model.
+    """
+    if api_source == "HuggingFace":
+        from transformers import AutoTokenizer
+
+        try:
+            tokenizer = AutoTokenizer.from_pretrained(api_model)
+        except OSError:
+            # sentence-transformers models are often named without their organisation
+            tokenizer = AutoTokenizer.from_pretrained(f"sentence-transformers/{api_model}")
+        return Tokenizer(
+            lambda texts: tokenizer(
+                texts,
+                add_special_tokens=False,
+                return_attention_mask=False,
+                return_token_type_ids=False,
+                verbose=False,
+            )["input_ids"],
+            tokenizer.decode,
+        )
+
+    import tiktoken
+
+    try:
+        encoding = tiktoken.encoding_for_model(api_model)
+    except KeyError:
+        encoding = tiktoken.get_encoding("cl100k_base")
+    return Tokenizer(
+        lambda texts: encoding.encode_batch(texts, disallowed_special=()),
+        encoding.decode,
+    )
+
+
+@lru_cache(maxsize=16)
+def get_llm_tokenizer(model: str) -> Tokenizer:
+    """
+    Returns the (shared) tokenizer of a completion model, as `litellm` counts its tokens: with
+    the model's `tiktoken` encoding for OpenAI models, counting what it encodes.
+    """
+    import tiktoken
+
+    try:
+        encoding = tiktoken.encoding_for_model(model.removeprefix("openai/"))
+    except KeyError:
+        pass
+    else:
+        return Tokenizer(
+            lambda texts: encoding.encode_batch(texts, disallowed_special=()),
+            encoding.decode,
+        )
+
+    from litellm import decode, encode, token_counter
+
+    def encode_batch(texts: List[str]) -> List[List[int]]:
+        # HuggingFace tokenizers return an `Encoding`, tiktoken a list
+        encoded = [encode(model=model, text=text) for text in texts]
+        return [list(getattr(tokens, "ids", tokens)) for tokens in encoded]
+
+    return Tokenizer(
+        encode_batch,
+        lambda tokens: decode(model=model, tokens=tokens),
+        count_batch=lambda texts: [token_counter(model=model, text=text) for text in texts],
+    )
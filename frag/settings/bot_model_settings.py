@@ -2,19 +2,34 @@
 LLM settings, used for both the interface and summarizer bots.
 """
 
-from typing import Any, Dict
+from typing import Any, Dict, Literal
 from litellm import get_model_info, get_supported_openai_params
 from pydantic import model_validator
-from pydantic_settings import BaseSettings
+from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
 class BotModelSettings(BaseSettings):
     """
     LLM settings, used for both the interface and summarizer bots.
+
+    Declared fields are frag's own options; any other key is passed to litellm as a
+    completion parameter, see `completion_kwargs`.
     """
 
+    model_config = SettingsConfigDict(extra="allow")
+
     api: str = "gpt-3.5-turbo"
     bot: str
+    batch_tokens: int | None = None  # summarizer only: token budget for batched documents
+    rpm: int | None = None  # requests per minute allowed for the model
+    tpm: int | None = None  # tokens per minute allowed for the model
+    retries: int = 3  # retries after rate limits and transient provider errors
+    hedge_percentile: float | None = None  # hedge calls slower than this latency percentile
+    hedge_model: str | None = None  # model for hedged calls; defaults to `api`
+    hedge_budget: float = 0.05  # maximum share of calls that can be hedged
+    # stable: keep the start of the prompts byte-identical across calls, for prompt caching
+    prompt_layout: Literal["inline", "stable"] = "inline"
+    prompt_cache_marker: bool = False  # mark the stable prefix for caching (Anthropic)
 
     def dump(self) -> dict[str, Any]:
         """
@@ -32,6 +47,13 @@ class BotModelSettings(BaseSettings):
         """
         return self.model_dump(exclude_unset=True, exclude_none=True)["api"]
 
+    @property
+    def completion_kwargs(self) -> dict[str, Any]:
+        """
+        Returns the litellm completion parameters.
+        """
+        return dict(self.model_extra or {})
+
     @model_validator(mode="before")
     @classmethod
     def validate_model(cls, values: dict[str, Any]) -> dict[str, Any]:
@@ -39,7 +61,7 @@ class BotModelSettings(BaseSettings):
         Makes sure all params are supported by the model.
         """
         other_values: Dict[str, Any] = {
-            k: v for k, v in values.items() if k not in ["api", "bot"]
+            k: v for k, v in values.items() if k not in cls.model_fields
         }
         # check if values are supported
         model_string: str = values.get("api", "gpt-3.5-turbo")
@@ -63,7 +85,6 @@ class BotModelSettings(BaseSettings):
                     f"Unsupported parameter {k} for model {values.get('model', 'gpt-3.5-turbo')}"
                 )
         return {
-            **other_values,
+            **values,
             "api": model_string,
-            "bot": values.get("bot"),
         }
@@ -1,5 +1,7 @@
+import hashlib
+import json
 from pathlib import Path
-from typing import Self, Dict, Any
+from typing import Self, Dict, Any, List, Literal
 from typing_extensions import TypedDict
 from pydantic_settings import BaseSettings
 from pydantic import field_validator, ValidationInfo
@@ -15,9 +17,29 @@ EmbedSettingsDict = TypedDict(
     {
         "api_name": str,
         "api_source": ApiSource,
+        "chunk_size": int,
         "chunk_overlap": int,
         "path": Path,
         "default_collection": str,
+        "dedup": bool,
+        "dedup_threshold": float,
+        "embed_rpm": int | None,
+        "embed_batch_size": int,
+        "upsert_batch_size": int,
+        "ttl_days": float | None,
+        "hybrid": bool,
+        "rrf_k": int,
+        "metadata_index_keys": List[str],
+        "filter_exact_limit": int,
+        "filter_widen_limit": int,
+        "retrieval_cache_size": int,
+        "retrieval_cache_threshold": float,
+        "hf_backend": Literal["torch", "onnx"],
+        "hf_quantize": bool,
+        "hf_threads": int | None,
+        "hf_workers": int,
+        "hf_max_pending": int | None,
+        "read_only": bool,
     },
 )
 
@@ -25,9 +47,29 @@ EmbedSettingsDict = TypedDict(
 class EmbedSettings(BaseSettings):
     api_source: ApiSource = "OpenAI"
     api_model: str = "text-embedding-3-large"
+    chunk_size: int = 512
     chunk_overlap: int = 0
     path: Path = Path("./db")
     default_collection: str = "default"
+    dedup: bool = True
+    dedup_threshold: float = 0.85
+    embed_rpm: int | None = None
+    embed_batch_size: int = 64
+    upsert_batch_size: int = 1000
+    ttl_days: float | None = None
+    hybrid: bool = True
+    rrf_k: int = 60
+    metadata_index_keys: List[str] = []
+    filter_exact_limit: int = 1000
+    filter_widen_limit: int = 10000
+    retrieval_cache_size: int = 1024
+    retrieval_cache_threshold: float = 0.95
+    hf_backend: Literal["torch", "onnx"] = "torch"
+    hf_quantize: bool = False
+    hf_threads: int | None = None
+    hf_workers: int = 0
+    hf_max_pending: int | None = None
+    read_only: bool = False
 
     @field_validator("default_collection")
     @classmethod
@@ -47,10 +89,46 @@ class EmbedSettings(BaseSettings):
     def api(self) -> BaseEmbedding:
         if not hasattr(self, "_api"):
             self._api: BaseEmbedding = get_embed_api(
-                api_model=self.api_model, api_source=self.api_source
+                api_model=self.api_model,
+                api_source=self.api_source,
+                **self.backend_options,
             )
         return self._api
 
+    @property
+    def backend_options(self) -> Dict[str, Any]:
+        """
+        Options of the local (HuggingFace) embedding backend, for `get_embed_api`.
+        """
+        return {
+            "backend": self.hf_backend,
+            "quantize": self.hf_quantize,
+            "threads": self.hf_threads,
+            "workers": self.hf_workers,
+            "max_pending": self.hf_max_pending,
+            "cache_dir": str(self.path),
+        }
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        Identifies what the stored chunks and vectors depend on: the embedding model and the
+        chunking settings.
+        """
+        settings: Dict[str, Any] = self.model_dump(
+            include={
+                "api_source",
+                "api_model",
+                "chunk_size",
+                "chunk_overlap",
+                "dedup",
+                "dedup_threshold",
+            }
+        )
+        return hashlib.sha256(
+            json.dumps(settings, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
     @classmethod
     def from_dict(
         cls,
@@ -62,9 +140,29 @@ class EmbedSettings(BaseSettings):
         instance: Self = cls(
             api_model=api_model,
             api_source=api_source,
+            chunk_size=embeds_dict.get("chunk_size", 512),
             chunk_overlap=embeds_dict.get("chunk_overlap", 0),
             default_collection=embeds_dict.get("default_collection", "default"),
             path=Path(embeds_dict.get("path", "./db")),
+            dedup=embeds_dict.get("dedup", True),
+            dedup_threshold=embeds_dict.get("dedup_threshold", 0.85),
+            embed_rpm=embeds_dict.get("embed_rpm", None),
+            embed_batch_size=embeds_dict.get("embed_batch_size", 64),
+            upsert_batch_size=embeds_dict.get("upsert_batch_size", 1000),
+            ttl_days=embeds_dict.get("ttl_days", None),
+            hybrid=embeds_dict.get("hybrid", True),
+            rrf_k=embeds_dict.get("rrf_k", 60),
+            metadata_index_keys=embeds_dict.get("metadata_index_keys", []),
+            filter_exact_limit=embeds_dict.get("filter_exact_limit", 1000),
+            filter_widen_limit=embeds_dict.get("filter_widen_limit", 10000),
+            retrieval_cache_size=embeds_dict.get("retrieval_cache_size", 1024),
+            retrieval_cache_threshold=embeds_dict.get("retrieval_cache_threshold", 0.95),
+            hf_backend=embeds_dict.get("hf_backend", "torch"),
+            hf_quantize=embeds_dict.get("hf_quantize", False),
+            hf_threads=embeds_dict.get("hf_threads", None),
+            hf_workers=embeds_dict.get("hf_workers", 0),
+            hf_max_pending=embeds_dict.get("hf_max_pending", None),
+            read_only=embeds_dict.get("read_only", False),
         )
         try:
             instance.api
@@ -59,6 +59,8 @@ class RecordMeta(DocMeta):
     parts: int = Field(1, description="Total parts of the document")
     before: str | None = Field(..., description="Text before the chunk")
     after: str | None = Field(..., description="Text after the chunk")
+    prev_id: str | None = Field(None, description="Id of the previous chunk")
+    next_id: str | None = Field(None, description="Id of the next chunk")
 
     extra_metadata: Dict[str, Union[str, int, float, date]] = Field(
         {}, description="Extra metadata"
@@ -0,0 +1,117 @@
+import math
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import pytest
+from llama_index.core.schema import TextNode
+
+from frag.embeddings.bm25 import BM25Index, tokenize
+
+TEXTS: Dict[str, str] = {
+    "a": "the os.path module joins paths",
+    "b": "the error ERR-42 is raised when the path is missing",
+    "c": "the quick brown fox jumps over the lazy dog",
+    "d": "the path of the fox, and the path of the dog",
+    "e": "the end",
+}
+
+
+@pytest.fixture
+def index(tmp_path: Path) -> BM25Index:
+    index = BM25Index(tmp_path / "bm25.sqlite3")
+    index.add(TextNode(id_=node_id, text=text) for node_id, text in TEXTS.items())
+    yield index
+    index.close()
+
+
+def reference(index: BM25Index, query: str, max_df: float) -> Dict[str, float]:
+    documents: Dict[str, Counter] = {i: Counter(tokenize(t)) for i, t in TEXTS.items()}
+    average: float = sum(sum(d.values()) for d in documents.values()) / len(documents)
+    terms: List[str] = list(dict.fromkeys(tokenize(query)))
+    frequencies: Dict[str, int] = {
+        term: sum(1 for d in documents.values() if term in d) for term in terms
+    }
+    frequencies = {term: df for term, df in frequencies.items() if df}
+    searched: Dict[str, int] = {
+        term: df for term, df in frequencies.items() if df <= max_df * len(documents)
+    } or dict([min(frequencies.items(), key=lambda f: f[1])])
+    scores: Dict[str, float] = {}
+    for term, df in searched.items():
+        idf: float = math.log(1 + (len(documents) - df + 0.5) / (df + 0.5))
+        for node_id, counts in documents.items():
+            if tf := counts[term]:
+                length: int = sum(counts.values())
+                scores[node_id] = scores.get(node_id, 0.0) + idf * tf * (index.k1 + 1) / (
+                    tf + index.k1 * (1 - index.b + index.b * length / average)
+                )
+    return scores
+
+
+def test_tokenize_keeps_identifiers() -> None:
+    assert tokenize("Call os.path, not ERR-42") == [
+        "call",
+        "os.path",
+        "os",
+        "path",
+        "not",
+        "err-42",
+        "err",
+        "42",
+    ]
+
+
+@pytest.mark.parametrize("query", ["os.path", "ERR-42 path", "fox dog", "path"])
+def test_scores_match_reference(index: BM25Index, query: str) -> None:
+    hits: List[Tuple[str, float]] = index.search(query, top_k=10)
+    expected: Dict[str, float] = reference(index, query, index.max_df)
+    assert {node_id for node_id, _ in hits} == set(expected)
+    for node_id, score in hits:
+        assert score == pytest.approx(expected[node_id])
+    assert [score for _, score in hits] == sorted((s for _, s in hits), reverse=True)
+
+
+def test_identifiers_rank_first(index: BM25Index) -> None:
+    assert index.search("os.path", top_k=1)[0][0] == "a"
+    assert index.search("err-42", top_k=1)[0][0] == "b"
+
+
+def test_common_terms_are_left_out(index: BM25Index) -> None:
+    # "the" is in every node: it does not change the ranking of the other terms
+    assert index.search("the lazy", top_k=10) == index.search("lazy", top_k=10)
+    # unless it is all there is
+    assert len(index.search("the", top_k=10)) == len(TEXTS)
+
+
+def test_top_k_and_among(index: BM25Index) -> None:
+    assert len(index.search("path", top_k=2)) == 2
+    assert [node_id for node_id, _ in index.search("path", 10, among={"a", "c"})] == ["a"]
+    assert index.search("path", 10, among=set()) == []
+    # the restriction does not outlive the search
+    assert len(index.search("path", top_k=10)) == 3
+
+
+def test_no_match(index: BM25Index) -> None:
+    assert index.search("", top_k=5) == []
+    assert index.search("zebra", top_k=5) == []
+
+
+def test_delete_and_replace(index: BM25Index) -> None:
+    index.delete(["a"])
+    assert "a" not in {node_id for node_id, _ in index.search("path", 10)}
+    index.add([TextNode(id_="c", text="an os.path example")])
+    assert index.search("os.path", top_k=1)[0][0] == "c"
+    assert [node_id for node_id, _ in index.search("fox", top_k=10)] == ["d"]
+
+
+def test_read_only(index: BM25Index) -> None:
+    expected: List[Tuple[str, float]] = index.search("fox dog", top_k=10)
+    index.close()
+    reader = BM25Index(index.path, read_only=True)
+    try:
+        assert reader.search("fox dog", top_k=10) == expected
+        assert reader.search("fox dog", 10, among={"c"}) == [
+            ("c", pytest.approx(dict(expected)["c"]))
+        ]
+    finally:
+        reader.close()
@@ -0,0 +1,90 @@
+from typing import List
+
+import pytest
+from llama_index.core.schema import Document
+
+from frag.completions.notes import VerdictStreamParser, parse_batch, parse_verdict
+from frag.typedefs import Note
+
+
+@pytest.fixture
+def documents() -> List[Document]:
+    return [
+        Document(
+            text=f"text {i}",
+            doc_id=f"doc-{i}",
+            metadata={"url": f"https://example.com/{i}", "title": f"Title {i}"},
+        )
+        for i in range(1, 4)
+    ]
+
+
+def verdict(relevant: str, summary: str = "", complete: str = "false") -> str:
+    return (
+        f"<relevant>{relevant}</relevant>\n<complete>{complete}</complete>\n"
+        f"<summary>{summary}</summary>"
+    )
+
+
+def test_parse_verdict(documents: List[Document]) -> None:
+    note: Note | None = parse_verdict(verdict("true", " The gist ", "true"), documents[0])
+    assert note == Note(
+        id="doc-1",
+        source="https://example.com/1",
+        title="Title 1",
+        summary="The gist",
+        complete=True,
+    )
+    assert parse_verdict(verdict("false", "ignored"), documents[0]) is None
+    assert parse_verdict(verdict("true", ""), documents[0]) is None
+
+
+def test_parse_batch(documents: List[Document]) -> None:
+    text: str = (
+        f'<verdict id="2">{verdict("true", "second")}</verdict>\n'
+        f"<verdict id=1>{verdict('True', 'first', 'true')}</verdict>\n"
+        f"<verdict id='3'>{verdict('false', 'third')}</verdict>\n"
+        # unknown and repeated ids are ignored
+        f'<verdict id="9">{verdict("true", "ninth")}</verdict>\n'
+        f'<verdict id="2">{verdict("true", "second again")}</verdict>'
+    )
+    notes: List[Note] = parse_batch(text, documents)
+    assert [(n.id, n.summary, n.complete) for n in notes] == [
+        ("doc-2", "second", False),
+        ("doc-1", "first", True),
+    ]
+
+
+def test_parse_batch_missing_verdicts(documents: List[Document]) -> None:
+    assert parse_batch("", documents) == []
+    # a batch cut before its closing tag
+    assert parse_batch('<verdict id="1">' + verdict("true", "cut"), documents) == []
+
+
+def test_stream_parser_stops_on_irrelevant(documents: List[Document]) -> None:
+    parser = VerdictStreamParser(documents[0])
+    assert parser.feed("<relevant>")
+    assert not parser.feed("f")
+    assert parser.done
+    assert parser.note is None
+
+
+def test_stream_parser_builds_note(documents: List[Document]) -> None:
+    parser = VerdictStreamParser(documents[1])
+    text: str = verdict("true", "A partial, then full summary.", "true")
+    cut: int = text.index("then")
+    for char in text[:cut]:
+        assert parser.feed(char)
+    assert parser.relevant is True
+    assert not parser.done
+    assert parser.note is not None and parser.note.summary == "A partial,"
+
+    assert parser.feed(text[cut:])
+    assert parser.done
+    assert parser.note == Note(
+        id="doc-2",
+        source="https://example.com/2",
+        title="Title 2",
+        summary="A partial, then full summary.",
+        complete=True,
+    )
@@ -0,0 +1,112 @@
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List
+
+import chromadb
+import numpy as np
+import pytest
+from llama_index.core.schema import TextNode
+
+from frag.embeddings import snapshot
+from frag.embeddings.bulk import node_records
+from frag.embeddings.registry import CollectionEntry, CollectionRegistry
+from frag.embeddings.serving import ServedSnapshot, SnapshotReader, publish, serving_dir
+from frag.embeddings.snapshot import Manifest, export_snapshot, read_manifest
+
+# ids the records file escapes, or stores as multi-byte UTF-8
+IDS: List[str] = [
+    "plain",
+    'with "quotes"',
+    "back\\slash",
+    'both \\"',
+    "naïve café",
+    "日本語のノード",
+    "emoji 🙂",
+    "tab\tand newline\n",
+]
+
+
+@pytest.fixture
+def vectors() -> Dict[str, List[float]]:
+    rng: np.random.Generator = np.random.default_rng(0)
+    return {node_id: rng.normal(size=8).astype(np.float32).tolist() for node_id in IDS}
+
+
+@pytest.fixture
+def published(
+    tmp_path: Path, vectors: Dict[str, List[float]], monkeypatch: pytest.MonkeyPatch
+) -> ServedSnapshot:
+    # a few records per segment, so that they spread over several
+    monkeypatch.setattr(snapshot, "SEGMENT_RECORDS", 2)
+    path: Path = tmp_path / ".frag"
+    registry = CollectionRegistry(path / "collections.json")
+    registry.put(
+        "docs",
+        CollectionEntry(physical="docs", api_source="OpenAI", api_model="test-model"),
+    )
+    store = SimpleNamespace(
+        collection_name="docs",
+        registry=registry,
+        db=chromadb.PersistentClient(path=str(path / "db")),
+        settings=SimpleNamespace(path=path, api_model="test-model", fingerprint="test"),
+    )
+    nodes: List[TextNode] = [
+        TextNode(
+            id_=node_id,
+            text=f"text of {node_id}",
+            metadata={"title": f"title of {node_id}"},
+            embedding=vector,
+        )
+        for node_id, vector in vectors.items()
+    ]
+    store.db.create_collection("docs").upsert(**node_records(nodes))
+
+    manifest: Manifest = export_snapshot(store, tmp_path / "snapshot", page_size=3)
+    assert len(manifest.segments) > 1
+    assert sum(segment.records for segment in manifest.segments) == len(IDS)
+    assert read_manifest(tmp_path / "snapshot") == manifest
+
+    publish(path, "docs", tmp_path / "snapshot")
+    return SnapshotReader(serving_dir(path, "docs")).current
+
+
+def test_locate(published: ServedSnapshot) -> None:
+    locations = published.locate(IDS + ["missing", 'with "quotes" '])
+    assert set(locations) == set(IDS)
+    for node_id, (segment, row) in locations.items():
+        assert published.record(segment, row)["id"] == node_id
+        assert published.find(node_id) == (segment, row)
+    assert published.find("missing") is None
+
+
+def test_get_nodes_and_embeddings(
+    published: ServedSnapshot, vectors: Dict[str, List[float]]
+) -> None:
+    nodes = published.get_nodes(list(reversed(IDS)) + ["missing"])
+    assert [node.node_id for node in nodes] == list(reversed(IDS))
+    for node in nodes:
+        assert node.get_content() == f"text of {node.node_id}"
+        assert node.metadata["title"] == f"title of {node.node_id}"
+
+    embeddings: Dict[str, List[float]] = published.get_embeddings(IDS)
+    assert set(embeddings) == set(IDS)
+    for node_id, embedding in embeddings.items():
+        assert embedding == pytest.approx(vectors[node_id])
+
+
+def test_search(published: ServedSnapshot, vectors: Dict[str, List[float]]) -> None:
+    for node_id, vector in vectors.items():
+        hits = published.search(vector, top_k=3)
+        assert len(hits) == 3
+        assert hits[0].node.node_id == node_id
+        assert hits[0].score == pytest.approx(1.0)
+        assert [hit.score for hit in hits] == sorted((hit.score for hit in hits), reverse=True)
+
+
+def test_search_among(published: ServedSnapshot, vectors: Dict[str, List[float]]) -> None:
+    among = {'with "quotes"', "日本語のノード", "back\\slash", "missing"}
+    hits = published.search(vectors["plain"], top_k=10, among=among)
+    assert {hit.node.node_id for hit in hits} == among - {"missing"}
+    hits = published.search(vectors["back\\slash"], top_k=1, among=among)
+    assert [hit.node.node_id for hit in hits] == ["back\\slash"]
+    assert published.search(vectors["plain"], top_k=3, among={"missing"}) == []